@@ -0,0 +1,889 @@
+"""
+Benchmarks for the print server.
+
+Runs against the in-memory CUPS fake and a throwaway database and upload
+directory, so it needs neither cupsd nor the real printer.db:
+
+    python bench.py                      # every scenario
+    python bench.py db-job-status        # just one
+    python bench.py startup              # cold start in fresh processes
+    python bench.py --json results.json  # also write machine-readable results
+    python bench.py --compare results.json  # flag regressions against a saved run
+"""
+
+import argparse
+import http.client
+import io
+import json
+import os
+import random
+import shutil
+import sqlite3
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+# Scratch space for the run, removed when it ends. Spawned PDF parse
+# workers re-import this module as __mp_main__ and inherit the paths
+# below through the environment, so only the bench process makes one.
+WORK_DIR = tempfile.mkdtemp(prefix="printer-bench-") if __name__ == "__main__" else None
+
+os.environ.setdefault("PRINTER_FAKE_CUPS", "1")
+os.environ.setdefault("FAKE_CUPS_SECONDS_PER_PAGE", "0")
+if WORK_DIR:
+    os.environ.setdefault("PRINTER_DB_PATH", os.path.join(WORK_DIR, "printer.db"))
+    os.environ.setdefault("PRINTER_UPLOAD_DIR", os.path.join(WORK_DIR, "uploads"))
+
+# main.py resolves static/ and templates/ relative to the working directory
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+import main  # noqa: E402
+import pdf_inspect  # noqa: E402
+import uvicorn  # noqa: E402
+from fastapi import Depends  # noqa: E402
+from PyPDF2 import PdfWriter  # noqa: E402
+
+
+SCENARIOS = {}
+
+
+def scenario(name):
+    def register(fn):
+        SCENARIOS[name] = fn
+        return fn
+    return register
+
+
+def percentile(sorted_values, pct):
+    index = min(len(sorted_values) - 1, round(pct / 100 * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+def measure(label, fn, requests, concurrency=1):
+    """
+    Call fn(i) for i in range(requests) from `concurrency` threads and
+    return throughput and latency percentiles.
+    """
+    latencies = []
+
+    def one(i):
+        start = time.perf_counter()
+        fn(i)
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    if concurrency == 1:
+        for i in range(requests):
+            one(i)
+    else:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(one, range(requests)))
+    elapsed = time.perf_counter() - start
+
+    return summarize(label, latencies, elapsed, concurrency)
+
+
+def summarize(label, latencies, elapsed, concurrency=1):
+    latencies = sorted(latencies)
+    requests = len(latencies)
+    return {
+        "label": label,
+        "requests": requests,
+        "concurrency": concurrency,
+        "seconds": round(elapsed, 4),
+        "rps": round(requests / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+    }
+
+
+# ---------- PDF corpus ----------
+
+def make_pdf(pages):
+    writer = PdfWriter()
+    for _ in range(pages):
+        writer.add_blank_page(595, 842)
+    writer.add_metadata({"/Title": f"Bench {pages} pages"})
+    buffer = io.BytesIO()
+    writer.write(buffer)
+    return buffer.getvalue()
+
+
+def pdf_corpus():
+    """
+    Write the benchmark PDFs once per run and return {name: path}.
+    """
+    corpus_dir = os.path.join(WORK_DIR, "corpus")
+    if os.path.isdir(corpus_dir):
+        return {
+            os.path.splitext(name)[0]: os.path.join(corpus_dir, name)
+            for name in sorted(os.listdir(corpus_dir))
+        }
+
+    os.makedirs(corpus_dir)
+    large = make_pdf(2000)
+    rng = random.Random(1020)
+
+    documents = {
+        "small": make_pdf(1),
+        "medium": make_pdf(40),
+        "large": large,
+        "truncated": large[: len(large) // 2],
+        "garbage": b"%PDF-1.4\n" + bytes(rng.getrandbits(8) for _ in range(256 * 1024)),
+    }
+
+    for name, data in documents.items():
+        with open(os.path.join(corpus_dir, f"{name}.pdf"), "wb") as f:
+            f.write(data)
+
+    return pdf_corpus()
+
+
+def ignore_pdf_errors(fn):
+    def call(*args):
+        try:
+            fn(*args)
+        except Exception:
+            pass
+    return call
+
+
+# ---------- HTTP ----------
+
+_server_port = None
+_http_local = threading.local()
+
+
+def serve():
+    """
+    Start the app under uvicorn on a free local port (once per run) and
+    return the port.
+    """
+    global _server_port
+    if _server_port is None:
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            port = s.getsockname()[1]
+
+        server = uvicorn.Server(uvicorn.Config(main.app, host="127.0.0.1", port=port, log_level="warning"))
+        threading.Thread(target=server.run, daemon=True).start()
+        while not server.started:
+            time.sleep(0.01)
+        _server_port = port
+
+    return _server_port
+
+
+def multipart_body(form, files):
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in form.items():
+        parts.append(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode()
+        )
+    for name, (filename, data) in files.items():
+        parts.append(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+            f'Content-Type: application/pdf\r\n\r\n'.encode() + data + b"\r\n"
+        )
+    parts.append(f"--{boundary}--\r\n".encode())
+    return b"".join(parts), f"multipart/form-data; boundary={boundary}"
+
+
+def http_connection():
+    # One keep-alive connection per benchmark thread
+    conn = getattr(_http_local, "conn", None)
+    if conn is None:
+        conn = _http_local.conn = http.client.HTTPConnection("127.0.0.1", serve())
+    return conn
+
+
+def http_request(method, path, form=None, token=None, files=None):
+    headers = {}
+    body = None
+    if files is not None:
+        body, headers["Content-Type"] = multipart_body(form or {}, files)
+    elif form is not None:
+        body = urllib.parse.urlencode(form)
+        headers["Content-Type"] = "application/x-www-form-urlencoded"
+    if token:
+        headers["Authorization"] = f"Bearer {token}"
+
+    try:
+        conn = http_connection()
+        conn.request(method, path, body=body, headers=headers)
+        response = conn.getresponse()
+    except (BrokenPipeError, ConnectionResetError, http.client.RemoteDisconnected):
+        # The server closed an idle keep-alive connection; reconnect once
+        _http_local.conn.close()
+        _http_local.conn = None
+        conn = http_connection()
+        conn.request(method, path, body=body, headers=headers)
+        response = conn.getresponse()
+
+    return response.status, response.read()
+
+
+def bench_user(username, password, role="user"):
+    conn = main.get_db()
+    conn.execute("""
+        INSERT OR REPLACE INTO users (username, password_hash, role, must_change_password)
+        VALUES (?, ?, ?, 0)
+    """, (username, main.hash_password(password), role))
+    conn.commit()
+
+
+def bench_login(username, password, role="user"):
+    bench_user(username, password, role)
+    status, body = http_request("POST", "/login", form={"username": username, "password": password})
+    if status != 200:
+        raise RuntimeError(f"login as {username} failed: {status} {body[:200]!r}")
+    return json.loads(body)["token"]
+
+
+class Background:
+    """
+    Run fn() in a loop on `threads` threads for the duration of a with
+    block.
+    """
+
+    def __init__(self, fn, threads):
+        self.fn = fn
+        self.threads = threads
+        self.stop = threading.Event()
+        self.calls = 0
+
+    def _loop(self):
+        while not self.stop.is_set():
+            self.fn()
+            self.calls += 1
+
+    def __enter__(self):
+        self._workers = [threading.Thread(target=self._loop, daemon=True) for _ in range(self.threads)]
+        for worker in self._workers:
+            worker.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop.set()
+        for worker in self._workers:
+            worker.join()
+
+
+# ---------- Baselines ----------
+
+def legacy_db_path():
+    # Same schema as the live database, but in the default rollback journal
+    # mode the server used before connections were pooled
+    path = os.path.join(WORK_DIR, "legacy.db")
+    if not os.path.exists(path):
+        legacy = sqlite3.connect(path)
+        main.get_db().backup(legacy)
+        legacy.execute("PRAGMA journal_mode=DELETE")
+        legacy.close()
+    return path
+
+
+def legacy_get_job(path, job_id):
+    conn = sqlite3.connect(path)
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT job_id, status, filename, file_path, cancel_requested, created_at
+        FROM print_jobs
+        WHERE job_id = ?
+    """, (job_id,))
+    row = cursor.fetchone()
+    conn.close()
+    return row
+
+
+def legacy_insert_job(path):
+    conn = sqlite3.connect(path)
+    cursor = conn.cursor()
+    cursor.execute("""
+        INSERT INTO print_jobs (user_id, status, filename, file_path, papers, cancel_requested, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    """, (1, "completed", "bench.pdf", "bench.pdf", 1, 0, datetime.now(timezone.utc).isoformat()))
+    conn.commit()
+    conn.close()
+
+
+_sync_baselines_mounted = False
+
+
+def mount_sync_baselines():
+    """
+    The hot endpoints as they were before the async storage path: sync
+    handlers and a sync auth dependency, all on Starlette's threadpool.
+    Mounted under /sync on the app being measured.
+    """
+    global _sync_baselines_mounted
+    if _sync_baselines_mounted:
+        return
+    _sync_baselines_mounted = True
+
+    def sync_user(credentials=Depends(main.security)):
+        return main.lookup_token(credentials.credentials)
+
+    def job_status(job_id: int):
+        job = main.get_job(job_id)
+        if not job:
+            return {"error": "Job not found"}
+        job.update(main.get_queue_position(job_id, job))
+        return job
+
+    def my_jobs(user=Depends(sync_user)):
+        page, next_after_job_id = main.list_jobs_page(user_id=user["user_id"])
+        return {"jobs": page, "next_after_job_id": next_after_job_id}
+
+    def get_quota(user=Depends(sync_user)):
+        return {"used": main.get_monthly_paper_usage(user["user_id"]), "limit": main.MONTHLY_PAPER_QUOTA}
+
+    main.app.add_api_route("/sync/job/{job_id}", job_status)
+    main.app.add_api_route("/sync/jobs", my_jobs)
+    main.app.add_api_route("/sync/quota", get_quota)
+
+
+def bench_insert_job():
+    return main.insert_job(
+        user_id=1,
+        status=main.JOB_COMPLETED,
+        filename="bench.pdf",
+        file_path="bench.pdf",
+        papers=1,
+        printer_name=None
+    )
+
+
+# ---------- Scenarios ----------
+
+@scenario("db-job-status")
+def db_job_status(args):
+    job_id = bench_insert_job()
+    legacy = legacy_db_path()
+
+    return [
+        measure(
+            "connect-per-call",
+            lambda i: legacy_get_job(legacy, job_id),
+            args.requests, args.concurrency
+        ),
+        measure(
+            "pooled",
+            lambda i: main.get_job_from_db(job_id),
+            args.requests, args.concurrency
+        ),
+    ]
+
+
+@scenario("db-submit")
+def db_submit(args):
+    legacy = legacy_db_path()
+
+    return [
+        measure(
+            "connect-per-call",
+            lambda i: legacy_insert_job(legacy),
+            args.requests, args.concurrency
+        ),
+        measure(
+            "pooled",
+            lambda i: bench_insert_job(),
+            args.requests, args.concurrency
+        ),
+    ]
+
+
+@scenario("page-count")
+def page_count(args):
+    pool = pdf_inspect.FallbackPool(workers=2, timeout=10)
+    requests = max(10, args.requests // 50)
+    results = []
+
+    for name, path in pdf_corpus().items():
+        results.append(measure(
+            f"{name}: full parse",
+            ignore_pdf_errors(lambda i: pdf_inspect.full_inspect(path)),
+            requests
+        ))
+        results.append(measure(
+            f"{name}: fast path",
+            ignore_pdf_errors(lambda i: pdf_inspect.inspect(path, pool)),
+            requests
+        ))
+
+    return results
+
+
+@scenario("login-mixed")
+def login_mixed(args):
+    """
+    /job status latency on its own, during a storm of valid logins (rate
+    limits off, so every request costs a bcrypt hash), and during a
+    brute-force run against one account (rate limits on).
+    """
+    job_id = bench_insert_job()
+    bench_user("bench", "Bench-password-1")
+    requests = max(50, args.requests // 10)
+    storm = max(4, args.concurrency * 2)
+
+    def status(i):
+        http_request("GET", f"/job/{job_id}")
+
+    def good_login():
+        http_request("POST", "/login", form={"username": "bench", "password": "Bench-password-1"})
+
+    def bad_login():
+        http_request("POST", "/login", form={"username": "bench", "password": "wrong"})
+
+    results = [measure("status: idle", status, requests, args.concurrency)]
+
+    limits = [(limiter, limiter.rate) for limiter in (main.login_ip_limiter, main.login_user_limiter)]
+    for limiter, _ in limits:
+        limiter.rate = 0
+    try:
+        with Background(good_login, storm) as logins:
+            results.append(measure("status: login storm", status, requests, args.concurrency))
+            results.append(measure("login: login storm", lambda i: good_login(), max(10, requests // 10), 1))
+        print(f"login storm: {logins.calls} logins")
+    finally:
+        for limiter, rate in limits:
+            limiter.rate = rate
+
+    with Background(bad_login, storm) as attempts:
+        results.append(measure("status: brute force", status, requests, args.concurrency))
+    print(f"brute force: {attempts.calls} attempts")
+
+    return results
+
+
+@scenario("async-endpoints")
+def async_endpoints(args):
+    """
+    For /job/{id}, /jobs and /quota, the most concurrent clients each
+    version (sync baseline, async) serves while keeping p99 within
+    --p99-ms. Levels double until one misses the target.
+    """
+    mount_sync_baselines()
+    token = bench_login("bench", "Bench-password-1")
+    job_id = bench_insert_job()
+
+    paths = [f"/job/{job_id}", "/jobs", "/quota"]
+    levels = (8, 16, 32, 64, 128, 256)
+    results = []
+
+    for path in paths:
+        for variant, prefix in (("sync", "/sync"), ("async", "")):
+            best = 0
+            for concurrency in levels:
+                r = measure(
+                    f"{variant} {path} c={concurrency}",
+                    lambda i: http_request("GET", prefix + path, token=token),
+                    max(args.requests // 4, concurrency * 10),
+                    concurrency
+                )
+                r["within_p99"] = r["p99_ms"] <= args.p99_ms
+                results.append(r)
+                if not r["within_p99"]:
+                    break
+                best = concurrency
+            print(f"{variant} {path}: {best} concurrent clients within p99 {args.p99_ms} ms")
+
+    return results
+
+
+@scenario("submit-burst")
+def submit_burst(args):
+    """
+    /print uploads from many clients at once: distinct small documents,
+    then the same medium document over and over (dedup hits).
+    """
+    token = bench_login("bench-admin", "Bench-password-1", role="admin")
+    medium = open(pdf_corpus()["medium"], "rb").read()
+    requests = max(20, args.requests // 10)
+
+    # Different bytes per request so every upload is parsed and stored
+    small = [make_pdf(1 + i % 3) + f"%{i}\n".encode() for i in range(requests)]
+
+    def submit(data):
+        status, body = http_request("POST", "/print", token=token, form={"copies": "1"}, files={"file": ("bench.pdf", data)})
+        if status != 200:
+            raise RuntimeError(f"/print returned {status}: {body[:200]!r}")
+
+    return [
+        measure("distinct small", lambda i: submit(small[i]), requests, args.concurrency),
+        measure("repeated medium", lambda i: submit(medium), requests, args.concurrency),
+    ]
+
+
+@scenario("status-polling")
+def status_polling(args):
+    """
+    --tabs open print pages, each polling its job, the printer status
+    (with its ETag) and the quota, as the page does without event streams.
+    """
+    tabs = args.tabs
+    tokens = [bench_login(f"bench-tab-{i}", "Bench-password-1") for i in range(min(tabs, 16))]
+    job_ids = [bench_insert_job() for _ in range(tabs)]
+    etags = {}
+
+    def poll_job(i):
+        http_request("GET", f"/job/{job_ids[i % tabs]}")
+
+    def poll_printer(i):
+        token = tokens[i % len(tokens)]
+        conn = http_connection()
+        headers = {"Authorization": f"Bearer {token}"}
+        if token in etags:
+            headers["If-None-Match"] = etags[token]
+        conn.request("GET", "/printer/status", headers=headers)
+        response = conn.getresponse()
+        response.read()
+        etags[token] = response.getheader("ETag")
+
+    def poll_quota(i):
+        http_request("GET", "/quota", token=tokens[i % len(tokens)])
+
+    return [
+        measure(f"job, {tabs} tabs", poll_job, args.requests, tabs),
+        measure(f"printer, {tabs} tabs", poll_printer, args.requests, tabs),
+        measure(f"quota, {tabs} tabs", poll_quota, args.requests, tabs),
+    ]
+
+
+def fill_print_jobs(rows):
+    """
+    Bring print_jobs up to `rows` rows, spread over 500 users and the
+    last year. Committed in batches so printer workers still finishing
+    earlier scenarios' jobs aren't locked out.
+    """
+    conn = main.get_db()
+    have = conn.execute("SELECT COUNT(*) FROM print_jobs").fetchone()[0]
+    if have >= rows:
+        return
+
+    rng = random.Random(1020)
+    now = time.time()
+    statuses = [main.JOB_COMPLETED] * 8 + [main.JOB_FAILED, main.JOB_CANCELLED]
+
+    def generate(count):
+        for _ in range(count):
+            created_at = datetime.fromtimestamp(now - rng.random() * 365 * 86400, timezone.utc).isoformat()
+            yield (rng.randint(1, 500), rng.choice(statuses), "bench.pdf", "bench.pdf", rng.randint(1, 20), created_at)
+
+    for batch in range(have, rows, 20_000):
+        conn.executemany("""
+            INSERT INTO print_jobs (user_id, status, filename, file_path, papers, cancel_requested, created_at)
+            VALUES (?, ?, ?, ?, ?, 0, ?)
+        """, generate(min(20_000, rows - batch)))
+        conn.commit()
+
+
+@scenario("admin-list")
+def admin_list(args):
+    """
+    /admin/jobs over a print_jobs table of --rows rows: the first page, a
+    page deep in the keyset, and the status and date filters.
+    """
+    start = time.perf_counter()
+    fill_print_jobs(args.rows)
+    print(f"print_jobs filled to {args.rows} rows in {time.perf_counter() - start:.1f}s")
+
+    token = bench_login("bench-admin", "Bench-password-1", role="admin")
+    deep = args.rows // 2
+    month_ago = (datetime.now(timezone.utc) - timedelta(days=30)).date().isoformat()
+    requests = max(50, args.requests // 10)
+
+    def get(path):
+        return lambda i: http_request("GET", path, token=token)
+
+    return [
+        measure("first page", get("/admin/jobs"), requests, args.concurrency),
+        measure("deep page", get(f"/admin/jobs?after_job_id={deep}"), requests, args.concurrency),
+        measure("status filter", get("/admin/jobs?status=failed"), requests, args.concurrency),
+        measure("last 30 days", get(f"/admin/jobs?created_from={month_ago}"), requests, args.concurrency),
+    ]
+
+
+def legacy_follow(conn, job_id):
+    # The print worker's old loop: a second's sleep, then every
+    # not-completed job in CUPS, until this one is no longer among them
+    while True:
+        time.sleep(1)
+        if job_id not in conn.getJobs(which_jobs="not-completed"):
+            return
+
+
+def tracker_follow(job_id):
+    main.cups_job_tracker.wait(job_id, lambda: False)
+
+
+@scenario("cups-tracking")
+def cups_tracking(args):
+    """
+    Following printed jobs until CUPS reports them done: the old
+    once-a-second getJobs poll against the shared tracker. Latency is how
+    long after a job finished it was noticed. CUPS round trips are
+    counted on the fake server, so they include the printer status
+    refreshes running alongside.
+    """
+    server = main.cups.get_server()
+    printer = next(iter(server.printers))
+    jobs = max(8, args.requests // 200)
+    concurrency = min(args.concurrency, jobs)
+    results = []
+
+    seconds_per_page = server.seconds_per_page
+    # Long enough that jobs wait in CUPS behind each other, as they do
+    server.seconds_per_page = 0.37
+    try:
+        for label, follow in (
+            ("getJobs poll", lambda job_id: legacy_follow(main.cups.Connection(), job_id)),
+            ("tracker", tracker_follow),
+        ):
+            lags = []
+            round_trips = server.round_trips
+
+            def one(i):
+                job_id = server.submit(printer, 1 + i % 3, f"bench-{label}-{i}", {})
+                follow(job_id)
+                lags.append(max(0.0, time.monotonic() - server.jobs[job_id]["end"]))
+
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                list(pool.map(one, range(jobs)))
+            elapsed = time.perf_counter() - start
+
+            r = summarize(label, lags, elapsed, concurrency)
+            r["round_trips_per_job"] = round((server.round_trips - round_trips) / jobs, 1)
+            print(f"{label}: {r['round_trips_per_job']} CUPS round trips per job")
+            results.append(r)
+    finally:
+        server.seconds_per_page = seconds_per_page
+
+    return results
+
+
+def wait_for_jobs(submitted, timeout=120):
+    """
+    Poll until every job in {job_id: submit time} is final. Returns
+    {job_id: (status, seconds from submit)} for those that got there.
+    """
+    done = {}
+    deadline = time.monotonic() + timeout
+
+    while len(done) < len(submitted) and time.monotonic() < deadline:
+        for job_id, submitted_at in submitted.items():
+            job = job_id not in done and main.get_job(job_id)
+            if job and job["status"] in main.JOB_FINAL_STATUSES:
+                done[job_id] = (job["status"], time.monotonic() - submitted_at)
+        time.sleep(0.01)
+
+    return done
+
+
+@scenario("cups-faults")
+def cups_faults(args):
+    """
+    Jobs submitted while the fake cupsd is down, hung (its calls overrun
+    a shortened CUPS timeout), failing a share of its calls, or has the
+    printer stopped. The fault is cleared after --fault-seconds and every
+    job must then complete: an outage should requeue jobs, never fail
+    them. Latency is submit to completed.
+    """
+    server = main.cups.get_server()
+    printer = next(iter(server.printers))
+    token = bench_login("bench-admin", "Bench-password-1", role="admin")
+    jobs = max(5, args.requests // 200)
+    documents = [make_pdf(1 + i % 3) + f"%fault {i}\n".encode() for i in range(jobs)]
+
+    faults = {
+        "cupsd down": lambda: main.cups.set_fault(down=True),
+        "cupsd hung": lambda: main.cups.set_fault(delay=1.0),
+        "cupsd flaky": lambda: main.cups.set_fault(fail_rate=0.3),
+        "printer stopped": lambda: main.cups.set_printer_state(printer, main.cups.IPP_PRINTER_STOPPED),
+    }
+
+    call_timeout = main.cups_client.timeout
+    main.cups_client.timeout = 0.25
+    results = []
+
+    try:
+        for label, inject in faults.items():
+            inject()
+            submitted = {}
+            start = time.perf_counter()
+
+            for data in documents:
+                status, body = http_request("POST", "/print", token=token, form={"copies": "1"}, files={"file": ("bench.pdf", data)})
+                if status != 200:
+                    raise RuntimeError(f"/print returned {status}: {body[:200]!r}")
+                submitted[json.loads(body)["job_id"]] = time.monotonic()
+
+            time.sleep(args.fault_seconds)
+            main.cups.set_fault()
+            main.cups.set_printer_state(printer, main.cups.IPP_PRINTER_IDLE)
+
+            done = wait_for_jobs(submitted)
+            elapsed = time.perf_counter() - start
+
+            completed = [t for status, t in done.values() if status == main.JOB_COMPLETED]
+            print(f"{label}: {len(completed)} of {len(submitted)} jobs completed")
+            if len(completed) < len(submitted):
+                raise RuntimeError(f"{label}: {len(submitted) - len(completed)} job(s) failed or never finished")
+
+            results.append(summarize(label, completed, elapsed))
+
+    finally:
+        main.cups.set_fault()
+        main.cups.set_printer_state(printer, main.cups.IPP_PRINTER_IDLE)
+        main.cups_client.timeout = call_timeout
+
+    return results
+
+
+# Runs in a fresh interpreter so nothing is already imported or cached.
+# Prints the timings of each phase as JSON on its last line.
+STARTUP_PROBE = """
+import json, time
+start = time.perf_counter()
+import main
+imported = time.perf_counter()
+main.start_app()
+started = time.perf_counter()
+main.stop_app()
+stopped = time.perf_counter()
+print(json.dumps({
+    "import": imported - start,
+    "start_app": started - imported,
+    "stop_app": stopped - started,
+}))
+"""
+
+
+def probe_startup(db_path):
+    env = dict(os.environ, PRINTER_DB_PATH=db_path)
+    result = subprocess.run(
+        [sys.executable, "-c", STARTUP_PROBE],
+        env=env, capture_output=True, text=True, check=True
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+@scenario("startup")
+def startup(args):
+    """
+    Cold start of the app in new processes: importing main, start_app()
+    and stop_app(), first against a new database each time (migrations
+    and the default admin's password hash), then against an existing one.
+    """
+    runs = max(3, min(20, args.requests // 100))
+    results = []
+
+    # Create the database the "existing db" runs start against
+    probe_startup(os.path.join(WORK_DIR, "startup.db"))
+
+    for label, fresh in (("new db", True), ("existing db", False)):
+        timings = []
+        for i in range(runs):
+            name = f"startup-{i}.db" if fresh else "startup.db"
+            timings.append(probe_startup(os.path.join(WORK_DIR, name)))
+
+        for phase in ("import", "start_app", "stop_app"):
+            results.append(summarize(
+                f"{label}: {phase}",
+                [t[phase] for t in timings],
+                sum(t[phase] for t in timings)
+            ))
+
+    return results
+
+
+def compare(baseline_path, results, tolerance):
+    """
+    Print every result whose p99 grew or whose throughput fell by more
+    than `tolerance` against a saved --json run. Returns how many did.
+    """
+    with open(baseline_path) as f:
+        baseline = json.load(f)["results"]
+
+    regressions = 0
+    for name, entries in results.items():
+        previous = {r["label"]: r for r in baseline.get(name, [])}
+        for r in entries:
+            before = previous.get(r["label"])
+            if not before:
+                continue
+            slower = r["p99_ms"] > before["p99_ms"] * (1 + tolerance)
+            fewer = r["rps"] < before["rps"] * (1 - tolerance)
+            if slower or fewer:
+                regressions += 1
+                print(
+                    f"REGRESSION {name} / {r['label']}: "
+                    f"p99 {before['p99_ms']} -> {r['p99_ms']} ms, rps {before['rps']} -> {r['rps']}"
+                )
+
+    return regressions
+
+
+def report(name, results):
+    print(f"\n== {name}")
+    print(f"{'label':<28}{'rps':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for r in results:
+        print(f"{r['label']:<28}{r['rps']:>10}{r['p50_ms']:>10}{r['p95_ms']:>10}{r['p99_ms']:>10}")
+
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("scenarios", nargs="*", help=f"any of: {', '.join(SCENARIOS)}")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--p99-ms", type=float, default=50, help="latency target for async-endpoints")
+    parser.add_argument("--tabs", type=int, default=64, help="open pages for status-polling")
+    parser.add_argument("--rows", type=int, default=1_000_000, help="print_jobs rows for admin-list")
+    parser.add_argument("--fault-seconds", type=float, default=2, help="how long cups-faults keeps each fault")
+    parser.add_argument("--compare", metavar="PATH", help="flag regressions against a saved --json run")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed p99/rps change for --compare")
+    parser.add_argument("--json", metavar="PATH", help="write results as JSON")
+    args = parser.parse_args()
+
+    names = args.scenarios or list(SCENARIOS)
+    unknown = [n for n in names if n not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenario(s): {', '.join(unknown)}")
+
+    main.start_app()
+
+    results = {}
+    for name in names:
+        # login-mixed leaves its account and this address rate limited
+        for limiter in (main.login_ip_limiter, main.login_user_limiter):
+            limiter.clear()
+
+        results[name] = SCENARIOS[name](args)
+        report(name, results[name])
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"created_at": datetime.now(timezone.utc).isoformat(), "results": results}, f, indent=2)
+
+    main.stop_app()
+
+    if args.compare and compare(args.compare, results, args.tolerance):
+        return 1
+
+
+if __name__ == "__main__":
+    try:
+        status = run()
+    finally:
+        shutil.rmtree(WORK_DIR, ignore_errors=True)
+    sys.exit(status)
@@ -0,0 +1,186 @@
+"""
+Thread-safe access to cupsd.
+
+pycups connections must not be shared between threads and their calls have
+no timeout, so every call goes to a small thread pool in which each thread
+owns its own connection. The caller waits at most `timeout` seconds; a call
+that overruns leaves its thread to finish in the background and that
+thread's connection is thrown away afterwards.
+
+Connection failures, timeouts and server errors count as transient and
+feed a circuit breaker: after `failure_threshold` in a row the client
+fails fast with CupsUnavailable for `reset_timeout` seconds, then lets a
+single probe call through. Each failed probe doubles the wait, up to
+`max_reset_timeout`, so a restarting cupsd is reconnected to with backoff
+instead of being hammered.
+
+`on_call(method, seconds, outcome)`, if given, is told how long each call
+took and whether it was "ok", "error" (the server answered with a
+non-transient error), "unavailable" or "timeout".
+"""
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+
+# IPP status codes from 0x0500 up are server errors (service unavailable,
+# internal error, ...) rather than problems with the request
+IPP_SERVER_ERROR = 0x0500
+
+
+class CupsUnavailable(Exception):
+    """cupsd couldn't be reached, timed out, or the circuit is open."""
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold=5, reset_timeout=1.0, max_reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._open_until = 0.0
+        self._current_timeout = reset_timeout
+        self._probing = False
+
+    @property
+    def is_open(self):
+        with self._lock:
+            return self._failures >= self.failure_threshold
+
+    def retry_after(self):
+        """Seconds until the next call will be let through (0 if now)."""
+        with self._lock:
+            if self._failures < self.failure_threshold:
+                return 0
+            return max(0.0, self._open_until - time.monotonic())
+
+    def allow(self):
+        with self._lock:
+            if self._failures < self.failure_threshold:
+                return True
+            if self._probing or time.monotonic() < self._open_until:
+                return False
+            # Half-open: one probe at a time
+            self._probing = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._probing = False
+            self._current_timeout = self.reset_timeout
+
+    def record_failure(self):
+        with self._lock:
+            if self._probing:
+                self._current_timeout = min(self._current_timeout * 2, self.max_reset_timeout)
+            self._probing = False
+            self._failures += 1
+            if self._failures >= self.failure_threshold:
+                self._open_until = time.monotonic() + self._current_timeout
+
+
+class CupsClient:
+    """
+    Drop-in for a cups.Connection: any method called on the client runs on
+    a pooled connection, e.g. client.getPrinters(). Calls that must share a
+    connection (createJob ... finishDocument) go through run().
+    """
+
+    def __init__(self, cups_module, workers=8, timeout=30.0, breaker=None, on_call=None):
+        self.cups = cups_module
+        self.timeout = timeout
+        self.breaker = breaker or CircuitBreaker()
+        self.on_call = on_call
+        self._local = threading.local()
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers,
+            thread_name_prefix="cups-client"
+        )
+        self._transient = (
+            self.cups.HTTPError,
+            RuntimeError,
+            OSError,
+        )
+
+    def is_transient(self, error):
+        if isinstance(error, CupsUnavailable):
+            return True
+        if isinstance(error, self.cups.IPPError):
+            status = error.args[0] if error.args else None
+            return isinstance(status, int) and status >= IPP_SERVER_ERROR
+        return isinstance(error, self._transient)
+
+    def _run(self, fn, args, kwargs, abandoned):
+        conn = getattr(self._local, "conn", None)
+
+        try:
+            if conn is None:
+                conn = self._local.conn = self.cups.Connection()
+            return fn(conn, *args, **kwargs)
+        except Exception as e:
+            if self.is_transient(e):
+                self._local.conn = None
+            raise
+        finally:
+            if abandoned.is_set():
+                # The caller gave up on us; don't trust this connection's state
+                self._local.conn = None
+
+    def call(self, method, *args, timeout=None, **kwargs):
+        def call_method(conn, *args, **kwargs):
+            return getattr(conn, method)(*args, **kwargs)
+
+        return self.run(call_method, *args, name=method, timeout=timeout, **kwargs)
+
+    def run(self, fn, *args, name=None, timeout=None, **kwargs):
+        """
+        Call fn(conn, *args, **kwargs) on a pooled connection, with the
+        same timeout and circuit breaker as a single call.
+        """
+        method = name or fn.__name__
+
+        if not self.breaker.allow():
+            raise CupsUnavailable(
+                f"CUPS unavailable, retrying in {self.breaker.retry_after():.1f}s"
+            )
+
+        abandoned = threading.Event()
+        start = time.monotonic()
+        future = self._executor.submit(self._run, fn, args, kwargs, abandoned)
+
+        try:
+            result = future.result(timeout=self.timeout if timeout is None else timeout)
+        except TimeoutError:
+            abandoned.set()
+            self.breaker.record_failure()
+            self._observe(method, start, "timeout")
+            raise CupsUnavailable(f"CUPS call {method} timed out")
+        except Exception as e:
+            if self.is_transient(e):
+                self.breaker.record_failure()
+                self._observe(method, start, "unavailable")
+                raise CupsUnavailable(f"CUPS call {method} failed: {e}") from e
+            # The server answered; the request itself was bad
+            self.breaker.record_success()
+            self._observe(method, start, "error")
+            raise
+
+        self.breaker.record_success()
+        self._observe(method, start, "ok")
+        return result
+
+    def _observe(self, method, start, outcome):
+        if self.on_call is not None:
+            self.on_call(method, time.monotonic() - start, outcome)
+
+    def __getattr__(self, method):
+        if method.startswith("_"):
+            raise AttributeError(method)
+
+        def call(*args, **kwargs):
+            return self.call(method, *args, **kwargs)
+
+        return call
@@ -0,0 +1,328 @@
+"""
+In-memory stand-in for the parts of the pycups API this server uses.
+
+Start the server with PRINTER_FAKE_CUPS=1 to run it without a cupsd, e.g.
+for offline development or benchmarking. Jobs "print" in wall-clock time
+(FAKE_CUPS_SECONDS_PER_PAGE per page and copy), one job at a time per
+printer, and move through the same IPP job states a real queue reports.
+
+set_fault() injects the failures a real cupsd produces while restarting or
+overloaded: refused connections, failing requests and slow responses.
+"""
+
+import itertools
+import os
+import random
+import re
+import threading
+import time
+
+
+IPP_JOB_PENDING = 3
+IPP_JOB_HELD = 4
+IPP_JOB_PROCESSING = 5
+IPP_JOB_STOPPED = 6
+IPP_JOB_CANCELED = 7
+IPP_JOB_ABORTED = 8
+IPP_JOB_COMPLETED = 9
+
+IPP_PRINTER_IDLE = 3
+IPP_PRINTER_PROCESSING = 4
+IPP_PRINTER_STOPPED = 5
+
+IPP_OK = 0x0000
+IPP_NOT_FOUND = 0x0406
+IPP_BAD_REQUEST = 0x0400
+
+HTTP_CONTINUE = 100
+
+CUPS_FORMAT_AUTO = "application/octet-stream"
+CUPS_FORMAT_RAW = "application/vnd.cups-raw"
+
+_TERMINAL = (IPP_JOB_CANCELED, IPP_JOB_ABORTED, IPP_JOB_COMPLETED)
+
+
+class IPPError(Exception):
+    pass
+
+
+class HTTPError(Exception):
+    pass
+
+
+def _count_pages(file_path):
+    try:
+        with open(file_path, "rb") as f:
+            data = f.read()
+    except OSError:
+        return 1
+    return _count_data_pages(data)
+
+
+def _count_data_pages(data):
+    return max(1, len(re.findall(rb"/Type\s*/Page\b", data)))
+
+
+def _parse_page_ranges(value):
+    pages = 0
+    for part in value.split(","):
+        first, _, last = part.partition("-")
+        pages += int(last or first) - int(first) + 1
+    return pages
+
+
+class FakeServer:
+    def __init__(self, printer_names, seconds_per_page):
+        self.lock = threading.Lock()
+        self.seconds_per_page = seconds_per_page
+        self.printers = {name: self._default_attrs(name) for name in printer_names}
+        self.busy_until = {name: 0.0 for name in printer_names}
+        self.jobs = {}
+        self.round_trips = 0
+        self.fault = {"down": False, "delay": 0.0, "fail_rate": 0.0}
+        self._job_ids = itertools.count(1)
+
+    @staticmethod
+    def _default_attrs(name):
+        return {
+            "printer-state": IPP_PRINTER_IDLE,
+            "printer-state-reasons": ["none"],
+            "printer-is-accepting-jobs": True,
+            "printer-uri-supported": f"ipp://localhost/printers/{name}",
+            "sides-supported": ["one-sided", "two-sided-long-edge"],
+            "color-supported": False,
+            "copies-supported": "1-999",
+        }
+
+    def _job_state(self, job, now):
+        if job["state"] in _TERMINAL or job["state"] == IPP_JOB_HELD:
+            return job["state"]
+        if now < job["start"]:
+            return IPP_JOB_PENDING
+        if now < job["end"]:
+            return IPP_JOB_PROCESSING
+        job["state"] = IPP_JOB_COMPLETED
+        return IPP_JOB_COMPLETED
+
+    def _printer_state(self, name, now):
+        if self.printers[name]["printer-state"] == IPP_PRINTER_STOPPED:
+            return IPP_PRINTER_STOPPED
+        if now < self.busy_until[name]:
+            return IPP_PRINTER_PROCESSING
+        return IPP_PRINTER_IDLE
+
+    def submit(self, printer, pages, title, options):
+        with self.lock:
+            if printer not in self.printers:
+                raise IPPError(IPP_NOT_FOUND, "The printer or class does not exist.")
+            job_id = next(self._job_ids)
+            self._schedule(job_id, printer, pages, title, options)
+            return job_id
+
+    def create(self, printer, title, options):
+        # Create-Job: held until its document arrives
+        with self.lock:
+            if printer not in self.printers:
+                raise IPPError(IPP_NOT_FOUND, "The printer or class does not exist.")
+            job_id = next(self._job_ids)
+            self.jobs[job_id] = {
+                "printer": printer,
+                "title": title,
+                "options": dict(options),
+                "start": float("inf"),
+                "end": float("inf"),
+                "state": IPP_JOB_HELD,
+            }
+            return job_id
+
+    def complete(self, job_id, pages):
+        with self.lock:
+            job = self.jobs[job_id]
+            if job["state"] != IPP_JOB_HELD:
+                return
+            self._schedule(job_id, job["printer"], pages, job["title"], job["options"])
+
+    def _schedule(self, job_id, printer, pages, title, options):
+        # Callers hold the lock
+        now = time.monotonic()
+        copies = int(options.get("copies", "1"))
+        duration = pages * copies * self.seconds_per_page
+        start = max(now, self.busy_until[printer])
+        self.busy_until[printer] = start + duration
+
+        self.jobs[job_id] = {
+            "printer": printer,
+            "title": title,
+            "options": dict(options),
+            "start": start,
+            "end": start + duration,
+            "state": IPP_JOB_PENDING,
+        }
+
+    def cancel(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if not job:
+                raise IPPError(IPP_NOT_FOUND, "Job does not exist.")
+
+            now = time.monotonic()
+            state = self._job_state(job, now)
+            if state in _TERMINAL:
+                return
+            if state == IPP_JOB_HELD:
+                job["state"] = IPP_JOB_CANCELED
+                return
+
+            # Free the rest of the job's slot on the printer
+            remaining = job["end"] - max(now, job["start"])
+            for other in self.jobs.values():
+                if other["printer"] == job["printer"] and other["start"] >= job["end"]:
+                    other["start"] -= remaining
+                    other["end"] -= remaining
+            self.busy_until[job["printer"]] -= remaining
+            job["state"] = IPP_JOB_CANCELED
+
+
+_server = FakeServer(
+    [
+        name.strip()
+        for name in os.environ.get("FAKE_CUPS_PRINTERS", "HP-LaserJet-1020").split(",")
+        if name.strip()
+    ],
+    float(os.environ.get("FAKE_CUPS_SECONDS_PER_PAGE", "0.05")),
+)
+
+
+def get_server():
+    return _server
+
+
+def set_fault(down=False, delay=0.0, fail_rate=0.0):
+    """
+    down: new connections are refused and calls on existing ones fail.
+    delay: every call stalls this many seconds first (a hung cupsd).
+    fail_rate: this fraction of calls fail with an HTTP error.
+    """
+    with _server.lock:
+        _server.fault = {"down": down, "delay": delay, "fail_rate": fail_rate}
+
+
+def set_printer_state(name, state):
+    # Fault injection: IPP_PRINTER_STOPPED takes a printer offline
+    with _server.lock:
+        _server.printers[name]["printer-state"] = state
+
+
+class Connection:
+    def __init__(self, host=None, port=None, encryption=None):
+        self._server = _server
+        self._document = None
+        if _server.fault["down"]:
+            raise RuntimeError("failed to connect to server")
+
+    def _round_trip(self):
+        with self._server.lock:
+            self._server.round_trips += 1
+            fault = self._server.fault
+            failing = fault["down"] or random.random() < fault["fail_rate"]
+
+        if fault["delay"]:
+            time.sleep(fault["delay"])
+        if failing:
+            raise HTTPError(503)
+
+    def getPrinters(self):
+        self._round_trip()
+        server = self._server
+        with server.lock:
+            now = time.monotonic()
+            printers = {}
+            for name, attrs in server.printers.items():
+                printers[name] = dict(attrs)
+                printers[name]["printer-state"] = server._printer_state(name, now)
+            return printers
+
+    def getPrinterAttributes(self, name=None, uri=None, requested_attributes=None):
+        self._round_trip()
+        server = self._server
+        with server.lock:
+            if name not in server.printers:
+                raise IPPError(IPP_NOT_FOUND, "The printer or class does not exist.")
+            attrs = dict(server.printers[name])
+            attrs["printer-state"] = server._printer_state(name, time.monotonic())
+            return attrs
+
+    def printFile(self, printer, filename, title, options):
+        self._round_trip()
+        if "page-ranges" in options:
+            pages = _parse_page_ranges(options["page-ranges"])
+        else:
+            pages = _count_pages(filename)
+        return self._server.submit(printer, pages, title, options)
+
+    def createJob(self, printer, title, options):
+        self._round_trip()
+        return self._server.create(printer, title, options)
+
+    def startDocument(self, printer, job_id, doc_name, format, last_document):
+        self._round_trip()
+        self._document = {"job_id": job_id, "data": bytearray()}
+        return HTTP_CONTINUE
+
+    def writeRequestData(self, buffer, length):
+        self._document["data"] += buffer[:length]
+        return HTTP_CONTINUE
+
+    def finishDocument(self, printer):
+        self._round_trip()
+        document, self._document = self._document, None
+        if document is None:
+            raise IPPError(IPP_BAD_REQUEST, "No document in progress.")
+
+        options = self._server.jobs[document["job_id"]]["options"]
+        if "page-ranges" in options:
+            pages = _parse_page_ranges(options["page-ranges"])
+        else:
+            pages = _count_data_pages(bytes(document["data"]))
+        self._server.complete(document["job_id"], pages)
+        return IPP_OK
+
+    def getJobs(self, which_jobs="not-completed", my_jobs=False, limit=-1,
+                first_job_id=-1, requested_attributes=None):
+        self._round_trip()
+        server = self._server
+        with server.lock:
+            now = time.monotonic()
+            result = {}
+            for job_id, job in server.jobs.items():
+                if job_id < first_job_id:
+                    continue
+                state = server._job_state(job, now)
+                if which_jobs == "not-completed" and state in _TERMINAL:
+                    continue
+                if which_jobs == "completed" and state not in _TERMINAL:
+                    continue
+                result[job_id] = {
+                    "job-state": state,
+                    "job-name": job["title"],
+                    "job-printer-uri": server.printers[job["printer"]]["printer-uri-supported"],
+                }
+            return result
+
+    def getJobAttributes(self, job_id, requested_attributes=None):
+        self._round_trip()
+        server = self._server
+        with server.lock:
+            job = server.jobs.get(job_id)
+            if not job:
+                raise IPPError(IPP_NOT_FOUND, "Job does not exist.")
+            return {
+                "job-id": job_id,
+                "job-state": server._job_state(job, time.monotonic()),
+                "job-name": job["title"],
+                "job-printer-uri": server.printers[job["printer"]]["printer-uri-supported"],
+            }
+
+    def cancelJob(self, job_id, purge_job=False):
+        self._round_trip()
+        self._server.cancel(job_id)
@@ -0,0 +1,64 @@
+"""
+Publish/subscribe hub for job status changes.
+
+Printer workers and request handlers publish from any thread; subscribers
+are asyncio queues owned by the event loop serving a Server-Sent Events
+response. Each event is delivered under one or more topic keys, e.g.
+("job", 42), ("user", 7) or ("all",).
+"""
+
+import asyncio
+import threading
+
+
+class JobEventHub:
+    def __init__(self, max_pending=100):
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        self._subscribers = {}
+
+    def subscribe(self, key):
+        """
+        Register a queue for `key` on the running event loop. Must be
+        called from a coroutine; pair it with unsubscribe().
+        """
+        subscriber = (asyncio.get_running_loop(), asyncio.Queue(self.max_pending))
+
+        with self._lock:
+            self._subscribers.setdefault(key, set()).add(subscriber)
+
+        return subscriber
+
+    def unsubscribe(self, key, subscriber):
+        with self._lock:
+            subscribers = self._subscribers.get(key)
+            if subscribers:
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    del self._subscribers[key]
+
+    def subscriber_count(self):
+        with self._lock:
+            return sum(len(s) for s in self._subscribers.values())
+
+    def publish(self, event, keys):
+        with self._lock:
+            targets = [
+                subscriber
+                for key in keys
+                for subscriber in self._subscribers.get(key, ())
+            ]
+
+        for loop, queue in targets:
+            try:
+                loop.call_soon_threadsafe(_deliver, queue, event)
+            except RuntimeError:
+                # The subscriber's loop has shut down
+                pass
+
+
+def _deliver(queue, event):
+    # A client that stopped reading loses its oldest events, not new ones
+    if queue.full():
+        queue.get_nowait()
+    queue.put_nowait(event)
@@ -0,0 +1,134 @@
+"""
+Follows submitted CUPS jobs until they reach a terminal state.
+
+One tracker serves every print worker on a CUPS connection. Workers block
+in wait() while a single poller thread asks cupsd about all of their jobs
+at once, one Get-Jobs request per tick, and hands each worker its job's
+state. The poll backs off while nothing changes: quickly right after a
+job moves, then less and less often while every job sits where it is.
+"""
+
+import threading
+import time
+
+
+IPP_JOB_PENDING = 3
+IPP_JOB_HELD = 4
+IPP_JOB_PROCESSING = 5
+IPP_JOB_CANCELED = 7
+IPP_JOB_ABORTED = 8
+IPP_JOB_COMPLETED = 9
+
+TERMINAL_STATES = (IPP_JOB_CANCELED, IPP_JOB_ABORTED, IPP_JOB_COMPLETED)
+
+
+class CupsJobTracker:
+    def __init__(self, conn, min_interval=0.1, max_interval=2.0, backoff=2.0):
+        self.conn = conn
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self._cond = threading.Condition()
+        self._states = {}
+        self._errors = {}
+        self._poller = None
+
+    def wake(self):
+        # Have waiters re-check should_stop(), e.g. after a cancel request
+        with self._cond:
+            self._cond.notify_all()
+
+    def wait(self, cups_job_id, should_stop):
+        """
+        Block until the job is canceled, aborted or completed and return
+        that IPP job state, or return None as soon as should_stop() is true.
+        Raises CupsUnavailable if cupsd can't be asked.
+        """
+        with self._cond:
+            self._states[cups_job_id] = None
+            self._errors.pop(cups_job_id, None)
+            if self._poller is None:
+                self._poller = threading.Thread(target=self._poll_loop, daemon=True)
+                self._poller.start()
+
+        try:
+            while True:
+                with self._cond:
+                    error = self._errors.pop(cups_job_id, None)
+                    state = self._states[cups_job_id]
+
+                    if error is None and state not in TERMINAL_STATES:
+                        self._cond.wait(self.max_interval)
+                        error = self._errors.pop(cups_job_id, None)
+                        state = self._states[cups_job_id]
+
+                if error is not None:
+                    raise error
+                if state in TERMINAL_STATES:
+                    return state
+                if should_stop():
+                    return None
+
+        finally:
+            with self._cond:
+                self._states.pop(cups_job_id, None)
+                self._errors.pop(cups_job_id, None)
+
+    def _poll_loop(self):
+        interval = self.min_interval
+
+        while True:
+            with self._cond:
+                waiting = list(self._states)
+                if not waiting:
+                    self._poller = None
+                    return
+
+            try:
+                states = self._job_states(min(waiting))
+            except Exception as e:
+                # Every waiter gets the error (CupsUnavailable sends them to
+                # wait for cupsd); the next wait() starts a new poller
+                with self._cond:
+                    for cups_job_id in self._states:
+                        self._errors[cups_job_id] = e
+                    self._poller = None
+                    self._cond.notify_all()
+                return
+
+            changed = updated = False
+            with self._cond:
+                for cups_job_id in waiting:
+                    if cups_job_id not in self._states:
+                        continue
+
+                    state = states.get(cups_job_id)
+                    if state is None:
+                        self._errors[cups_job_id] = LookupError(
+                            f"CUPS job {cups_job_id} no longer exists"
+                        )
+                        changed = updated = True
+                    elif state != self._states[cups_job_id]:
+                        # Seeing a new job for the first time isn't a change
+                        changed = changed or self._states[cups_job_id] is not None
+                        self._states[cups_job_id] = state
+                        updated = True
+
+                if updated:
+                    self._cond.notify_all()
+
+            if changed:
+                interval = self.min_interval
+            else:
+                interval = min(interval * self.backoff, self.max_interval)
+
+            time.sleep(interval)
+
+    def _job_states(self, first_job_id):
+        # Job ids only grow, so this covers every job being waited on
+        jobs = self.conn.getJobs(
+            which_jobs="all",
+            first_job_id=first_job_id,
+            requested_attributes=["job-id", "job-state"]
+        )
+        return {job_id: attrs["job-state"] for job_id, attrs in jobs.items()}
@@ -1,62 +1,513 @@
-from typing import Dict
-from fastapi import FastAPI, UploadFile, File, Header, HTTPException, Depends, Form, status
-from queue import Queue
+from typing import Dict, Optional
+from fastapi import FastAPI, Header, HTTPException, Depends, Form, Query, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from datetime import datetime, timedelta, timezone
 
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, JSONResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from fastapi import Request
 
-from PyPDF2 import PdfReader
-
-import shutil
 import os
+import asyncio
+import hashlib
+import json
 import time
 import threading
 import sqlite3
 import bcrypt
 import re
 import uuid
-import cups
-
-
-print_queue = Queue()
-
-cups_conn = cups.Connection()
-PRINTER_NAME = "HP-LaserJet-1020"
-
-UPLOAD_DIR = "uploads"
+import secrets
+import socket
+import math
+import mmap
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+if os.environ.get("PRINTER_FAKE_CUPS") == "1":
+    import fake_cups as cups
+else:
+    import cups
+
+import metrics
+import pdf_inspect
+from python_multipart.multipart import MultipartParser, parse_options_header
+from cups_client import CircuitBreaker, CupsClient, CupsUnavailable
+from job_events import JobEventHub
+from scheduler import FairQueue
+from rate_limit import RateLimiter
+from render_cache import RenderCache
+from job_tracker import (
+    CupsJobTracker,
+    IPP_JOB_ABORTED,
+    IPP_JOB_CANCELED,
+    IPP_JOB_COMPLETED,
+    IPP_JOB_HELD,
+    TERMINAL_STATES,
+)
+
+
+# Adaptive backoff bounds (seconds) for the one Get-Jobs poll that follows
+# every printing job in CUPS
+CUPS_POLL_MIN_INTERVAL = float(os.environ.get("CUPS_POLL_MIN_INTERVAL", "0.1"))
+CUPS_POLL_MAX_INTERVAL = float(os.environ.get("CUPS_POLL_MAX_INTERVAL", "2"))
+
+# How long a worker waits before re-checking its printer when it is offline
+# and no other printer can take the job
+PRINTER_OFFLINE_RETRY = float(os.environ.get("PRINTER_OFFLINE_RETRY", "5"))
+
+# Prometheus-style metrics, served at GET /metrics. If METRICS_TOKEN is set
+# scrapers must send it as a bearer token.
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+
+# Job waits and print times run from seconds to hours
+JOB_DURATION_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600, 7200, 21600)
+
+metrics_registry = metrics.Registry()
+
+http_request_seconds = metrics_registry.histogram(
+    "printer_http_request_duration_seconds",
+    "HTTP request latency by route template",
+    ("method", "route")
+)
+http_requests = metrics_registry.counter(
+    "printer_http_requests_total",
+    "HTTP requests by route template and response status",
+    ("method", "route", "status")
+)
+cups_call_seconds = metrics_registry.histogram(
+    "printer_cups_call_duration_seconds",
+    "cupsd call latency by pycups method and outcome",
+    ("method", "outcome")
+)
+page_count_seconds = metrics_registry.histogram(
+    "printer_page_count_duration_seconds",
+    "Time to count an upload's pages by outcome",
+    ("outcome",)
+)
+storage_wait_seconds = metrics_registry.histogram(
+    "printer_storage_wait_seconds",
+    "Time async endpoints wait for a free storage thread (and its SQLite connection)"
+)
+storage_call_seconds = metrics_registry.histogram(
+    "printer_storage_call_duration_seconds",
+    "Time spent in storage calls by function",
+    ("function",)
+)
+db_write_wait_seconds = metrics_registry.histogram(
+    "printer_db_write_wait_seconds",
+    "Time spent waiting for the SQLite write lock"
+)
+password_wait_seconds = metrics_registry.histogram(
+    "printer_password_hash_wait_seconds",
+    "Time password work waits for a bcrypt thread"
+)
+password_hash_seconds = metrics_registry.histogram(
+    "printer_password_hash_duration_seconds",
+    "bcrypt time by operation",
+    ("operation",)
+)
+job_wait_seconds = metrics_registry.histogram(
+    "printer_job_wait_seconds",
+    "Time from submission until a job starts printing",
+    buckets=JOB_DURATION_BUCKETS
+)
+job_print_seconds = metrics_registry.histogram(
+    "printer_job_print_duration_seconds",
+    "Time from a job starting to print until it is final, by final status",
+    ("status",),
+    buckets=JOB_DURATION_BUCKETS
+)
+render_seconds = metrics_registry.histogram(
+    "printer_render_duration_seconds",
+    "Time to pre-render a document for a host-based printer, by outcome",
+    ("outcome",),
+    buckets=JOB_DURATION_BUCKETS
+)
+render_lookups = metrics_registry.counter(
+    "printer_render_cache_lookups_total",
+    "Print-ready render lookups by whether a rendered file was used",
+    ("result",)
+)
+jobs_finished = metrics_registry.counter(
+    "printer_jobs_finished_total",
+    "Jobs reaching a final status",
+    ("status",)
+)
+
+def observe_cups_call(method, seconds, outcome):
+    cups_call_seconds.observe(seconds, method, outcome)
+
+# Every cupsd call goes through cups_client: pooled per-thread connections,
+# a timeout per call and a circuit breaker that fails fast while cupsd is
+# down. Jobs that hit a CUPS outage before reaching CUPS are requeued.
+CUPS_CALL_TIMEOUT = float(os.environ.get("CUPS_CALL_TIMEOUT", "30"))
+CUPS_CLIENT_WORKERS = int(os.environ.get("CUPS_CLIENT_WORKERS", "8"))
+CUPS_FAILURE_THRESHOLD = int(os.environ.get("CUPS_FAILURE_THRESHOLD", "3"))
+CUPS_RESET_TIMEOUT = float(os.environ.get("CUPS_RESET_TIMEOUT", "1"))
+CUPS_MAX_RESET_TIMEOUT = float(os.environ.get("CUPS_MAX_RESET_TIMEOUT", "30"))
+
+# How documents reach cupsd: "stream" sends them over one connection as
+# Create-Job plus Send-Document, CUPS_STREAM_CHUNK_SIZE bytes at a time
+# from a memory map of the stored file; "file" hands the path to printFile.
+CUPS_SUBMIT_MODE = os.environ.get("CUPS_SUBMIT_MODE", "stream")
+CUPS_STREAM_CHUNK_SIZE = int(os.environ.get("CUPS_STREAM_CHUNK_SIZE", str(64 * 1024)))
+
+cups_client = CupsClient(
+    cups,
+    workers=CUPS_CLIENT_WORKERS,
+    timeout=CUPS_CALL_TIMEOUT,
+    breaker=CircuitBreaker(
+        failure_threshold=CUPS_FAILURE_THRESHOLD,
+        reset_timeout=CUPS_RESET_TIMEOUT,
+        max_reset_timeout=CUPS_MAX_RESET_TIMEOUT
+    ),
+    on_call=observe_cups_call
+)
+
+cups_job_tracker = CupsJobTracker(
+    cups_client,
+    min_interval=CUPS_POLL_MIN_INTERVAL,
+    max_interval=CUPS_POLL_MAX_INTERVAL
+)
+
+# Printer registry: one queue and worker thread per device
+printers_lock = threading.Lock()
+printers: Dict[str, dict] = {}
+printer_queues: Dict[str, FairQueue] = {}
+printer_threads: Dict[str, threading.Thread] = {}
+
+# Observed seconds per paper, persisted in the printers table so API-only
+# processes (which re-read it every PRINTER_STATUS_REFRESH_INTERVAL) and
+# restarts see it too
+printer_speeds: Dict[str, float] = {}
+printer_speeds_loaded_at = 0.0
+
+# /printer/status and /printer/capabilities are served from a snapshot of
+# the registry. A background thread refreshes printer states from CUPS every
+# PRINTER_STATUS_REFRESH_INTERVAL seconds, or sooner when a worker sees a
+# job start or finish. If no refresh has succeeded for
+# PRINTER_STATUS_STALE_AFTER seconds (cupsd down or hung) the snapshot is
+# still served, marked stale.
+PRINTER_STATUS_REFRESH_INTERVAL = float(os.environ.get("PRINTER_STATUS_REFRESH_INTERVAL", "2"))
+PRINTER_STATUS_STALE_AFTER = float(os.environ.get("PRINTER_STATUS_STALE_AFTER", "30"))
+
+printer_snapshot = {"refreshed_at": 0.0, "status": None, "capabilities": None}
+printer_refresh_requested = threading.Event()
+
+# Set while cupsd couldn't be reached at startup; the status worker
+# retries discovery until it can
+printer_discovery_pending = threading.Event()
+
+# Set by stop_app(); background threads return once they see it
+shutdown_requested = threading.Event()
+
+UPLOAD_DIR = os.environ.get("PRINTER_UPLOAD_DIR", "uploads")
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 
+# Content-addressed store for uploaded PDFs: uploads/blobs/<ab>/<sha256>.pdf
+BLOB_DIR = os.path.join(UPLOAD_DIR, "blobs")
+os.makedirs(BLOB_DIR, exist_ok=True)
+
+# Unreferenced blobs are kept this long after last use so repeat prints hit.
+# With 0 (small disks) a blob is deleted as soon as CUPS has accepted the
+# last of the jobs using it.
+BLOB_RETENTION_SECONDS = float(os.environ.get("BLOB_RETENTION_SECONDS", str(7 * 24 * 3600)))
+BLOB_GC_INTERVAL = float(os.environ.get("BLOB_GC_INTERVAL", "3600"))
+
+# The garbage collector never takes a blob younger than this, whatever
+# BLOB_RETENTION_SECONDS says: a blob is stored a moment before the job
+# row that refers to it is written, and must survive that gap
+BLOB_GC_GRACE_SECONDS = float(os.environ.get("BLOB_GC_GRACE_SECONDS", "600"))
+
+# Full PDF parses (when the fast page count can't be read) run in a small
+# process pool and are abandoned after PDF_PARSE_TIMEOUT seconds
+PDF_PARSE_WORKERS = int(os.environ.get("PDF_PARSE_WORKERS", "2"))
+PDF_PARSE_TIMEOUT = float(os.environ.get("PDF_PARSE_TIMEOUT", "10"))
+
+pdf_parse_pool = pdf_inspect.FallbackPool(PDF_PARSE_WORKERS, PDF_PARSE_TIMEOUT)
+
+# Host-based printers listed in RENDER_PRINTERS (ones without a PDF
+# interpreter, like the LaserJet 1020) get queued jobs converted to device
+# data with cupsfilter ahead of time, RENDER_WORKERS at once, and the
+# worker sends the rendered file raw. Renders are cached under
+# uploads/rendered up to RENDER_CACHE_MAX_BYTES.
+RENDER_PRINTERS = {
+    name.strip()
+    for name in os.environ.get("RENDER_PRINTERS", "").split(",")
+    if name.strip()
+}
+RENDER_WORKERS = int(os.environ.get("RENDER_WORKERS", "1"))
+RENDER_TIMEOUT = float(os.environ.get("RENDER_TIMEOUT", "300"))
+RENDER_CACHE_MAX_BYTES = int(os.environ.get("RENDER_CACHE_MAX_BYTES", str(2 * 1024 ** 3)))
+
+def observe_render(seconds, outcome):
+    render_seconds.observe(seconds, outcome)
+
+render_cache = RenderCache(
+    os.path.join(UPLOAD_DIR, "rendered"),
+    command=os.environ.get("CUPSFILTER", "cupsfilter"),
+    ppd_dir=os.environ.get("CUPS_PPD_DIR", "/etc/cups/ppd"),
+    workers=RENDER_WORKERS,
+    timeout=RENDER_TIMEOUT,
+    max_bytes=RENDER_CACHE_MAX_BYTES,
+    on_render=observe_render
+)
+
+MAX_UPLOAD_BYTES = int(os.environ.get("MAX_UPLOAD_BYTES", str(50 * 1024 * 1024)))
+
+# Room for the multipart boundaries, part headers and option fields on
+# top of the file itself, when checking Content-Length
+MAX_FORM_OVERHEAD_BYTES = 64 * 1024
+MAX_FORM_FIELD_BYTES = 1024
+
 JOB_QUEUED = "queued"
 JOB_PRINTING = "printing"
 JOB_COMPLETED = "completed"
 JOB_FAILED = "failed"
 JOB_CANCELLED = "cancelled"
 
-
-DB_PATH = "printer.db"
+JOB_FINAL_STATUSES = (JOB_COMPLETED, JOB_FAILED, JOB_CANCELLED)
+
+# The statuses a job may move to from each status. A write that doesn't
+# follow one of these (say, a late worker update to a job that was
+# already cancelled) is dropped.
+JOB_TRANSITIONS = {
+    JOB_QUEUED: (JOB_PRINTING, JOB_CANCELLED, JOB_FAILED),
+    JOB_PRINTING: (JOB_QUEUED, JOB_COMPLETED, JOB_FAILED, JOB_CANCELLED),
+}
+
+# Jobs longer than this many pages (all copies together) are sent to CUPS
+# in page-range chunks of this size, one copy at a time, and go back into
+# the scheduler between chunks. 0 sends every job whole.
+PRINT_CHUNK_PAGES = int(os.environ.get("PRINT_CHUNK_PAGES", "50"))
+
+# Printing speed assumed for a printer until it has printed something;
+# after that, queue estimates use its observed seconds per paper, smoothed
+# over recent jobs by PRINTER_SPEED_SMOOTHING (0..1, higher = faster to
+# follow changes)
+ESTIMATED_SECONDS_PER_PAPER = float(os.environ.get("ESTIMATED_SECONDS_PER_PAPER", "4"))
+PRINTER_SPEED_SMOOTHING = float(os.environ.get("PRINTER_SPEED_SMOOTHING", "0.2"))
+
+# Admission control for /print. A submit gets a 429, with a Retry-After
+# of how long the backlog is expected to take to drain enough, when the
+# user already has MAX_USER_ACTIVE_JOBS jobs queued or printing, or the
+# backlog across all printers is at MAX_BACKLOG_JOBS jobs or would go
+# past MAX_BACKLOG_PAPERS papers. 0 turns a limit off; admins are exempt.
+# Concurrent submits can overshoot a limit by a few jobs.
+MAX_USER_ACTIVE_JOBS = int(os.environ.get("MAX_USER_ACTIVE_JOBS", "5"))
+MAX_BACKLOG_JOBS = int(os.environ.get("MAX_BACKLOG_JOBS", "0"))
+MAX_BACKLOG_PAPERS = int(os.environ.get("MAX_BACKLOG_PAPERS", "2000"))
+
+# Idle Server-Sent Events streams send a comment this often (seconds) so
+# proxies don't drop them
+SSE_KEEPALIVE_INTERVAL = 15
+
+# What this process runs:
+#   all    - the API and the printer workers (default; a single process)
+#   api    - the API only. Jobs are left queued in SQLite for a printer
+#            daemon, so any number of these can run, e.g. under
+#            uvicorn --workers N.
+#   daemon - the printer workers only; see printer_daemon.py
+PRINTER_ROLE = os.environ.get("PRINTER_ROLE", "all")
+
+if PRINTER_ROLE not in ("all", "api", "daemon"):
+    raise RuntimeError(f"Unknown PRINTER_ROLE {PRINTER_ROLE!r}")
+
+# print_jobs doubles as the queue between processes. A process running
+# printer workers claims queued and printing jobs for itself and renews the
+# claim every JOB_CLAIM_INTERVAL; a job whose claim hasn't been renewed for
+# JOB_LEASE_SECONDS (its daemon died) is taken over by another daemon and
+# reconciled with CUPS. An "all" process is the only one printing, so it
+# takes every job over when it starts. A daemon restarted with the same
+# (unique, stable) PRINTER_DAEMON_ID takes its own jobs back at once
+# instead of waiting for their leases to run out.
+PRINTER_DAEMON_ID = os.environ.get("PRINTER_DAEMON_ID", f"{socket.gethostname()}:{os.getpid()}")
+JOB_LEASE_SECONDS = float(os.environ.get("JOB_LEASE_SECONDS", "30"))
+JOB_CLAIM_INTERVAL = float(os.environ.get("JOB_CLAIM_INTERVAL", "1"))
+
+# API-only processes don't see status changes happen, so they read them
+# back from SQLite this often (seconds) for the event streams
+JOB_EVENT_POLL_INTERVAL = float(os.environ.get("JOB_EVENT_POLL_INTERVAL", "1"))
+
+
+# What the app brings up when it starts (from its lifespan, or
+# start_app() in scripts), rather than at import:
+#   db       migrations, the default admin account, session and upload
+#            cleanup
+#   cups     printer discovery and status refresh
+#   workers  print workers and job claiming; with PRINTER_ROLE=api,
+#            following the printer daemons' job updates instead
+PRINTER_SUBSYSTEMS = {
+    name.strip()
+    for name in os.environ.get("PRINTER_SUBSYSTEMS", "db,cups,workers").split(",")
+    if name.strip()
+}
+
+# On shutdown printer workers stop taking jobs, and jobs already sent to
+# CUPS get this many seconds to finish. Whatever is left is handed back
+# in the database for the next start or another printer daemon.
+SHUTDOWN_DRAIN_TIMEOUT = float(os.environ.get("SHUTDOWN_DRAIN_TIMEOUT", "30"))
+
+DB_PATH = os.environ.get("PRINTER_DB_PATH", "printer.db")
+DB_SYNCHRONOUS = os.environ.get("DB_SYNCHRONOUS", "NORMAL")
+DB_BUSY_TIMEOUT_MS = int(os.environ.get("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_STATEMENT_CACHE_SIZE = int(os.environ.get("DB_STATEMENT_CACHE_SIZE", "256"))
 MONTHLY_PAPER_QUOTA = 10
 
+# Statuses whose papers count against the monthly quota
+QUOTA_CHARGED_STATUSES = ("queued", "printing", "completed")
+
+# How long /quota may serve a cached ledger value (seconds); enforcement
+# always goes through the ledger row itself
+QUOTA_CACHE_TTL = float(os.environ.get("QUOTA_CACHE_TTL", "30"))
+
+JOBS_PAGE_SIZE = 50
+JOBS_MAX_PAGE_SIZE = 500
+
 IST = timezone(timedelta(hours=5, minutes=30))
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app):
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, start_app)
+    yield
+    await loop.run_in_executor(None, stop_app)
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(metrics.RequestMetrics, duration=http_request_seconds, requests=http_requests)
 app.mount("/static", StaticFiles(directory="static"), name="static")
 templates = Jinja2Templates(directory="templates")
 
 
+# jobs holds queued and printing jobs; once a job is final it moves to the
+# finished_jobs LRU, which also caches final jobs read back from SQLite for
+# /job/{id}. jobs_lock only guards these dicts. Status changes go through
+# transition_job() under transition_lock: written to the database first,
+# then applied here, so the cache never shows a status SQLite refused.
+FINISHED_JOB_CACHE_SIZE = int(os.environ.get("FINISHED_JOB_CACHE_SIZE", "10000"))
+
 jobs_lock = threading.Lock()
+transition_lock = threading.Lock()
 jobs: Dict[int, dict] = {}
+finished_jobs: "OrderedDict[int, dict]" = OrderedDict()
 
-tokens = {}
 security = HTTPBearer()
 
+# Sessions expire after SESSION_TTL seconds without use. The expiry is
+# pushed forward in the database at most every SESSION_REFRESH_INTERVAL,
+# and a cached session is trusted for SESSION_CACHE_TTL before it is
+# re-read (which is also how long a logout elsewhere can take to apply).
+SESSION_TTL = float(os.environ.get("SESSION_TTL", str(12 * 3600)))
+SESSION_REFRESH_INTERVAL = float(os.environ.get("SESSION_REFRESH_INTERVAL", "300"))
+SESSION_CACHE_TTL = float(os.environ.get("SESSION_CACHE_TTL", "60"))
+SESSION_CACHE_SIZE = int(os.environ.get("SESSION_CACHE_SIZE", "10000"))
+SESSION_EVICT_INTERVAL = float(os.environ.get("SESSION_EVICT_INTERVAL", "600"))
+
+# EventSource can't send an Authorization header, so the browser trades its
+# session token for a stream ticket and puts that in the URL instead. A
+# ticket only opens event streams, is checked against its session when a
+# stream opens, and expires after STREAM_TICKET_TTL seconds; until then it
+# can be reused, so EventSource's own reconnects keep working.
+STREAM_TICKET_TTL = float(os.environ.get("STREAM_TICKET_TTL", "60"))
+
+sessions_lock = threading.Lock()
+session_cache: "OrderedDict[str, dict]" = OrderedDict()
+
+# bcrypt runs on its own small pool so a burst of logins can't take every
+# request thread; past PASSWORD_HASH_MAX_PENDING waiting hashes, logins get
+# a 503 instead of queueing. Stored hashes with a different cost are
+# rehashed on the next successful login.
+BCRYPT_ROUNDS = int(os.environ.get("BCRYPT_ROUNDS", "12"))
+PASSWORD_HASH_WORKERS = int(os.environ.get("PASSWORD_HASH_WORKERS", "2"))
+PASSWORD_HASH_MAX_PENDING = int(os.environ.get("PASSWORD_HASH_MAX_PENDING", "64"))
+
+password_executor = ThreadPoolExecutor(
+    max_workers=PASSWORD_HASH_WORKERS,
+    thread_name_prefix="password-hash"
+)
+password_slots = threading.BoundedSemaphore(PASSWORD_HASH_MAX_PENDING)
+
+# Login attempts per client address, and failed attempts per username.
+# A whole lab can share one address, so the per-address limit is loose.
+login_ip_limiter = RateLimiter(
+    rate=float(os.environ.get("LOGIN_IP_PER_MINUTE", "60")) / 60,
+    burst=int(os.environ.get("LOGIN_IP_BURST", "60"))
+)
+login_user_limiter = RateLimiter(
+    rate=float(os.environ.get("LOGIN_USER_PER_MINUTE", "5")) / 60,
+    burst=int(os.environ.get("LOGIN_USER_BURST", "5"))
+)
+
+job_event_hub = JobEventHub()
+
+blob_stats_lock = threading.Lock()
+blob_stats = {"lookups": 0, "hits": 0}
+
+quota_lock = threading.Lock()
+quota_cache: Dict[tuple, tuple] = {}
+
+# One SQLite connection per thread (storage pool, printer workers),
+# opened on first use and kept for the life of the thread
+db_local = threading.local()
+
+# Async endpoints run their SQLite queries and upload file writes on this
+# pool rather than Starlette's shared threadpool, which sync endpoints and
+# dependencies also draw on. Cached sessions and jobs are answered on the
+# event loop without a thread hop at all.
+STORAGE_WORKERS = int(os.environ.get("STORAGE_WORKERS", "16"))
+
+storage_executor = ThreadPoolExecutor(
+    max_workers=STORAGE_WORKERS,
+    thread_name_prefix="storage"
+)
+
+async def run_storage(fn, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    submitted = time.perf_counter()
+
+    def call():
+        started = time.perf_counter()
+        storage_wait_seconds.observe(started - submitted)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            storage_call_seconds.observe(time.perf_counter() - started, fn.__name__)
+
+    return await loop.run_in_executor(storage_executor, call)
+
+def begin_write(cursor):
+    # Take the write lock now rather than on the first write, timing how
+    # long other writers (in any process) keep us waiting for it
+    with db_write_wait_seconds.time():
+        cursor.execute("BEGIN IMMEDIATE")
+
+def get_db():
+    conn = getattr(db_local, "conn", None)
+
+    if conn is None:
+        conn = sqlite3.connect(DB_PATH, cached_statements=DB_STATEMENT_CACHE_SIZE)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(f"PRAGMA synchronous={DB_SYNCHRONOUS}")
+        conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+        db_local.conn = conn
+
+    elif conn.in_transaction:
+        # A previous caller on this thread raised before committing;
+        # don't keep holding its write lock
+        conn.rollback()
+
+    return conn
+
 def init_db():
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     cursor = conn.cursor()
 
+    # Processes starting together run their migrations one at a time
+    begin_write(cursor)
+
     cursor.execute("""
     CREATE TABLE IF NOT EXISTS print_jobs (
         job_id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -80,297 +531,2347 @@ def init_db():
     )
     """)
 
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS sessions (
+        token_hash TEXT PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        created_at TEXT NOT NULL,
+        expires_at REAL NOT NULL
+    )
+    """)
+
+    cursor.execute("""
+    CREATE INDEX IF NOT EXISTS idx_sessions_expires
+    ON sessions (expires_at)
+    """)
+
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS stream_tickets (
+        ticket_hash TEXT PRIMARY KEY,
+        token_hash TEXT NOT NULL,
+        expires_at REAL NOT NULL
+    )
+    """)
+
+    cursor.execute("""
+    CREATE INDEX IF NOT EXISTS idx_stream_tickets_expires
+    ON stream_tickets (expires_at)
+    """)
+
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS quota_usage (
+        user_id INTEGER NOT NULL,
+        month_key TEXT NOT NULL,
+        papers INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, month_key)
+    )
+    """)
+
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS blobs (
+        sha256 TEXT PRIMARY KEY,
+        path TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        pages INTEGER NOT NULL,
+        metadata TEXT NOT NULL DEFAULT '{}',
+        created_at TEXT NOT NULL,
+        last_used_at REAL NOT NULL
+    )
+    """)
+
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS printers (
+        name TEXT PRIMARY KEY,
+        enabled INTEGER NOT NULL DEFAULT 1,
+        duplex INTEGER NOT NULL DEFAULT 0,
+        color INTEGER NOT NULL DEFAULT 0,
+        max_copies INTEGER NOT NULL DEFAULT 1,
+        last_seen TEXT
+    )
+    """)
+
+    add_column_if_missing(cursor, "print_jobs", "printer_name", "TEXT")
+    add_column_if_missing(cursor, "print_jobs", "file_sha256", "TEXT")
+    add_column_if_missing(cursor, "print_jobs", "priority", "INTEGER NOT NULL DEFAULT 0")
+    add_column_if_missing(cursor, "print_jobs", "pages", "INTEGER")
+    add_column_if_missing(cursor, "print_jobs", "pages_total", "INTEGER")
+    add_column_if_missing(cursor, "print_jobs", "pages_printed", "INTEGER NOT NULL DEFAULT 0")
+    add_column_if_missing(cursor, "print_jobs", "copies", "INTEGER NOT NULL DEFAULT 1")
+    add_column_if_missing(cursor, "print_jobs", "color_mode", "TEXT NOT NULL DEFAULT 'bw'")
+    add_column_if_missing(cursor, "print_jobs", "sides", "TEXT NOT NULL DEFAULT 'one-sided'")
+    add_column_if_missing(cursor, "print_jobs", "cups_job_id", "INTEGER")
+    add_column_if_missing(cursor, "print_jobs", "claimed_by", "TEXT")
+    add_column_if_missing(cursor, "print_jobs", "lease_expires", "REAL")
+    add_column_if_missing(cursor, "print_jobs", "started_at", "TEXT")
+    add_column_if_missing(cursor, "print_jobs", "finished_at", "TEXT")
+    add_column_if_missing(cursor, "printers", "seconds_per_paper", "REAL")
+
+    if add_column_if_missing(cursor, "print_jobs", "quota_month", "TEXT"):
+        backfill_quota_ledger(cursor)
+
+    # Quota sums filter on user + month; job lists page through job_id
+    cursor.execute("""
+    CREATE INDEX IF NOT EXISTS idx_print_jobs_user_created
+    ON print_jobs (user_id, created_at)
+    """)
+
+    cursor.execute("""
+    CREATE INDEX IF NOT EXISTS idx_print_jobs_user_job
+    ON print_jobs (user_id, job_id)
+    """)
+
+    cursor.execute("""
+    CREATE INDEX IF NOT EXISTS idx_print_jobs_status
+    ON print_jobs (status)
+    """)
+
+    # Blob reference counts look jobs up by their stored path
+    cursor.execute("""
+    CREATE INDEX IF NOT EXISTS idx_print_jobs_file_path
+    ON print_jobs (file_path)
+    """)
 
     conn.commit()
-    conn.close()
 
-def load_pending_jobs():
-    conn = sqlite3.connect(DB_PATH)
+def add_column_if_missing(cursor, table, column, definition):
+    cursor.execute(f"PRAGMA table_info({table})")
+    if column in [r[1] for r in cursor.fetchall()]:
+        return False
+
+    cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+    return True
+
+def backfill_quota_ledger(cursor):
+    # Charge jobs from before the ledger existed to the month they were made in
+    cursor.execute("SELECT job_id, created_at FROM print_jobs")
+    cursor.executemany(
+        "UPDATE print_jobs SET quota_month = ? WHERE job_id = ?",
+        [(month_key_for(r[1]), r[0]) for r in cursor.fetchall()]
+    )
+
+    cursor.execute(f"""
+        INSERT OR REPLACE INTO quota_usage (user_id, month_key, papers)
+        SELECT user_id, quota_month, SUM(papers)
+        FROM print_jobs
+        WHERE status IN ({", ".join("?" for _ in QUOTA_CHARGED_STATUSES)})
+        GROUP BY user_id, quota_month
+    """, QUOTA_CHARGED_STATUSES)
+
+def load_pending_jobs(job_ids):
+    """
+    Load claimed jobs from the database into memory. Queued jobs go into
+    their printer's queue; jobs that were printing (before a restart, or
+    under a daemon that died) are first reconciled against CUPS.
+    """
+    conn = get_db()
     cursor = conn.cursor()
 
-    cursor.execute("""
-        SELECT job_id, status, filename, file_path, cancel_requested
+    cursor.execute(f"""
+        SELECT job_id, status, filename, file_path, cancel_requested,
+               user_id, papers, printer_name, priority,
+               pages, pages_total, pages_printed,
+               copies, color_mode, sides, cups_job_id, created_at, started_at
         FROM print_jobs
-        WHERE status IN (?, ?)
-    """, (JOB_QUEUED, JOB_PRINTING))
+        WHERE job_id IN ({", ".join("?" for _ in job_ids)})
+        AND status IN (?, ?)
+        ORDER BY job_id
+    """, (*job_ids, JOB_QUEUED, JOB_PRINTING))
 
     rows = cursor.fetchall()
-    conn.close()
 
-    with jobs_lock:
-        for r in rows:
+    for r in rows:
+        with jobs_lock:
             jobs[r[0]] = {
                 "job_id": r[0],
+                "user_id": r[5],
                 "status": r[1],
                 "filename": r[2],
                 "file_path": r[3],
+                "papers": r[6],
+                "copies": r[12],
+                "color_mode": r[13],
+                "sides": r[14],
+                "printer_name": r[7],
+                "priority": r[8],
+                "pages": r[9],
+                "pages_total": r[10],
+                "pages_printed": r[11],
+                "cups_job_id": r[15],
+                "created_at": r[16],
+                "started_at": r[17],
                 "cancel_requested": bool(r[4])
             }
-            if r[1] == JOB_QUEUED:
-                print_queue.put(r[0])
-                
-def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    token = credentials.credentials  # this is the actual token string
-
-    user = tokens.get(token)
-    if not user:
-        raise HTTPException(status_code=401, detail="Invalid token")
 
-    return user
+    # Interrupted jobs first, so they keep their place ahead of new work
+    reconcile_printing_jobs([r[0] for r in rows if r[1] == JOB_PRINTING])
 
-def hash_password(password: str) -> str:
-    return bcrypt.hashpw(password.encode(), bcrypt.gensalt()).decode()
+    for r in rows:
+        if r[1] == JOB_QUEUED:
+            resume_job(r[0])
 
-def verify_password(password: str, hashed: str) -> bool:
-    return bcrypt.checkpw(password.encode(), hashed.encode())
-    
-def is_strong_password(pw: str) -> bool:
-    return (
-        len(pw) >= 10 and
-        re.search(r"[A-Z]", pw) and
-        re.search(r"[a-z]", pw) and
-        re.search(r"[0-9]", pw) and
-        re.search(r"[^A-Za-z0-9]", pw)
-    )
+def resume_job(job_id):
+    with jobs_lock:
+        job = jobs[job_id]
+        printer_name = job["printer_name"]
+
+    if printer_name not in printer_queues:
+        # Jobs from before the printer pool, or for a printer that is gone
+        printer_name = choose_printer(job["color_mode"], job["sides"], job["copies"])
+        if printer_name is None:
+            return
+        assign_job_to_printer(job_id, printer_name)
+    else:
+        enqueue_job(printer_name, job_id)
+
+def reconcile_printing_jobs(job_ids):
+    """
+    Settle jobs that were printing when the server stopped, using one
+    getJobs call. A job whose CUPS job already finished gets its final
+    status (or moves on to its next chunk), one still in CUPS is followed
+    again by its worker, and one that never reached CUPS is sent again.
+    Nothing is sent twice: a submit whose reply was lost is found by name.
+    """
+    if not job_ids:
+        return
 
-def require_password_change_complete(
-user=Depends(get_current_user)
-):
-    if user["must_change_password"]:
-        raise HTTPException(
-            status_code=403,
-            detail="Password change required"
-        )
-    return user
-  
-def count_pdf_pages(file_path: str) -> int:
     try:
-        with open(file_path, "rb") as f:
-            reader = PdfReader(f)
-            return len(reader.pages)
-    except Exception:
-        raise HTTPException(
-            status_code=400,
-            detail="Invalid or corrupted PDF file"
+        cups_jobs = cups_client.getJobs(
+            which_jobs="all",
+            requested_attributes=["job-name", "job-state"]
         )
-    
-def get_monthly_paper_usage(user_id: int) -> int:
-    start_utc, end_utc = get_current_ist_month_window()
+    except CupsUnavailable as e:
+        # The workers look the jobs up by name once cupsd is back
+        print(f"{e}; reconciling {len(job_ids)} printing job(s) later")
+        cups_jobs = None
+
+    for job_id in job_ids:
+        with jobs_lock:
+            job = jobs[job_id]
+            init_job_chunks(job)
+            title = job_title(job_id, job)
+            cups_job_id = job["cups_job_id"]
+            printed_all = job["pages_total"] and job["pages_printed"] >= job["pages_total"]
+
+        if printed_all:
+            # Stopped between the last chunk and the final status write
+            finish_job(job_id, job, JOB_COMPLETED)
+            continue
+
+        if cups_jobs is None:
+            job["cups_submit_attempted"] = cups_job_id is None
+            resume_job(job_id)
+            continue
+
+        if cups_job_id is None:
+            cups_job_id = cups_job_by_title(cups_jobs, title)
+
+        if cups_job_id is None:
+            resume_job(job_id)
+            continue
+
+        # A recorded job CUPS no longer lists finished and was purged
+        state = cups_jobs.get(cups_job_id, {}).get("job-state", IPP_JOB_COMPLETED)
+
+        if state == IPP_JOB_COMPLETED:
+            record_job_progress(job_id, job, submitted_pages(job))
+            with jobs_lock:
+                more = job["chunks"] and job["next_chunk"] < len(job["chunks"])
+
+            if more and not job["cancel_requested"]:
+                resume_job(job_id)
+            else:
+                finish_job(job_id, job, JOB_CANCELLED if more else JOB_COMPLETED)
+        elif state == IPP_JOB_CANCELED:
+            finish_job(job_id, job, JOB_CANCELLED)
+        elif state in TERMINAL_STATES:
+            finish_job(job_id, job, JOB_FAILED)
+        else:
+            job["cups_job_id"] = cups_job_id
+            resume_job(job_id)
+
+    print(f"Reconciled {len(job_ids)} printing job(s) with CUPS")
+
+def finish_job(job_id, job, final_status):
+    transition_job(job_id, job, final_status)
+    print(f"Job {job_id} {final_status}")
+
+def claim_jobs(batch=500, take_over=False):
+    """
+    Claim queued and printing jobs that no live daemon holds (or, with
+    take_over, every one) and load them. Returns the ids claimed.
+    """
+    now = time.time()
+
+    with jobs_lock:
+        loaded = set(jobs)
 
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     cursor = conn.cursor()
+    begin_write(cursor)
 
-    cursor.execute("""
-        SELECT COALESCE(SUM(papers), 0)
-        FROM print_jobs
-        WHERE user_id = ?
-        AND status IN ('queued', 'printing', 'completed')
-        AND created_at >= ?
-        AND created_at < ?
-    """, (user_id, start_utc, end_utc))
+    try:
+        cursor.execute("""
+            SELECT job_id
+            FROM print_jobs
+            WHERE status IN (?, ?)
+            AND (? OR claimed_by IS NULL OR claimed_by = ? OR lease_expires < ?)
+            ORDER BY job_id
+        """, (JOB_QUEUED, JOB_PRINTING, take_over, PRINTER_DAEMON_ID, now))
+
+        job_ids = [r[0] for r in cursor.fetchall() if r[0] not in loaded]
+        if not take_over:
+            job_ids = job_ids[:batch]
+
+        cursor.executemany("""
+            UPDATE print_jobs
+            SET claimed_by = ?, lease_expires = ?
+            WHERE job_id = ?
+        """, [(PRINTER_DAEMON_ID, now + JOB_LEASE_SECONDS, job_id) for job_id in job_ids])
 
-    used_papers = cursor.fetchone()[0]
-    conn.close()
+        conn.commit()
 
-    return used_papers
+    except sqlite3.Error:
+        conn.rollback()
+        raise
 
-def calculate_papers(pages: int, copies: int, sides: str) -> int:
-    if sides == "two-sided-long-edge":
-        papers_per_copy = (pages + 1) // 2
-    else:
-        papers_per_copy = pages
+    if job_ids:
+        load_pending_jobs(job_ids)
 
-    return papers_per_copy * copies
+    return job_ids
 
+def renew_job_leases():
+    conn = get_db()
+    conn.execute("""
+        UPDATE print_jobs
+        SET lease_expires = ?
+        WHERE claimed_by = ? AND status IN (?, ?)
+    """, (time.time() + JOB_LEASE_SECONDS, PRINTER_DAEMON_ID, JOB_QUEUED, JOB_PRINTING))
+    conn.commit()
 
-def get_current_ist_month_window():
-    # Current time in IST
-    now_ist = datetime.now(IST)
+def check_job_claim(job_id):
+    """
+    Checked just before a job goes to CUPS, so a daemon that lost its
+    claim (say, after a long stall) can't print a job twice and a cancel
+    made through another process can't be missed. Returns whether this
+    process still holds the job and whether a cancel was requested.
+    """
+    conn = get_db()
+    cursor = conn.cursor()
 
-    # First day of this month at 00:00 IST
-    start_ist = now_ist.replace(
-        day=1, hour=0, minute=0, second=0, microsecond=0
+    cursor.execute(
+        "SELECT claimed_by, cancel_requested FROM print_jobs WHERE job_id = ?",
+        (job_id,)
     )
+    row = cursor.fetchone()
 
-    # First day of next month
-    if start_ist.month == 12:
-        next_month_ist = start_ist.replace(
-            year=start_ist.year + 1, month=1
-        )
-    else:
-        next_month_ist = start_ist.replace(
-            month=start_ist.month + 1
-        )
+    if row is None:
+        return False, False
 
-    # Convert both to UTC
-    start_utc = start_ist.astimezone(timezone.utc)
-    end_utc = next_month_ist.astimezone(timezone.utc)
+    return row[0] == PRINTER_DAEMON_ID, bool(row[1])
 
-    return start_utc.isoformat(), end_utc.isoformat()
+def sync_claimed_jobs():
+    """
+    Apply cancels and priority changes made through another process to
+    the jobs this one holds.
+    """
+    with jobs_lock:
+        held = {job_id: (job["cancel_requested"], job.get("priority", 0)) for job_id, job in jobs.items()}
 
+    if not held:
+        return
 
-def create_default_admin():
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     cursor = conn.cursor()
 
-    cursor.execute("SELECT * FROM users WHERE role = 'admin'")
-    admin_exists = cursor.fetchone()
+    cursor.execute(f"""
+        SELECT job_id, cancel_requested, priority
+        FROM print_jobs
+        WHERE job_id IN ({", ".join("?" for _ in held)})
+    """, tuple(held))
 
-    if not admin_exists:
-        cursor.execute("""
-            INSERT INTO users (username, password_hash, role)
-            VALUES (?, ?, ?)
-        """, (
-            "admin",
-            hash_password("admin123"),
-            "admin"
-        ))
+    for job_id, cancel_requested, priority in cursor.fetchall():
+        if cancel_requested and not held[job_id][0]:
+            request_cancel(job_id)
+        elif priority != held[job_id][1]:
+            with jobs_lock:
+                job = jobs.get(job_id)
+                if job:
+                    job["priority"] = priority
+                    if job.get("printer_name") in printer_queues:
+                        printer_queues[job["printer_name"]].set_priority(job_id, priority)
+
+def job_claim_worker():
+    while True:
+        try:
+            renew_job_leases()
+            claim_jobs()
+            sync_claimed_jobs()
+        except Exception as e:
+            print("Job claim failed:", e)
+
+        if shutdown_requested.wait(JOB_CLAIM_INTERVAL):
+            return
+
+def release_job_claims():
+    """
+    Hand back the jobs this process holds that CUPS doesn't have yet, so
+    another printer daemon (or the next start) can take them right away.
+    """
+    conn = get_db()
+    cursor = conn.cursor()
+
+    cursor.execute("""
+        UPDATE print_jobs
+        SET claimed_by = NULL, lease_expires = NULL
+        WHERE claimed_by = ? AND status IN (?, ?)
+        AND cups_job_id IS NULL
+    """, (PRINTER_DAEMON_ID, JOB_QUEUED, JOB_PRINTING))
+    released = cursor.rowcount
+
+    conn.commit()
+    return released
+
+def job_status_feed_worker():
+    """
+    In API-only processes, publish the status changes printer daemons
+    write to SQLite so event streams here see them.
+    """
+    seen = {}
+    last_job_id = None
+
+    while not shutdown_requested.wait(JOB_EVENT_POLL_INTERVAL):
+        try:
+            conn = get_db()
+            cursor = conn.cursor()
+
+            if last_job_id is None:
+                cursor.execute("SELECT COALESCE(MAX(job_id), 0) FROM print_jobs")
+                last_job_id = cursor.fetchone()[0]
+
+            # Active jobs, the ones that were active last time round, and
+            # every job created since, which may already have finished
+            cursor.execute(f"""
+                SELECT job_id, status, pages_printed, pages_total, user_id
+                FROM print_jobs
+                WHERE status IN (?, ?)
+                OR job_id > ?
+                OR job_id IN ({", ".join("?" for _ in seen)})
+            """, (JOB_QUEUED, JOB_PRINTING, last_job_id, *seen))
+
+            current = {}
+            newest = last_job_id
+            for job_id, job_status, pages_printed, pages_total, user_id in cursor.fetchall():
+                state = (job_status, pages_printed)
+                newest = max(newest, job_id)
+                if job_id > last_job_id or seen.get(job_id, state) != state:
+                    event = {"job_id": job_id, "status": job_status}
+                    if pages_total:
+                        event["pages_printed"] = pages_printed
+                        event["pages_total"] = pages_total
+                    job_event_hub.publish(event, [("job", job_id), ("all",), ("user", user_id)])
+
+                if job_status not in JOB_FINAL_STATUSES:
+                    current[job_id] = state
+
+            seen = current
+            last_job_id = newest
+
+        except Exception as e:
+            print("Job status feed failed:", e)
+
+def hash_token(token):
+    # Only a hash of each token is stored, so a leaked database holds no
+    # usable sessions
+    return hashlib.sha256(token.encode()).hexdigest()
+
+def create_session(user_id):
+    token = secrets.token_urlsafe(32)
+
+    conn = get_db()
+    cursor = conn.cursor()
+
+    cursor.execute("""
+        INSERT INTO sessions (token_hash, user_id, created_at, expires_at)
+        VALUES (?, ?, ?, ?)
+    """, (
+        hash_token(token),
+        user_id,
+        datetime.now(timezone.utc).isoformat(),
+        time.time() + SESSION_TTL
+    ))
+
+    conn.commit()
+
+    return token
+
+def load_session(token_hash, now):
+    conn = get_db()
+    cursor = conn.cursor()
+
+    cursor.execute("""
+        SELECT s.user_id, s.expires_at, u.username, u.role, u.must_change_password
+        FROM sessions s
+        JOIN users u ON u.user_id = s.user_id
+        WHERE s.token_hash = ? AND s.expires_at > ?
+    """, (token_hash, now))
+
+    return cursor.fetchone()
+
+def peek_session(token):
+    """
+    The cached user for a token, or None if lookup_token() has to read or
+    refresh the session in the database.
+    """
+    token_hash = hash_token(token)
+    now = time.time()
+
+    with sessions_lock:
+        entry = session_cache.get(token_hash)
+        if entry:
+            session_cache.move_to_end(token_hash)
+
+    if (
+        not entry
+        or entry["cached_until"] < now
+        or entry["expires_at"] < now + SESSION_TTL - SESSION_REFRESH_INTERVAL
+    ):
+        return None
+
+    return entry["user"]
+
+def lookup_token(token, fresh=False):
+    token_hash = hash_token(token)
+    now = time.time()
+
+    with sessions_lock:
+        entry = session_cache.get(token_hash)
+        if entry:
+            session_cache.move_to_end(token_hash)
+
+    if fresh or not entry or entry["cached_until"] < now or entry["expires_at"] < now:
+        row = load_session(token_hash, now)
+
+        if not row:
+            with sessions_lock:
+                session_cache.pop(token_hash, None)
+            raise HTTPException(status_code=401, detail="Invalid token")
+
+        entry = {
+            "user": {
+                "user_id": row[0],
+                "username": row[2],
+                "role": row[3],
+                "must_change_password": row[4],
+                "token": token
+            },
+            "expires_at": row[1],
+            "cached_until": now + SESSION_CACHE_TTL
+        }
+
+        with sessions_lock:
+            session_cache[token_hash] = entry
+            while len(session_cache) > SESSION_CACHE_SIZE:
+                session_cache.popitem(last=False)
+
+    # Sliding expiry, written through only once the stored expiry has
+    # fallen SESSION_REFRESH_INTERVAL behind
+    if entry["expires_at"] < now + SESSION_TTL - SESSION_REFRESH_INTERVAL:
+        entry["expires_at"] = now + SESSION_TTL
+
+        conn = get_db()
+        conn.execute("""
+            UPDATE sessions
+            SET expires_at = ?
+            WHERE token_hash = ?
+        """, (entry["expires_at"], token_hash))
         conn.commit()
 
-    conn.close()
+    return entry["user"]
 
-    
-init_db()
-load_pending_jobs()
-create_default_admin()
-    
-def insert_job(user_id, status, filename, file_path, papers):
-    conn = sqlite3.connect(DB_PATH)
+def delete_session(token):
+    token_hash = hash_token(token)
+
+    conn = get_db()
+    conn.execute("DELETE FROM sessions WHERE token_hash = ?", (token_hash,))
+    conn.commit()
+
+    with sessions_lock:
+        session_cache.pop(token_hash, None)
+
+def create_stream_ticket(token):
+    ticket = secrets.token_urlsafe(32)
+
+    conn = get_db()
+    conn.execute("""
+        INSERT INTO stream_tickets (ticket_hash, token_hash, expires_at)
+        VALUES (?, ?, ?)
+    """, (hash_token(ticket), hash_token(token), time.time() + STREAM_TICKET_TTL))
+    conn.commit()
+
+    return ticket
+
+def lookup_stream_ticket(ticket):
+    now = time.time()
+
+    conn = get_db()
     cursor = conn.cursor()
 
     cursor.execute("""
-        INSERT INTO print_jobs (user_id, status, filename, file_path ,papers ,cancel_requested ,created_at)
-    VALUES (?, ?, ?, ?, ?, ?, ?)
-""", (
-    user_id,
-    status,
-    filename,
-    file_path,
-    papers,
-    0,
-    datetime.now(timezone.utc).isoformat()
+        SELECT s.user_id, u.username, u.role, u.must_change_password
+        FROM stream_tickets t
+        JOIN sessions s ON s.token_hash = t.token_hash
+        JOIN users u ON u.user_id = s.user_id
+        WHERE t.ticket_hash = ? AND t.expires_at > ? AND s.expires_at > ?
+    """, (hash_token(ticket), now, now))
+
+    row = cursor.fetchone()
+    if not row:
+        raise HTTPException(status_code=401, detail="Invalid ticket")
 
-))
+    # No "token": a stream can't be used to end the session
+    return {
+        "user_id": row[0],
+        "username": row[1],
+        "role": row[2],
+        "must_change_password": row[3]
+    }
 
+def evict_expired_sessions():
+    now = time.time()
 
-    job_id = cursor.lastrowid
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM sessions WHERE expires_at <= ?", (now,))
+    removed = cursor.rowcount
+    cursor.execute("DELETE FROM stream_tickets WHERE expires_at <= ?", (now,))
     conn.commit()
-    conn.close()
 
-    return job_id
+    with sessions_lock:
+        for token_hash in [k for k, v in session_cache.items() if v["expires_at"] <= now]:
+            del session_cache[token_hash]
+
+    return removed
+
+def session_eviction_worker():
+    while not shutdown_requested.wait(SESSION_EVICT_INTERVAL):
+        try:
+            evict_expired_sessions()
+        except Exception as e:
+            print("Session eviction failed:", e)
+
+        login_ip_limiter.prune()
+        login_user_limiter.prune()
+
+async def authenticate(token, fresh=False):
+    user = None if fresh else peek_session(token)
+    if user is None:
+        user = await run_storage(lookup_token, token, fresh)
+    return user
+
+async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    token = credentials.credentials  # this is the actual token string
+
+    return await authenticate(token)
+
+async def get_stream_user(request: Request, ticket: Optional[str] = None):
+    # EventSource can't send headers, so event streams also take a
+    # ?ticket= from POST /events/ticket; the session token itself never
+    # goes in a URL, where access logs would record it
+    authorization = request.headers.get("Authorization", "")
+    if authorization.startswith("Bearer "):
+        return await authenticate(authorization[len("Bearer "):])
+
+    if not ticket:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+
+    return await run_storage(lookup_stream_ticket, ticket)
+
+def hash_password(password: str) -> str:
+    return bcrypt.hashpw(password.encode(), bcrypt.gensalt(rounds=BCRYPT_ROUNDS)).decode()
+
+def verify_password(password: str, hashed: str) -> bool:
+    return bcrypt.checkpw(password.encode(), hashed.encode())
+
+def password_needs_rehash(hashed: str) -> bool:
+    # bcrypt hashes look like $2b$12$<salt+hash>
+    try:
+        return int(hashed.split("$")[2]) != BCRYPT_ROUNDS
+    except (IndexError, ValueError):
+        return False
+
+async def run_password_work(fn, *args):
+    if not password_slots.acquire(blocking=False):
+        raise HTTPException(
+            status_code=503,
+            detail="Too many logins in progress, please retry",
+            headers={"Retry-After": "1"}
+        )
+
+    try:
+        loop = asyncio.get_running_loop()
+        submitted = time.perf_counter()
+
+        def call():
+            started = time.perf_counter()
+            password_wait_seconds.observe(started - submitted)
+            with password_hash_seconds.time(fn.__name__):
+                return fn(*args)
+
+        return await loop.run_in_executor(password_executor, call)
+    finally:
+        password_slots.release()
+
+def check_rate_limit(limiter, key):
+    retry_after = limiter.acquire(key)
 
+    if retry_after:
+        raise HTTPException(
+            status_code=429,
+            detail="Too many attempts, please wait and retry",
+            headers={"Retry-After": str(math.ceil(retry_after))}
+        )
 
-def update_job_status(job_id, status):
-    conn = sqlite3.connect(DB_PATH)
+def get_login_row(username):
+    conn = get_db()
     cursor = conn.cursor()
 
     cursor.execute("""
-        UPDATE print_jobs
-        SET status = ?
-        WHERE job_id = ?
-    """, (status, job_id))
+        SELECT user_id, password_hash, role, must_change_password
+        FROM users
+        WHERE username = ?
+    """, (username,))
+
+    return cursor.fetchone()
+
+def get_password_hash(user_id):
+    conn = get_db()
+    cursor = conn.cursor()
+
+    cursor.execute(
+        "SELECT password_hash FROM users WHERE user_id = ?",
+        (user_id,)
+    )
+
+    return cursor.fetchone()[0]
+
+def set_password_hash(user_id, password_hash, password_changed=False):
+    conn = get_db()
+
+    if password_changed:
+        conn.execute("""
+            UPDATE users
+            SET password_hash = ?, must_change_password = 0
+            WHERE user_id = ?
+        """, (password_hash, user_id))
+    else:
+        conn.execute("""
+            UPDATE users
+            SET password_hash = ?
+            WHERE user_id = ?
+        """, (password_hash, user_id))
 
     conn.commit()
-    conn.close()
+    
+def is_strong_password(pw: str) -> bool:
+    return (
+        len(pw) >= 10 and
+        re.search(r"[A-Z]", pw) and
+        re.search(r"[a-z]", pw) and
+        re.search(r"[0-9]", pw) and
+        re.search(r"[^A-Za-z0-9]", pw)
+    )
+
+async def require_password_change_complete(
+user=Depends(get_current_user)
+):
+    if user["must_change_password"]:
+        # The password may have been changed through another worker
+        # process since this session was cached
+        user = await authenticate(user["token"], fresh=True)
+
+    if user["must_change_password"]:
+        raise HTTPException(
+            status_code=403,
+            detail="Password change required"
+        )
+    return user
+  
+def inspect_pdf(file_path: str) -> dict:
+    start = time.perf_counter()
+    outcome = "ok"
+
+    try:
+        return pdf_inspect.inspect(file_path, pdf_parse_pool)
+    except pdf_inspect.PdfBusy:
+        outcome = "busy"
+        raise HTTPException(
+            status_code=503,
+            detail="Server busy processing other PDFs, try again shortly"
+        )
+    except pdf_inspect.PdfTimeout:
+        outcome = "timeout"
+        raise HTTPException(
+            status_code=400,
+            detail="PDF took too long to process"
+        )
+    except pdf_inspect.PdfError:
+        outcome = "invalid"
+        raise HTTPException(
+            status_code=400,
+            detail="Invalid or corrupted PDF file"
+        )
+    finally:
+        page_count_seconds.observe(time.perf_counter() - start, outcome)
+    
+def month_key_for(created_at: str) -> str:
+    # Quota months run on IST calendar months
+    return datetime.fromisoformat(created_at).astimezone(IST).strftime("%Y-%m")
+
+def cache_quota_usage(user_id, month_key, papers):
+    with quota_lock:
+        quota_cache[(user_id, month_key)] = (papers, time.monotonic() + QUOTA_CACHE_TTL)
+
+async def form_file_chunks(request, fields, upload_info):
+    """
+    Parse a multipart/form-data body as it comes off the connection,
+    yielding the bytes of its "file" part and collecting the other (small)
+    fields into `fields`. The file's name goes into upload_info.
+    """
+    content_type, params = parse_options_header(request.headers.get("content-type", ""))
+    if content_type != b"multipart/form-data" or not params.get(b"boundary"):
+        raise HTTPException(status_code=400, detail="Expected a multipart/form-data upload")
+
+    part = {}
+    pieces = []
+
+    def on_part_begin():
+        part.update(headers={}, field=b"", value=b"")
+
+    def on_header_field(data, start, end):
+        part["field"] += data[start:end]
+
+    def on_header_value(data, start, end):
+        part["value"] += data[start:end]
+
+    def on_header_end():
+        part["headers"][part["field"].lower()] = part["value"]
+        part["field"] = part["value"] = b""
+
+    def on_headers_finished():
+        _, options = parse_options_header(part["headers"].get(b"content-disposition", b""))
+        part["name"] = options.get(b"name", b"").decode("utf-8", "replace")
+        if part["name"] == "file":
+            upload_info["filename"] = options.get(b"filename", b"").decode("utf-8", "replace")
+
+    def on_part_data(data, start, end):
+        pieces.append((part["name"], data[start:end]))
+
+    parser = MultipartParser(params[b"boundary"], {
+        "on_part_begin": on_part_begin,
+        "on_header_field": on_header_field,
+        "on_header_value": on_header_value,
+        "on_header_end": on_header_end,
+        "on_headers_finished": on_headers_finished,
+        "on_part_data": on_part_data,
+    })
+
+    async for chunk in request.stream():
+        try:
+            parser.write(chunk)
+        except Exception:
+            raise HTTPException(status_code=400, detail="Malformed upload")
+
+        data = b"".join(piece for name, piece in pieces if name == "file")
+        for name, piece in pieces:
+            if name != "file":
+                fields[name] = fields.get(name, b"") + piece
+                if len(fields[name]) > MAX_FORM_FIELD_BYTES:
+                    raise HTTPException(status_code=400, detail=f"Field {name} too large")
+        pieces.clear()
+
+        if data:
+            yield data
+
+    parser.finalize()
+
+    if "filename" not in upload_info:
+        raise HTTPException(status_code=400, detail="No file uploaded")
+
+async def ingest_upload(chunks):
+    """
+    Stream an upload (an async iterator of its bytes) to a unique temp path
+    under UPLOAD_DIR, hashing it and enforcing MAX_UPLOAD_BYTES as chunks
+    arrive. Non-PDF uploads are rejected once their first 1 KB is in.
+    Returns the temp path, SHA-256 and size; store_blob() moves it into
+    the blob store.
+    """
+    part_path = os.path.join(UPLOAD_DIR, f"{uuid.uuid4().hex}.pdf.part")
+
+    digest = hashlib.sha256()
+    size = 0
+    head = b""
+
+    buffer = await run_storage(open, part_path, "wb")
+
+    try:
+        async for chunk in chunks:
+            # PDF readers accept the header anywhere in the first 1 KB
+            if head is not None:
+                head = (head + chunk)[:1024]
+                if b"%PDF-" in head:
+                    head = None
+                elif len(head) == 1024:
+                    raise HTTPException(status_code=400, detail="Only PDF files can be printed")
+
+            size += len(chunk)
+            if size > MAX_UPLOAD_BYTES:
+                raise HTTPException(
+                    status_code=413,
+                    detail=f"File too large (max {MAX_UPLOAD_BYTES // (1024 * 1024)} MB)"
+                )
+
+            digest.update(chunk)
+            await run_storage(buffer.write, chunk)
+
+        if size == 0:
+            raise HTTPException(status_code=400, detail="Empty file")
+
+        if head is not None:
+            raise HTTPException(status_code=400, detail="Only PDF files can be printed")
+
+        await run_storage(buffer.close)
+
+    except BaseException:
+        buffer.close()
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise
+
+    return {
+        "part_path": part_path,
+        "sha256": digest.hexdigest(),
+        "size": size
+    }
+
+def blob_path(sha256):
+    return os.path.join(BLOB_DIR, sha256[:2], f"{sha256}.pdf")
+
+def blob_from_row(row):
+    return {
+        "sha256": row[0],
+        "path": row[1],
+        "size": row[2],
+        "pages": row[3],
+        "metadata": json.loads(row[4])
+    }
+
+def store_blob(upload):
+    """
+    Move an ingested upload into the content-addressed store. A document
+    that is already stored is reused as-is: the temp file is dropped and
+    the cached page count and metadata are returned without parsing.
+    """
+    sha256 = upload["sha256"]
+    path = blob_path(sha256)
+
+    conn = get_db()
+    cursor = conn.cursor()
+
+    # Touching the row first keeps the garbage collector off it
+    cursor.execute("""
+        UPDATE blobs
+        SET last_used_at = ?
+        WHERE sha256 = ?
+    """, (time.time(), sha256))
+    touched = cursor.rowcount > 0
+    conn.commit()
+
+    row = None
+    if touched:
+        cursor.execute("""
+            SELECT sha256, path, size, pages, metadata
+            FROM blobs
+            WHERE sha256 = ?
+        """, (sha256,))
+        row = cursor.fetchone()
+
+    hit = row is not None and os.path.exists(row[1])
+
+    with blob_stats_lock:
+        blob_stats["lookups"] += 1
+        if hit:
+            blob_stats["hits"] += 1
+
+    if hit:
+        os.remove(upload["part_path"])
+        return blob_from_row(row)
+
+    try:
+        info = inspect_pdf(upload["part_path"])
+    except BaseException:
+        os.remove(upload["part_path"])
+        raise
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    os.replace(upload["part_path"], path)
+
+    cursor.execute("""
+        INSERT OR REPLACE INTO blobs (sha256, path, size, pages, metadata, created_at, last_used_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    """, (
+        sha256,
+        path,
+        upload["size"],
+        info["pages"],
+        json.dumps(info["metadata"]),
+        datetime.now(timezone.utc).isoformat(),
+        time.time()
+    ))
+    conn.commit()
+
+    return {
+        "sha256": sha256,
+        "path": path,
+        "size": upload["size"],
+        "pages": info["pages"],
+        "metadata": info["metadata"]
+    }
+
+def collect_garbage_blobs():
+    """
+    Delete blobs that no queued or printing job refers to and that
+    haven't been used for BLOB_RETENTION_SECONDS (BLOB_GC_GRACE_SECONDS
+    at least).
+    """
+    cutoff = time.time() - max(BLOB_RETENTION_SECONDS, BLOB_GC_GRACE_SECONDS)
+
+    conn = get_db()
+    cursor = conn.cursor()
+
+    cursor.execute("""
+        SELECT b.sha256, b.path
+        FROM blobs b
+        WHERE b.last_used_at < ?
+        AND NOT EXISTS (
+            SELECT 1 FROM print_jobs j
+            WHERE j.file_path = b.path
+            AND j.status IN (?, ?)
+        )
+    """, (cutoff, JOB_QUEUED, JOB_PRINTING))
+    candidates = cursor.fetchall()
+
+    removed = 0
+
+    for sha256, path in candidates:
+        # Re-check under the write lock; a submit may have just reused it.
+        # The file goes before the commit so a concurrent re-upload that
+        # finds the row gone can safely put it back.
+        begin_write(cursor)
+        try:
+            cursor.execute("""
+                DELETE FROM blobs
+                WHERE sha256 = ? AND last_used_at < ?
+            """, (sha256, cutoff))
+
+            if cursor.rowcount and os.path.exists(path):
+                os.remove(path)
+                removed += 1
+
+            conn.commit()
+
+        except Exception:
+            conn.rollback()
+            raise
+
+    return removed
+
+def release_blob(job_id, job):
+    """
+    Delete the blob of a job CUPS has fully accepted, unless another
+    queued or printing job uses it or it was reused after this job was
+    submitted. Only called with BLOB_RETENTION_SECONDS at 0.
+    """
+    path = job["file_path"]
+    submitted = datetime.fromisoformat(job["created_at"]).timestamp()
+
+    conn = get_db()
+    cursor = conn.cursor()
+
+    begin_write(cursor)
+    try:
+        cursor.execute("""
+            DELETE FROM blobs
+            WHERE path = ? AND last_used_at <= ?
+            AND NOT EXISTS (
+                SELECT 1 FROM print_jobs j
+                WHERE j.file_path = blobs.path
+                AND j.job_id != ?
+                AND j.status IN (?, ?)
+            )
+        """, (path, submitted, job_id, JOB_QUEUED, JOB_PRINTING))
+
+        if cursor.rowcount and os.path.exists(path):
+            os.remove(path)
+
+        conn.commit()
+
+    except Exception:
+        conn.rollback()
+        raise
+
+def get_blob_stats():
+    conn = get_db()
+    cursor = conn.cursor()
+
+    cursor.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM blobs")
+    count, total_bytes = cursor.fetchone()
+
+    with blob_stats_lock:
+        lookups = blob_stats["lookups"]
+        hits = blob_stats["hits"]
+
+    return {
+        "blobs": count,
+        "bytes": total_bytes,
+        "lookups": lookups,
+        "dedup_hits": hits,
+        "dedup_hit_rate": round(hits / lookups, 4) if lookups else 0.0
+    }
+
+def blob_gc_worker():
+    while not shutdown_requested.wait(BLOB_GC_INTERVAL):
+        try:
+            removed = collect_garbage_blobs()
+            if removed:
+                print(f"Removed {removed} unused upload(s)")
+        except Exception as e:
+            print("Upload garbage collection failed:", e)
+
+def get_monthly_paper_usage(user_id: int) -> int:
+    month_key = datetime.now(IST).strftime("%Y-%m")
+
+    with quota_lock:
+        cached = quota_cache.get((user_id, month_key))
+    if cached and cached[1] > time.monotonic():
+        return cached[0]
+
+    conn = get_db()
+    cursor = conn.cursor()
+
+    cursor.execute("""
+        SELECT papers
+        FROM quota_usage
+        WHERE user_id = ? AND month_key = ?
+    """, (user_id, month_key))
+
+    row = cursor.fetchone()
+    used_papers = row[0] if row else 0
+
+    cache_quota_usage(user_id, month_key, used_papers)
+
+    return used_papers
+
+def calculate_papers(pages: int, copies: int, sides: str) -> int:
+    if sides == "two-sided-long-edge":
+        papers_per_copy = (pages + 1) // 2
+    else:
+        papers_per_copy = pages
+
+    return papers_per_copy * copies
+
+
+def create_default_admin():
+    conn = get_db()
+    cursor = conn.cursor()
+
+    cursor.execute("SELECT * FROM users WHERE role = 'admin'")
+    admin_exists = cursor.fetchone()
+
+    if not admin_exists:
+        # Another process may be creating it at the same time
+        cursor.execute("""
+            INSERT OR IGNORE INTO users (username, password_hash, role)
+            VALUES (?, ?, ?)
+        """, (
+            "admin",
+            hash_password("admin123"),
+            "admin"
+        ))
+        conn.commit()
+
+
+
+def insert_job(user_id, status, filename, file_path, papers, printer_name, quota_limit=None, file_sha256=None,
+               pages=None, pages_total=None, copies=1, color_mode="bw", sides="one-sided", created_at=None,
+               claimed_by=None):
+    """
+    Insert the job and charge its papers to the user's monthly ledger in
+    one transaction. With quota_limit set the charge is only made if it
+    keeps the user within the limit; otherwise nothing is written and a
+    403 is raised.
+    """
+    created_at = created_at or datetime.now(timezone.utc).isoformat()
+    month_key = month_key_for(created_at)
+
+    conn = get_db()
+    cursor = conn.cursor()
+
+    # Take the write lock up front so concurrent submits can't both pass
+    begin_write(cursor)
+
+    try:
+        cursor.execute("""
+            INSERT INTO quota_usage (user_id, month_key, papers)
+            VALUES (?, ?, 0)
+            ON CONFLICT (user_id, month_key) DO NOTHING
+        """, (user_id, month_key))
+
+        cursor.execute("""
+            UPDATE quota_usage
+            SET papers = papers + ?
+            WHERE user_id = ? AND month_key = ?
+            AND (? IS NULL OR papers + ? <= ?)
+        """, (papers, user_id, month_key, quota_limit, papers, quota_limit))
+
+        reserved = cursor.rowcount > 0
+
+        cursor.execute("""
+            SELECT papers
+            FROM quota_usage
+            WHERE user_id = ? AND month_key = ?
+        """, (user_id, month_key))
+        used_papers = cursor.fetchone()[0]
+
+        if not reserved:
+            conn.rollback()
+            cache_quota_usage(user_id, month_key, used_papers)
+            raise HTTPException(
+                status_code=403,
+                detail=(
+                f"Monthly paper quota exceeded. "
+                f"Used {used_papers}/{quota_limit} papers."
+                )
+            )
+
+        cursor.execute("""
+            INSERT INTO print_jobs (user_id, status, filename, file_path ,papers ,cancel_requested ,created_at, printer_name, quota_month, file_sha256,
+                                    pages, pages_total, copies, color_mode, sides, claimed_by, lease_expires)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, (
+        user_id,
+        status,
+        filename,
+        file_path,
+        papers,
+        0,
+        created_at,
+        printer_name,
+        month_key,
+        file_sha256,
+        pages,
+        pages_total,
+        copies,
+        color_mode,
+        sides,
+        claimed_by,
+        time.time() + JOB_LEASE_SECONDS if claimed_by else None
+    ))
+
+        job_id = cursor.lastrowid
+        conn.commit()
+
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+
+    cache_quota_usage(user_id, month_key, used_papers)
+
+    return job_id
+
+
+def stage_timestamp(status, at):
+    # The SET clause recording when a job first started printing, or when
+    # it became final
+    if status == JOB_PRINTING:
+        return ", started_at = COALESCE(started_at, ?)", (at,)
+    if status in JOB_FINAL_STATUSES:
+        return ", finished_at = ?", (at,)
+    return "", ()
+
+def update_job_status(job_id, status, from_statuses=None, at=None):
+    """
+    Move a job to `status` if JOB_TRANSITIONS allows it from the stored
+    status (and it is one of from_statuses, if given). Returns whether
+    the job was updated. Starting to print and reaching a final status
+    are timestamped with `at` (default now).
+    """
+    sources = [
+        s for s, targets in JOB_TRANSITIONS.items()
+        if status in targets and (from_statuses is None or s in from_statuses)
+    ]
+    stamp, stamp_params = stage_timestamp(status, at or datetime.now(timezone.utc).isoformat())
+
+    conn = get_db()
+    cursor = conn.cursor()
+
+    if status in QUOTA_CHARGED_STATUSES:
+        cursor.execute(f"""
+            UPDATE print_jobs
+            SET status = ?{stamp}
+            WHERE job_id = ?
+            AND status IN ({", ".join("?" for _ in sources)})
+        """, (status, *stamp_params, job_id, *sources))
+        updated = cursor.rowcount > 0
+
+        conn.commit()
+        if updated:
+            if status in JOB_FINAL_STATUSES:
+                jobs_finished.inc(status)
+            publish_job_status(job_id, status)
+        return updated
+
+    # Cancelled and failed jobs give their papers back, once
+    begin_write(cursor)
+
+    try:
+        cursor.execute("""
+            SELECT user_id, quota_month, papers, status
+            FROM print_jobs
+            WHERE job_id = ?
+        """, (job_id,))
+        row = cursor.fetchone()
+
+        if not row or row[3] not in sources:
+            conn.rollback()
+            return False
+
+        cursor.execute(f"""
+            UPDATE print_jobs
+            SET status = ?{stamp}
+            WHERE job_id = ?
+        """, (status, *stamp_params, job_id))
+
+        refund = row and row[1] and row[3] in QUOTA_CHARGED_STATUSES
+
+        if refund:
+            cursor.execute("""
+                UPDATE quota_usage
+                SET papers = MAX(papers - ?, 0)
+                WHERE user_id = ? AND month_key = ?
+            """, (row[2], row[0], row[1]))
+
+            cursor.execute("""
+                SELECT papers
+                FROM quota_usage
+                WHERE user_id = ? AND month_key = ?
+            """, (row[0], row[1]))
+            used_papers = cursor.fetchone()[0]
+
+        conn.commit()
+
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+
+    if refund:
+        cache_quota_usage(row[0], row[1], used_papers)
+
+    jobs_finished.inc(status)
+    publish_job_status(job_id, status)
+    return True
+
+def publish_job_status(job_id, status, job=None):
+    # A single dict read doesn't need jobs_lock
+    job = job or jobs.get(job_id) or finished_jobs.get(job_id) or {}
+
+    keys = [("job", job_id), ("all",)]
+    if "user_id" in job:
+        keys.append(("user", job["user_id"]))
+
+    event = {"job_id": job_id, "status": status}
+    if job.get("pages_total"):
+        event["pages_printed"] = job.get("pages_printed", 0)
+        event["pages_total"] = job["pages_total"]
+
+    job_event_hub.publish(event, keys)
 
 def get_job_from_db(job_id):
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
+    cursor = conn.cursor()
+
+    cursor.execute("""
+        SELECT job_id, status, filename, file_path, cancel_requested, created_at, user_id,
+               pages_printed, pages_total, printer_name, started_at, finished_at
+        FROM print_jobs
+        WHERE job_id = ?
+    """, (job_id,))
+
+    row = cursor.fetchone()
+
+    if not row:
+        return None
+
+    return {
+        "job_id": row[0],
+        "status": row[1],
+        "filename": row[2],
+        "file_path": row[3],
+        "cancel_requested": bool(row[4]),
+        "created_at": row[5],
+        "user_id": row[6],
+        "pages_printed": row[7],
+        "pages_total": row[8],
+        "printer_name": row[9],
+        "started_at": row[10],
+        "finished_at": row[11]
+    }
+
+JOB_VIEW_FIELDS = (
+    "job_id", "status", "filename", "file_path", "cancel_requested",
+    "created_at", "user_id", "pages_printed", "pages_total", "printer_name",
+    "started_at", "finished_at"
+)
+
+def job_view(job):
+    # The fields get_job_from_db returns, from a cached job
+    return {field: job.get(field) for field in JOB_VIEW_FIELDS}
+
+# What /print reports about the job it queued; file paths, CUPS ids and
+# chunk bookkeeping stay on the server
+SUBMIT_RESPONSE_FIELDS = (
+    "job_id", "user_id", "status", "filename", "papers", "copies",
+    "color_mode", "sides", "printer_name", "priority", "pages",
+    "pages_total", "pages_printed", "created_at", "cancel_requested"
+)
+
+def submit_response(job):
+    return {field: job.get(field) for field in SUBMIT_RESPONSE_FIELDS}
+
+def retire_job(job_id):
+    # Callers hold jobs_lock
+    job = jobs.pop(job_id, None)
+    if job is None:
+        return
+
+    finished_jobs[job_id] = job
+    while len(finished_jobs) > FINISHED_JOB_CACHE_SIZE:
+        finished_jobs.popitem(last=False)
+
+def peek_job(job_id):
+    # The cached view of a job, or None if it isn't in memory
+    with jobs_lock:
+        job = jobs.get(job_id)
+        if job is None and job_id in finished_jobs:
+            finished_jobs.move_to_end(job_id)
+            job = finished_jobs[job_id]
+        return job_view(job) if job is not None else None
+
+def get_job(job_id):
+    """
+    A job as get_job_from_db returns it, from memory when it is cached.
+    Final jobs read from the database are cached for next time.
+    """
+    job = peek_job(job_id)
+    if job is not None:
+        return job
+
+    job = get_job_from_db(job_id)
+
+    if job and job["status"] in JOB_FINAL_STATUSES:
+        with jobs_lock:
+            if job_id not in jobs:
+                finished_jobs[job_id] = dict(job)
+                while len(finished_jobs) > FINISHED_JOB_CACHE_SIZE:
+                    finished_jobs.popitem(last=False)
+
+    return job
+
+def transition_job(job_id, job, status, expected=None):
+    """
+    Move a cached job to `status`: the database is written first and the
+    cache follows, so the two never disagree. Returns False, changing
+    nothing, if the job's status isn't one of `expected`, and also if the
+    database refused the change (another process got there first).
+    """
+    now = datetime.now(timezone.utc)
+    at = now.isoformat()
+
+    # Held from the check to the cache update so two threads can't both
+    # act on the same starting status; readers only need jobs_lock
+    with transition_lock:
+        with jobs_lock:
+            if expected is not None and job["status"] not in expected:
+                return False
+
+        if not update_job_status(job_id, status, at=at):
+            return False
+
+        with jobs_lock:
+            job["status"] = status
+            if status == JOB_PRINTING and not job.get("started_at"):
+                job["started_at"] = at
+                job_wait_seconds.observe(seconds_between(job["created_at"], now))
+            elif status in JOB_FINAL_STATUSES:
+                job["finished_at"] = at
+                if job.get("started_at"):
+                    job_print_seconds.observe(seconds_between(job["started_at"], now), status)
+                retire_job(job_id)
+
+    return True
+
+def seconds_between(timestamp, now):
+    # Naive timestamps from older rows are server-local time
+    then = datetime.fromisoformat(timestamp).astimezone(timezone.utc)
+    return max(0.0, (now - then).total_seconds())
+
+
+def parse_created_filter(value):
+    # Accept ISO dates or datetimes; without an offset they are IST
+    if value is None:
+        return None
+
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid date: {value}")
+
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=IST)
+
+    return parsed.astimezone(timezone.utc).isoformat()
+
+def list_jobs_page(
+    user_id=None,
+    after_job_id=None,
+    limit=JOBS_PAGE_SIZE,
+    status=None,
+    created_from=None,
+    created_to=None
+):
+    """
+    Newest-first page of jobs using the job_id as a keyset cursor.
+    Returns the page and the cursor for the next one (None on the last page).
+    """
+    where = []
+    params = []
+
+    if user_id is not None:
+        where.append("user_id = ?")
+        params.append(user_id)
+
+    if after_job_id is not None:
+        where.append("job_id < ?")
+        params.append(after_job_id)
+
+    if status is not None:
+        where.append("status = ?")
+        params.append(status)
+
+    if created_from is not None:
+        where.append("created_at >= ?")
+        params.append(created_from)
+
+    if created_to is not None:
+        where.append("created_at < ?")
+        params.append(created_to)
+
+    conn = get_db()
+    cursor = conn.cursor()
+
+    cursor.execute(f"""
+        SELECT job_id, filename, status, papers, created_at
+        FROM print_jobs
+        {"WHERE " + " AND ".join(where) if where else ""}
+        ORDER BY job_id DESC
+        LIMIT ?
+    """, (*params, limit + 1))
+
+    rows = cursor.fetchall()
+
+    page = [
+        {
+            "job_id": r[0],
+            "filename": r[1],
+            "status": r[2],
+            "papers": r[3],
+            "created_at": r[4]
+        }
+        for r in rows[:limit]
+    ]
+
+    next_after_job_id = page[-1]["job_id"] if len(rows) > limit else None
+
+    return page, next_after_job_id
+
+def set_cancel_requested(job_id):
+    # Only jobs that can still be cancelled are flagged
+    conn = get_db()
+    cursor = conn.cursor()
+
+    cursor.execute("""
+        UPDATE print_jobs
+        SET cancel_requested = 1
+        WHERE job_id = ? AND status IN (?, ?)
+    """, (job_id, JOB_QUEUED, JOB_PRINTING))
+
+    flagged = cursor.rowcount > 0
+    conn.commit()
+
+    return flagged
+
+async def require_admin(user=Depends(get_current_user)):
+    if user["role"] != "admin":
+        raise HTTPException(status_code=403, detail="Admin access required")
+    return user
+
+def set_job_printer(job_id, printer_name):
+    conn = get_db()
+    cursor = conn.cursor()
+
+    cursor.execute("""
+        UPDATE print_jobs
+        SET printer_name = ?
+        WHERE job_id = ?
+    """, (printer_name, job_id))
+
+    conn.commit()
+
+def parse_printer_capabilities(attrs):
+    # Duplex support
+    duplex = "sides-supported" in attrs and len(attrs["sides-supported"]) > 1
+
+    # Color support
+    color = (
+        "color-supported" in attrs and attrs["color-supported"]
+    ) or (
+        "ColorModel" in attrs
+    )
+
+    # Max copies (fallback to 1 if unknown)
+    max_copies = int(attrs.get("copies-supported", "1").split("-")[-1])
+
+    return {
+        "duplex": bool(duplex),
+        "color": bool(color),
+        "max_copies": max_copies
+    }
+
+def parse_printer_status(attrs):
+    state = attrs.get("printer-state")
+    reasons = attrs.get("printer-state-reasons", [])
+
+    if state == 3:
+        status = "idle"
+    elif state == 4:
+        status = "printing"
+    else:
+        status = "offline"
+
+    if attrs.get("printer-is-accepting-jobs") is False:
+        status = "offline"
+
+    return {
+        "status": status,
+        "reasons": reasons
+    }
+
+def update_printer_states(cups_printers):
+    with printers_lock:
+        for name, printer in printers.items():
+            if name in cups_printers:
+                printer.update(parse_printer_status(cups_printers[name]))
+            else:
+                printer.update({"status": "offline", "reasons": ["Printer not found"]})
+
+    build_printer_snapshot(refreshed_at=time.monotonic())
+
+def request_printer_refresh():
+    printer_refresh_requested.set()
+
+def printer_status_worker():
+    # Only this thread waits on cupsd for status, so a hung cupsd leaves
+    # the snapshot stale rather than blocking requests
+    while not shutdown_requested.is_set():
+        printer_refresh_requested.wait(PRINTER_STATUS_REFRESH_INTERVAL)
+        printer_refresh_requested.clear()
+
+        if shutdown_requested.is_set():
+            return
+
+        try:
+            if printer_discovery_pending.is_set():
+                discover_printers()
+                printer_discovery_pending.clear()
+                print("Printer discovery succeeded")
+            else:
+                # Printers enabled or disabled through another process
+                load_printers()
+                update_printer_states(cups_client.getPrinters())
+            if "workers" in started_subsystems:
+                start_printer_workers()
+        except Exception as e:
+            print("Printer status refresh failed:", e)
+
+def discover_printers():
+    """
+    Register every printer CUPS knows about, refresh the capabilities of
+    the ones already in the table and create a queue for each enabled one.
+    """
+    cups_printers = cups_client.getPrinters()
+    now = datetime.now(timezone.utc).isoformat()
+
+    conn = get_db()
+    cursor = conn.cursor()
+
+    for name, attrs in cups_printers.items():
+        caps = parse_printer_capabilities(attrs)
+        cursor.execute("""
+            INSERT INTO printers (name, duplex, color, max_copies, last_seen)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(name) DO UPDATE SET
+                duplex = excluded.duplex,
+                color = excluded.color,
+                max_copies = excluded.max_copies,
+                last_seen = excluded.last_seen
+        """, (name, int(caps["duplex"]), int(caps["color"]), caps["max_copies"], now))
+
+    conn.commit()
+
+    load_printers()
+    update_printer_states(cups_printers)
+
+def load_printers():
+    """
+    Load the enabled printers from the table and create a queue for each.
+    Printers already loaded keep their last CUPS status; new ones are
+    offline until CUPS says otherwise.
+    """
+    cursor = get_db().cursor()
+    cursor.execute("""
+        SELECT name, enabled, duplex, color, max_copies
+        FROM printers
+    """)
+    rows = cursor.fetchall()
+
+    with printers_lock:
+        known = dict(printers)
+        printers.clear()
+        for r in rows:
+            if not r[1]:
+                continue
+            printers[r[0]] = {
+                "name": r[0],
+                "duplex": bool(r[2]),
+                "color": bool(r[3]),
+                "max_copies": r[4],
+                "status": known.get(r[0], {}).get("status", "offline"),
+                "reasons": known.get(r[0], {}).get("reasons", [])
+            }
+            if r[0] not in printer_queues:
+                printer_queues[r[0]] = FairQueue()
+
+    load_printer_speeds()
+
+def set_printer_enabled(printer_name, enabled):
+    conn = get_db()
+    cursor = conn.cursor()
+
+    cursor.execute("""
+        UPDATE printers
+        SET enabled = ?
+        WHERE name = ?
+    """, (int(enabled), printer_name))
+
+    found = cursor.rowcount > 0
+    conn.commit()
+
+    return found
+
+def start_printer_workers():
+    # API-only processes hold no jobs, so they run no workers
+    if PRINTER_ROLE == "api":
+        return
+
+    for name in list(printer_queues):
+        if name in printer_threads:
+            continue
+        thread = threading.Thread(target=print_worker, args=(name,), daemon=True)
+        printer_threads[name] = thread
+        thread.start()
+
+def printer_loads():
+    """
+    Papers still waiting on (or being printed by) each printer. API-only
+    processes hold no jobs in memory and ask the database.
+    """
+    loads = {}
+
+    if PRINTER_ROLE == "api":
+        cursor = get_db().cursor()
+        cursor.execute("""
+            SELECT printer_name, SUM(papers)
+            FROM print_jobs
+            WHERE status IN (?, ?)
+            GROUP BY printer_name
+        """, (JOB_QUEUED, JOB_PRINTING))
+        return {r[0]: r[1] or 0 for r in cursor.fetchall()}
+
+    with jobs_lock:
+        for job in jobs.values():
+            if job["status"] in (JOB_QUEUED, JOB_PRINTING):
+                name = job.get("printer_name")
+                loads[name] = loads.get(name, 0) + job.get("papers", 0)
+
+    return loads
+
+def choose_printer(color_mode, sides, copies, exclude=(), online_only=False):
+    """
+    Pick the least-loaded enabled printer that supports the requested
+    options, preferring printers that are currently online.
+    Returns None when no printer can take the job.
+    """
+    with printers_lock:
+        capable = [
+            dict(p) for p in printers.values()
+            if p["name"] not in exclude
+            and (color_mode == "bw" or p["color"])
+            and (sides == "one-sided" or p["duplex"])
+            and copies <= p["max_copies"]
+        ]
+
+    online = [p for p in capable if p["status"] != "offline"]
+    if online or online_only:
+        capable = online
+
+    if not capable:
+        return None
+
+    loads = printer_loads()
+    return min(capable, key=lambda p: loads.get(p["name"], 0))["name"]
+
+def assign_job_to_printer(job_id, printer_name):
+    with jobs_lock:
+        job = jobs.get(job_id)
+        if job:
+            job["printer_name"] = printer_name
+
+    set_job_printer(job_id, printer_name)
+    enqueue_job(printer_name, job_id)
+
+def job_chunks(job):
+    """
+    The (copy, first_page, last_page) sub-jobs a job is printed as, or
+    None if it goes to CUPS whole.
+    """
+    pages = job.get("pages")
+    copies = job.get("copies", 1)
+
+    if not PRINT_CHUNK_PAGES or not pages or pages * copies <= PRINT_CHUNK_PAGES:
+        return None
+
+    # Keep both sides of a sheet in the same chunk
+    size = PRINT_CHUNK_PAGES
+    if job.get("sides", "one-sided") != "one-sided" and size % 2:
+        size += 1
+
+    return [
+        (copy, first, min(first + size - 1, pages))
+        for copy in range(copies)
+        for first in range(1, pages + 1, size)
+    ]
+
+def chunk_pages(chunk):
+    return chunk[2] - chunk[1] + 1
+
+def next_chunk_papers(job):
+    chunks = job.get("chunks")
+    if not chunks:
+        return job["papers"]
+
+    chunk = chunks[job["next_chunk"]]
+    return calculate_papers(chunk_pages(chunk), 1, job.get("sides", "one-sided"))
+
+def init_job_chunks(job):
+    # Callers hold jobs_lock
+    if "chunks" in job:
+        return
+
+    job["chunks"] = job_chunks(job)
+    job["next_chunk"] = 0
+
+    # Pick up after the chunks already printed before a restart
+    printed = job.get("pages_printed") or 0
+    while job["chunks"] and job["next_chunk"] < len(job["chunks"]) - 1:
+        pages = chunk_pages(job["chunks"][job["next_chunk"]])
+        if printed < pages:
+            break
+        printed -= pages
+        job["next_chunk"] += 1
+
+def job_title(job_id, job):
+    # CUPS job name; chunks are PrintJob-<id>.<n>
+    if job.get("chunks"):
+        return f"PrintJob-{job_id}.{job['next_chunk'] + 1}"
+    return f"PrintJob-{job_id}"
+
+def submitted_pages(job):
+    # Pages in what is sent to CUPS next: the current chunk or the whole job
+    if job.get("chunks"):
+        return chunk_pages(job["chunks"][job["next_chunk"]])
+    return job.get("pages_total") or 0
+
+def cups_print_options(job, chunk_index=None):
+    # Callers hold jobs_lock. Options for a chunk (one copy, a page range;
+    # the next one by default) or the whole job.
+    options = {
+        "copies": str(job["copies"]),
+        "sides": job["sides"],
+        "ColorModel": "Gray" if job["color_mode"] == "bw" else "RGB"
+    }
+
+    if job.get("chunks"):
+        chunk = job["chunks"][job["next_chunk"] if chunk_index is None else chunk_index]
+        options["copies"] = "1"
+        options["page-ranges"] = f"{chunk[1]}-{chunk[2]}"
+
+    return options
+
+def render_options(cups_options):
+    # Copies are left to CUPS, so one render serves any number of them
+    return {k: v for k, v in cups_options.items() if k != "copies"}
+
+def enqueue_job(printer_name, job_id):
+    with jobs_lock:
+        job = jobs[job_id]
+        init_job_chunks(job)
+
+        user_id, priority = job["user_id"], job.get("priority", 0)
+        cost = next_chunk_papers(job)
+        file_path = job["file_path"]
+        options = render_options(cups_print_options(job))
+
+    printer_queues[printer_name].put(job_id, user_id, cost, priority)
+
+    if printer_name in RENDER_PRINTERS:
+        # Convert while the jobs ahead of it print
+        render_cache.prefetch(file_path, printer_name, options)
+
+def record_job_progress(job_id, job, pages):
+    # The CUPS job is forgotten in the same write, so a restart can't
+    # count its pages twice
+    with jobs_lock:
+        job["pages_printed"] = (job.get("pages_printed") or 0) + pages
+        job["next_chunk"] = job.get("next_chunk", 0) + 1
+        job["cups_submit_attempted"] = False
+        job["cups_job_id"] = None
+        pages_printed = job["pages_printed"]
+
+    conn = get_db()
+    conn.execute("""
+        UPDATE print_jobs
+        SET pages_printed = ?, cups_job_id = NULL
+        WHERE job_id = ?
+    """, (pages_printed, job_id))
+    conn.commit()
+
+def set_job_cups_id(job_id, cups_job_id):
+    conn = get_db()
+    conn.execute("""
+        UPDATE print_jobs
+        SET cups_job_id = ?
+        WHERE job_id = ?
+    """, (cups_job_id, job_id))
+    conn.commit()
+
+def set_job_priority(job_id, priority):
+    conn = get_db()
     cursor = conn.cursor()
 
     cursor.execute("""
-        SELECT job_id, status, filename, file_path, cancel_requested, created_at
-        FROM print_jobs
+        UPDATE print_jobs
+        SET priority = ?
         WHERE job_id = ?
-    """, (job_id,))
+    """, (priority, job_id))
 
-    row = cursor.fetchone()
-    conn.close()
+    conn.commit()
 
-    if not row:
-        return None
+def load_printer_speeds():
+    global printer_speeds_loaded_at
 
-    return {
-        "job_id": row[0],
-        "status": row[1],
-        "filename": row[2],
-        "file_path": row[3],
-        "cancel_requested": bool(row[4]),
-        "created_at": row[5]
-    }
-    
+    cursor = get_db().cursor()
+    cursor.execute("""
+        SELECT name, seconds_per_paper
+        FROM printers
+        WHERE seconds_per_paper IS NOT NULL
+    """)
+    speeds = dict(cursor.fetchall())
+
+    with printers_lock:
+        printer_speeds.update(speeds)
+        printer_speeds_loaded_at = time.monotonic()
+
+def seconds_per_paper(printer_name):
+    if PRINTER_ROLE == "api" and time.monotonic() - printer_speeds_loaded_at > PRINTER_STATUS_REFRESH_INTERVAL:
+        # The printer daemon measures; we only read
+        load_printer_speeds()
+
+    with printers_lock:
+        return printer_speeds.get(printer_name, ESTIMATED_SECONDS_PER_PAPER)
+
+def record_printer_speed(printer_name, papers, seconds):
+    # Fold one finished submission into the printer's observed speed
+    if papers <= 0 or seconds <= 0:
+        return
+
+    with printers_lock:
+        speed = printer_speeds.get(printer_name, ESTIMATED_SECONDS_PER_PAPER)
+        speed += PRINTER_SPEED_SMOOTHING * (seconds / papers - speed)
+        printer_speeds[printer_name] = speed
+
+    conn = get_db()
+    conn.execute("""
+        UPDATE printers
+        SET seconds_per_paper = ?
+        WHERE name = ?
+    """, (speed, printer_name))
+    conn.commit()
 
-def set_cancel_requested(job_id):
-    conn = sqlite3.connect(DB_PATH)
+def get_queue_from_db(printer_name):
+    """
+    get_queue() for API-only processes, from the rows a printer daemon
+    keeps up to date. The order is by priority and age; the daemon's
+    fair-share order between users isn't visible from here.
+    """
+    conn = get_db()
     cursor = conn.cursor()
 
     cursor.execute("""
-        UPDATE print_jobs
-        SET cancel_requested = 1
-        WHERE job_id = ?
-    """, (job_id,))
+        SELECT job_id, user_id, papers, priority, status
+        FROM print_jobs
+        WHERE printer_name = ? AND status IN (?, ?)
+        ORDER BY priority DESC, job_id
+    """, (printer_name, JOB_QUEUED, JOB_PRINTING))
+    rows = cursor.fetchall()
 
-    conn.commit()
-    conn.close()
+    start = time.time()
+    speed = seconds_per_paper(printer_name)
+
+    running = []
+    for job_id, user_id, papers, priority, job_status in rows:
+        if job_status == JOB_PRINTING:
+            start += papers * speed
+            running.append({
+                "job_id": job_id,
+                "user_id": user_id,
+                "papers": papers,
+                "estimated_finish": datetime.fromtimestamp(start, timezone.utc).isoformat()
+            })
+
+    queued = []
+    for job_id, user_id, papers, priority, job_status in rows:
+        if job_status == JOB_QUEUED:
+            entry = {
+                "job_id": job_id,
+                "user_id": user_id,
+                "papers": papers,
+                "priority": priority,
+                "position": len(queued),
+                "estimated_start": datetime.fromtimestamp(start, timezone.utc).isoformat()
+            }
+            start += papers * speed
+            entry["estimated_finish"] = datetime.fromtimestamp(start, timezone.utc).isoformat()
+            queued.append(entry)
+
+    return {"name": printer_name, "running": running, "queued": queued}
+
+def get_queue(printer_name):
+    """
+    Jobs running on and queued for a printer, in print order, each with an
+    estimated start time.
+    """
+    if PRINTER_ROLE == "api":
+        return get_queue_from_db(printer_name)
+
+    queue = printer_queues[printer_name]
+    now = time.time()
+    start = now
+    speed = seconds_per_paper(printer_name)
+
+    running = []
+    for entry in queue.running():
+        with jobs_lock:
+            printing_since = jobs.get(entry["job_id"], {}).get("printing_since", now)
+        start = max(start, printing_since + entry["cost"] * speed)
+        running.append({
+            "job_id": entry["job_id"],
+            "user_id": entry["user_id"],
+            "papers": entry["cost"],
+            "estimated_finish": datetime.fromtimestamp(start, timezone.utc).isoformat()
+        })
+
+    queued = []
+    for position, entry in enumerate(queue.order()):
+        item = {
+            "job_id": entry["job_id"],
+            "user_id": entry["user_id"],
+            "papers": entry["cost"],
+            "priority": entry["priority"],
+            "position": position,
+            "estimated_start": datetime.fromtimestamp(start, timezone.utc).isoformat()
+        }
+        start += entry["cost"] * speed
+        item["estimated_finish"] = datetime.fromtimestamp(start, timezone.utc).isoformat()
+        queued.append(item)
 
-def require_admin(user=Depends(get_current_user)):
-    if user["role"] != "admin":
-        raise HTTPException(status_code=403, detail="Admin access required")
-    return user
+    return {"name": printer_name, "running": running, "queued": queued}
 
-def get_printer_capabilities(printer_name: str):
-    conn = cups.Connection()
-    printers = conn.getPrinters()
+def get_queue_position(job_id, job=None):
+    # job is the caller's get_job() view, if it has one
+    with jobs_lock:
+        job = jobs.get(job_id) or job
+        printer_name = job.get("printer_name") if job else None
 
-    if printer_name not in printers:
-        raise RuntimeError("Printer not found")
+    if not job or job["status"] != JOB_QUEUED or printer_name not in printer_queues:
+        return {}
 
-    attrs = printers[printer_name]
+    for entry in get_queue(printer_name)["queued"]:
+        if entry["job_id"] == job_id:
+            return {
+                "queue_position": entry["position"],
+                "estimated_start": entry["estimated_start"]
+            }
 
-    # Duplex support
-    duplex = "sides-supported" in attrs and len(attrs["sides-supported"]) > 1
+    return {}
+
+def remaining_papers(job):
+    # Papers still to print, counting chunks already printed as done
+    pages_total = job.get("pages_total")
+    if not pages_total:
+        return job["papers"]
+    return job["papers"] * (pages_total - (job.get("pages_printed") or 0)) / pages_total
+
+def backlog_state():
+    """
+    What admission control looks at: {user_id: (jobs, papers)} for every
+    queued or printing job, and (finish, papers, user_id) estimates for
+    the printer queues' entries, soonest first.
+    """
+    per_user = {}
+
+    if PRINTER_ROLE == "api":
+        cursor = get_db().cursor()
+        cursor.execute("""
+            SELECT user_id, COUNT(*), SUM(
+                CASE WHEN pages_total > 0
+                THEN papers * (pages_total - pages_printed) * 1.0 / pages_total
+                ELSE papers END
+            )
+            FROM print_jobs
+            WHERE status IN (?, ?)
+            GROUP BY user_id
+        """, (JOB_QUEUED, JOB_PRINTING))
+        per_user = {r[0]: (r[1], r[2] or 0) for r in cursor.fetchall()}
+    else:
+        with jobs_lock:
+            for job in jobs.values():
+                if job["status"] in (JOB_QUEUED, JOB_PRINTING):
+                    count, papers = per_user.get(job["user_id"], (0, 0))
+                    per_user[job["user_id"]] = (count + 1, papers + remaining_papers(job))
+
+    finishes = []
+    for printer_name in list(printer_queues):
+        queue = get_queue(printer_name)
+        for entry in queue["running"] + queue["queued"]:
+            finish = datetime.fromisoformat(entry["estimated_finish"]).timestamp()
+            finishes.append((finish, entry["papers"], entry["user_id"]))
+
+    finishes.sort()
+    return per_user, finishes
+
+def admission_check(user_id, papers=0):
+    """
+    None if a job of `papers` papers from this user can be admitted now,
+    else (reason, seconds until enough of the backlog should have printed
+    for it to be).
+    """
+    per_user, finishes = backlog_state()
+    now = time.time()
+
+    def finished_after(count, finish_times):
+        # When the count-th of these jobs (1 = soonest) is expected to finish
+        if not finish_times:
+            return now
+        return finish_times[min(count, len(finish_times)) - 1]
+
+    user_jobs = per_user.get(user_id, (0, 0))[0]
+    if MAX_USER_ACTIVE_JOBS and user_jobs >= MAX_USER_ACTIVE_JOBS:
+        mine = [f for f, _, u in finishes if u == user_id]
+        until = finished_after(user_jobs - MAX_USER_ACTIVE_JOBS + 1, mine)
+        return f"You already have {user_jobs} jobs waiting to print", max(1.0, until - now)
+
+    total_jobs = sum(count for count, _ in per_user.values())
+    if MAX_BACKLOG_JOBS and total_jobs >= MAX_BACKLOG_JOBS:
+        until = finished_after(total_jobs - MAX_BACKLOG_JOBS + 1, [f for f, _, _ in finishes])
+        return "The print queue is full", max(1.0, until - now)
+
+    # A job bigger than the limit still gets in once the backlog is empty
+    total_papers = sum(p for _, p in per_user.values())
+    if MAX_BACKLOG_PAPERS and total_papers and total_papers + papers > MAX_BACKLOG_PAPERS:
+        excess = total_papers + papers - MAX_BACKLOG_PAPERS
+        until = finishes[-1][0] if finishes else now
+        freed = 0
+        for finish, entry_papers, _ in finishes:
+            freed += entry_papers
+            if freed >= excess:
+                until = finish
+                break
+        return "The print queue is full", max(1.0, until - now)
+
+    return None
+
+def accepted_start(job):
+    # A just-submitted job that is no longer queued has already started
+    return {"estimated_start": job.get("started_at") or datetime.now(timezone.utc).isoformat()}
+
+async def require_admission(user, papers=0):
+    """
+    Raise 429 with a Retry-After if the backlog can't take this user's
+    job. /print calls it once before reading the upload and, with
+    MAX_BACKLOG_PAPERS set, again once the papers are known.
+    """
+    if user["role"] == "admin":
+        return
+
+    if PRINTER_ROLE == "api":
+        rejected = await run_storage(admission_check, user["user_id"], papers)
+    else:
+        rejected = admission_check(user["user_id"], papers)
 
-    # Color support
-    color = (
-        "color-supported" in attrs and attrs["color-supported"]
-    ) or (
-        "ColorModel" in attrs
-    )
+    if rejected:
+        reason, retry_after = rejected
+        raise HTTPException(
+            status_code=429,
+            detail=f"{reason}, try again in about {math.ceil(retry_after / 60)} min",
+            headers={"Retry-After": str(math.ceil(retry_after))}
+        )
 
-    # Max copies (fallback to 1 if unknown)
-    max_copies = int(attrs.get("copies-supported", "1").split("-")[-1])
+def snapshot_entry(body):
+    if body is None:
+        return None
 
+    encoded = json.dumps(body, sort_keys=True).encode()
     return {
-        "duplex": duplex,
-        "color": color,
-        "max_copies": max_copies
+        "body": body,
+        "etag": '"%s"' % hashlib.sha1(encoded).hexdigest()
     }
 
-def get_printer_status(printer_name: str):
-    conn = cups.Connection()
-    printers = conn.getPrinters()
+def build_printer_snapshot(refreshed_at=None):
+    """
+    Recompute the status and capabilities bodies from the registry and
+    swap them in. Readers take the module-level dict without locking.
+    """
+    global printer_snapshot
 
-    if printer_name not in printers:
-        return {
-            "status": "offline",
-            "reason": "Printer not found"
-        }
+    with printers_lock:
+        pool = [dict(p) for p in printers.values()]
 
-    attrs = printers[printer_name]
-    state = attrs.get("printer-state")
-    reasons = attrs.get("printer-state-reasons", [])
+    statuses = [p["status"] for p in pool]
 
-    if state == 3:
+    if "idle" in statuses:
         status = "idle"
-    elif state == 4:
+    elif "printing" in statuses:
         status = "printing"
     else:
         status = "offline"
 
-    return {
+    status_body = {
         "status": status,
-        "reasons": reasons
+        "reasons": [] if pool else ["No printers registered"],
+        "printers": [
+            {"name": p["name"], "status": p["status"], "reasons": p["reasons"]}
+            for p in pool
+        ],
+        "stale": False
+    }
+
+    # What the pool as a whole can do, preferring printers that are online
+    online = [p for p in pool if p["status"] != "offline"]
+    if online:
+        pool = online
+
+    capabilities_body = None
+    if pool:
+        capabilities_body = {
+            "duplex": any(p["duplex"] for p in pool),
+            "color": any(p["color"] for p in pool),
+            "max_copies": max(p["max_copies"] for p in pool)
+        }
+
+    printer_snapshot = {
+        "refreshed_at": printer_snapshot["refreshed_at"] if refreshed_at is None else refreshed_at,
+        "status": snapshot_entry(status_body),
+        "capabilities": snapshot_entry(capabilities_body)
     }
 
+def get_printer_capabilities():
+    entry = printer_snapshot["capabilities"]
+
+    if entry is None:
+        raise RuntimeError("No printers available")
+
+    return entry
+
+def get_printer_status():
+    snapshot = printer_snapshot
+    entry = snapshot["status"]
+
+    if time.monotonic() - snapshot["refreshed_at"] > PRINTER_STATUS_STALE_AFTER:
+        body = dict(entry["body"])
+        body["status"] = "offline"
+        body["reasons"] = body["reasons"] + ["Printer status unavailable from CUPS"]
+        body["stale"] = True
+        return snapshot_entry(body)
+
+    return entry
+
+def etag_response(request, entry):
+    headers = {"ETag": entry["etag"], "Cache-Control": "private, no-cache"}
+
+    if request.headers.get("If-None-Match") == entry["etag"]:
+        return Response(status_code=304, headers=headers)
+
+    return JSONResponse(entry["body"], headers=headers)
+
+def check_printer_online(conn, printer_name):
+    try:
+        attrs = conn.getPrinterAttributes(
+            printer_name,
+            requested_attributes=[
+                "printer-state",
+                "printer-state-reasons",
+                "printer-is-accepting-jobs"
+            ]
+        )
+    except CupsUnavailable:
+        # cupsd itself is down; that says nothing about this printer
+        raise
+    except Exception:
+        attrs = {}
+
+    state = parse_printer_status(attrs)
+
+    changed = False
+    with printers_lock:
+        printer = printers.get(printer_name)
+        if printer and (printer["status"], printer["reasons"]) != (state["status"], state["reasons"]):
+            printer.update(state)
+            changed = True
+
+    if changed:
+        build_printer_snapshot()
+
+    return state["status"] != "offline"
+
 
 @app.get("/login", response_class=HTMLResponse)
 def login_page(request: Request):
@@ -394,59 +2895,78 @@ def change_password_page(request: Request):
     )
 
 @app.get("/quota")
-def get_quota(user=Depends(get_current_user)):
-    used = get_monthly_paper_usage(user["user_id"])
+async def get_quota(user=Depends(get_current_user)):
+    used = await run_storage(get_monthly_paper_usage, user["user_id"])
     return {
         "used": used,
         "limit": MONTHLY_PAPER_QUOTA
     }
     
 @app.get("/printer/capabilities")
-def printer_capabilities(user=Depends(get_current_user)):
+def printer_capabilities(request: Request, user=Depends(get_current_user)):
     try:
-        return get_printer_capabilities(PRINTER_NAME)
+        return etag_response(request, get_printer_capabilities())
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/printer/status")
-def printer_status(user=Depends(get_current_user)):
-    return get_printer_status(PRINTER_NAME)
+def printer_status(request: Request, user=Depends(get_current_user)):
+    return etag_response(request, get_printer_status())
+
+@app.get("/printers")
+def list_printers(user=Depends(get_current_user)):
+    with printers_lock:
+        return [dict(p) for p in printers.values()]
+
+@app.post("/admin/printers/discover")
+def rediscover_printers(admin=Depends(require_admin)):
+    try:
+        discover_printers()
+    except CupsUnavailable as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    if "workers" in started_subsystems:
+        start_printer_workers()
+    return list_printers(admin)
+
+@app.post("/admin/printer/{printer_name}/enable")
+def enable_printer(printer_name: str, admin=Depends(require_admin)):
+    if not set_printer_enabled(printer_name, True):
+        raise HTTPException(status_code=404, detail="Printer not found")
+    return rediscover_printers(admin)
+
+@app.post("/admin/printer/{printer_name}/disable")
+def disable_printer(printer_name: str, admin=Depends(require_admin)):
+    if not set_printer_enabled(printer_name, False):
+        raise HTTPException(status_code=404, detail="Printer not found")
+    return rediscover_printers(admin)
     
     
 @app.post("/login")
-def login(
+async def login(
+    request: Request,
     username: str = Form(...),
     password: str = Form(...)
 ):
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-
-    cursor.execute("""
-        SELECT user_id, password_hash, role, must_change_password
-        FROM users
-        WHERE username = ?
-    """, (username,))
+    check_rate_limit(login_ip_limiter, request.client.host if request.client else "")
+    check_rate_limit(login_user_limiter, username)
 
-    row = cursor.fetchone()
-    conn.close()
+    row = await run_storage(get_login_row, username)
 
     # ❌ Invalid username OR password
-    if not row or not verify_password(password, row[1]):
+    if not row or not await run_password_work(verify_password, password, row[1]):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid credentials"
         )
 
-    # ✅ Valid login
-    token = str(uuid.uuid4())
+    # ✅ Valid login; only failures count against the username
+    login_user_limiter.reset(username)
 
-    tokens[token] = {
-        "user_id": row[0],
-        "username": username,
-        "role": row[2],
-        "must_change_password": row[3],
-        "token": token
-    }
+    if password_needs_rehash(row[1]):
+        new_hash = await run_password_work(hash_password, password)
+        await run_storage(set_password_hash, row[0], new_hash)
+
+    token = await run_storage(create_session, row[0])
 
     return {
         "token": token,
@@ -455,15 +2975,24 @@ def login(
     }
 
     
-@app.post("/print")
-def submit_print(
-    file: UploadFile = File(...),
-    copies: int = Form(1),
-    color_mode: str = Form("bw"),
-    sides: str = Form("one-sided"),
-    user=Depends(require_password_change_complete)
-):
-    
+@app.post("/logout")
+def logout(user=Depends(get_current_user)):
+    delete_session(user["token"])
+    return {"message": "Logged out"}
+
+def print_options(fields):
+    """
+    copies, color_mode and sides from /print's form fields (raw bytes),
+    with the form's defaults.
+    """
+    try:
+        copies = int(fields.get("copies", b"1"))
+    except ValueError:
+        copies = 0
+
+    color_mode = fields.get("color_mode", b"bw").decode("utf-8", "replace")
+    sides = fields.get("sides", b"one-sided").decode("utf-8", "replace")
+
     if copies < 1 or copies > 50:
         raise HTTPException(status_code=400, detail="Invalid number of copies")
 
@@ -473,78 +3002,123 @@ def submit_print(
     if sides not in ("one-sided", "two-sided-long-edge"):
         raise HTTPException(status_code=400, detail="Invalid sides option")
 
-    # Admins are exempt
-    if user["role"] != "admin":
-        file_path = os.path.join(UPLOAD_DIR, file.filename)
-
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+    return copies, color_mode, sides
 
-        pdf_pages = count_pdf_pages(file_path)
+@app.post("/print")
+async def submit_print(request: Request, user=Depends(require_password_change_complete)):
+    # The body is read here, not through File()/Form() parameters: FastAPI
+    # receives and spools a whole multipart body before the endpoint runs,
+    # and nothing below could turn an upload away until then
 
-        papers = calculate_papers(
-            pages=pdf_pages,
-            copies=copies,
-            sides=sides
+    content_length = request.headers.get("content-length", "")
+    if content_length.isdigit() and int(content_length) > MAX_UPLOAD_BYTES + MAX_FORM_OVERHEAD_BYTES:
+        raise HTTPException(
+            status_code=413,
+            detail=f"File too large (max {MAX_UPLOAD_BYTES // (1024 * 1024)} MB)"
         )
 
-        used_papers = get_monthly_paper_usage(user["user_id"])
+    # The per-user and job-count limits need nothing from the upload, so
+    # they are checked before reading any of the body. The paper limit
+    # has to wait for the page count.
+    await require_admission(user)
+
+    fields = {}
+    file = {}
+    upload = await ingest_upload(form_file_chunks(request, fields, file))
 
-        if used_papers + papers > MONTHLY_PAPER_QUOTA:
-            os.remove(file_path)
+    try:
+        copies, color_mode, sides = print_options(fields)
+
+        # Reads the database for printer loads in api mode
+        printer_name = await run_storage(choose_printer, color_mode, sides, copies)
+
+        if printer_name is None:
             raise HTTPException(
-                status_code=403,
-                detail=(
-                f"Monthly paper quota exceeded. "
-                f"Used {used_papers}/{MONTHLY_PAPER_QUOTA} papers."
-                )
+                status_code=503,
+                detail="No printer available for the selected options"
             )
+    except HTTPException:
+        os.remove(upload["part_path"])
+        raise
 
-    else:
-        file_path = os.path.join(UPLOAD_DIR, file.filename)
+    blob = await run_storage(store_blob, upload)
+    file_path = blob["path"]
 
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+    papers = calculate_papers(
+        pages=blob["pages"],
+        copies=copies,
+        sides=sides
+    )
 
-        pdf_pages = count_pdf_pages(file_path)
-        papers = calculate_papers(
-            pages=pdf_pages,
-            copies=copies,
-            sides=sides
-        )
-        
-    # Insert job
-    job_id = insert_job(
+    if MAX_BACKLOG_PAPERS:
+        await require_admission(user, papers)
+
+    # Admins are exempt; everyone else reserves quota in the same
+    # transaction that inserts the job. A rejected upload stays in the
+    # blob store until garbage collection.
+    created_at = datetime.now(timezone.utc).isoformat()
+    job_id = await run_storage(
+        insert_job,
         user_id=user["user_id"],
         status=JOB_QUEUED,
-        filename=file.filename,
+        filename=file["filename"],
         file_path=file_path,
-        papers=papers
+        papers=papers,
+        printer_name=printer_name,
+        quota_limit=None if user["role"] == "admin" else MONTHLY_PAPER_QUOTA,
+        file_sha256=blob["sha256"],
+        pages=blob["pages"],
+        pages_total=blob["pages"] * copies,
+        copies=copies,
+        color_mode=color_mode,
+        sides=sides,
+        created_at=created_at,
+        claimed_by=None if PRINTER_ROLE == "api" else PRINTER_DAEMON_ID
     )
-    # Cache in memory
-    with jobs_lock:
-        jobs[job_id] = {
+
+    job = {
             "job_id": job_id,
             "user_id": user["user_id"],
             "status": JOB_QUEUED,
-            "filename": file.filename,
+            "filename": file["filename"],
             "file_path": file_path,
             "papers": papers,
             "copies": copies,
             "color_mode": color_mode,
             "sides": sides,
+            "printer_name": printer_name,
+            "priority": 0,
+            "pages": blob["pages"],
+            "pages_total": blob["pages"] * copies,
+            "pages_printed": 0,
+            "cups_job_id": None,
+            "created_at": created_at,
             "cancel_requested": False
         }
 
+    publish_job_status(job_id, JOB_QUEUED, job)
+
+    if PRINTER_ROLE == "api":
+        # A printer daemon claims it from the database
+        response = submit_response(job)
+        response.update(await run_storage(get_queue_position, job_id, job) or accepted_start(job))
+        return response
+
+    # Cache in memory and enqueue
+    with jobs_lock:
+        jobs[job_id] = job
 
+    enqueue_job(printer_name, job_id)
 
-    # Enqueue
-    print_queue.put(job_id)
+    with jobs_lock:
+        response = submit_response(job)
+        started = accepted_start(job)
 
-    return jobs[job_id]
+    response.update(get_queue_position(job_id) or started)
+    return response
 
 @app.post("/change-password")
-def change_password(
+async def change_password(
     old_password: str = Form(...),
     new_password: str = Form(...),
     user=Depends(get_current_user)
@@ -562,198 +3136,696 @@ def change_password(
             detail="Password must be at least 10 characters and include uppercase, lowercase, number, and symbol."
         )
 
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
+    check_rate_limit(login_user_limiter, user["username"])
 
-    cursor.execute(
-        "SELECT password_hash FROM users WHERE user_id = ?",
-        (user["user_id"],)
-    )
-    stored_hash = cursor.fetchone()[0]
+    stored_hash = await run_storage(get_password_hash, user["user_id"])
 
-    if not verify_password(old_password, stored_hash):
-        conn.close()
+    if not await run_password_work(verify_password, old_password, stored_hash):
         raise HTTPException(status_code=401, detail="Old password incorrect")
 
-    cursor.execute("""
-        UPDATE users
-        SET password_hash = ?, must_change_password = 0
-        WHERE user_id = ?
-    """, (
-        hash_password(new_password),
-        user["user_id"]
-    ))
+    login_user_limiter.reset(user["username"])
 
-    conn.commit()
-    conn.close()
+    new_hash = await run_password_work(hash_password, new_password)
+    await run_storage(set_password_hash, user["user_id"], new_hash, True)
     
-    token = user["token"]
-    if token in tokens:
-        tokens[token]["must_change_password"] = 0
+    # Update this user's cached sessions in this process; other processes
+    # re-read the flag when they next see it set
+    with sessions_lock:
+        for entry in session_cache.values():
+            if entry["user"]["user_id"] == user["user_id"]:
+                entry["user"]["must_change_password"] = 0
         
     return {"message": "Password updated successfully"}
 
 @app.get("/job/{job_id}")
-def job_status(job_id: int):
-    job = get_job_from_db(job_id)
+async def job_status(job_id: int):
+    job = peek_job(job_id) or await run_storage(get_job, job_id)
 
     if not job:
         return {"error": "Job not found"}
 
+    if PRINTER_ROLE == "api":
+        # Queue positions come from the database here
+        job.update(await run_storage(get_queue_position, job_id, job))
+    else:
+        job.update(get_queue_position(job_id, job))
+
     return job
     
-@app.get("/jobs")
-def my_jobs(user=Depends(require_password_change_complete)):
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
+async def job_event_stream(request: Request, key, load_initial=None, until_final=False):
+    """
+    Server-Sent Events body: the events returned by load_initial(), read
+    after subscribing so no change slips in between, then everything
+    published under `key` until the client goes away (or, with
+    until_final, until a job reaches a final status).
+    """
+    subscriber = job_event_hub.subscribe(key)
+    queue = subscriber[1]
 
-    cursor.execute("""
-    SELECT job_id, filename, status, papers, created_at
-    FROM print_jobs
-    WHERE user_id = ?
-    ORDER BY job_id DESC
-""", (user["user_id"],))
+    try:
+        initial = await run_storage(load_initial) if load_initial else []
+
+        for event in initial:
+            yield f"event: job\ndata: {json.dumps(event)}\n\n"
+            if until_final and event["status"] in JOB_FINAL_STATUSES:
+                return
+
+        while not await request.is_disconnected():
+            try:
+                event = await asyncio.wait_for(queue.get(), SSE_KEEPALIVE_INTERVAL)
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+                continue
 
+            yield f"event: job\ndata: {json.dumps(event)}\n\n"
 
-    rows = cursor.fetchall()
-    conn.close()
+            if until_final and event["status"] in JOB_FINAL_STATUSES:
+                return
 
-    return [
-    {
-        "job_id": r[0],
-        "filename": r[1],
-        "status": r[2],
-        "papers": r[3],
-        "created_at": r[4]
+    finally:
+        job_event_hub.unsubscribe(key, subscriber)
+
+def event_stream_response(body):
+    return StreamingResponse(
+        body,
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no"
+        }
+    )
+
+@app.post("/events/ticket")
+async def stream_ticket(user=Depends(get_current_user)):
+    ticket = await run_storage(create_stream_ticket, user["token"])
+    return {"ticket": ticket, "expires_in": STREAM_TICKET_TTL}
+
+@app.get("/job/{job_id}/events")
+async def job_events(job_id: int, request: Request, user=Depends(get_stream_user)):
+    job = await run_storage(get_job, job_id)
+
+    if not job or (user["role"] != "admin" and job["user_id"] != user["user_id"]):
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    def current_status():
+        job = get_job(job_id)
+        event = {"job_id": job_id, "status": job["status"], **get_queue_position(job_id, job)}
+        if job["pages_total"]:
+            event["pages_printed"] = job["pages_printed"]
+            event["pages_total"] = job["pages_total"]
+        return [event]
+
+    body = job_event_stream(
+        request,
+        ("job", job_id),
+        load_initial=current_status,
+        until_final=True
+    )
+
+    return event_stream_response(body)
+
+@app.get("/jobs/events")
+async def my_job_events(request: Request, user=Depends(get_stream_user)):
+    if user["role"] == "admin":
+        key = ("all",)
+    else:
+        key = ("user", user["user_id"])
+
+    return event_stream_response(job_event_stream(request, key))
+
+@app.get("/jobs")
+async def my_jobs(
+    after_job_id: Optional[int] = None,
+    limit: int = Query(JOBS_PAGE_SIZE, ge=1, le=JOBS_MAX_PAGE_SIZE),
+    status_filter: Optional[str] = Query(None, alias="status"),
+    created_from: Optional[str] = None,
+    created_to: Optional[str] = None,
+    user=Depends(require_password_change_complete)
+):
+    page, next_after_job_id = await run_storage(
+        list_jobs_page,
+        user_id=user["user_id"],
+        after_job_id=after_job_id,
+        limit=limit,
+        status=status_filter,
+        created_from=parse_created_filter(created_from),
+        created_to=parse_created_filter(created_to)
+    )
+
+    return {
+        "jobs": page,
+        "next_after_job_id": next_after_job_id
     }
-    for r in rows
-]
 
 
     
     
+def request_cancel(job_id):
+    """
+    Cancel a queued job at once, or ask the worker printing it to stop.
+    A job held by another process is cancelled through the database; its
+    daemon picks the flag up on its next sync.
+    """
+    with jobs_lock:
+        job = jobs.get(job_id)
+        status = job["status"] if job else None
+
+        if job:
+            job["cancel_requested"] = True
+
+    if not set_cancel_requested(job_id) and job is None:
+        stored = get_job(job_id)
+        if not stored:
+            return {"error": "Job not found"}
+        return {"error": f"Cannot cancel job in state '{stored['status']}'"}
+
+    # If a worker starts it first, this is a cancel of a printing job
+    if status == JOB_QUEUED and transition_job(job_id, job, JOB_CANCELLED, expected=(JOB_QUEUED,)):
+        if job.get("printer_name") in printer_queues:
+            printer_queues[job["printer_name"]].remove(job_id)
+        return {"message": "Job cancelled (queued)"}
+
+    if job is None and update_job_status(job_id, JOB_CANCELLED, from_statuses=(JOB_QUEUED,)):
+        return {"message": "Job cancelled (queued)"}
+
+    if job:
+        cups_job_tracker.wake()
+    return {"message": "Cancel requested (printing)"}
+
 @app.post("/admin/job/{job_id}/cancel")
 def cancel_job(job_id: int, admin=Depends(require_admin)):
+    return request_cancel(job_id)
+
+
+@app.post("/admin/job/{job_id}/priority")
+def set_priority(job_id: int, priority: int = Form(...), admin=Depends(require_admin)):
     with jobs_lock:
         job = jobs.get(job_id)
 
-        if not job:
-            return {"error": "Job not found"}
+        if job and job["status"] == JOB_QUEUED:
+            job["priority"] = priority
+            if job["printer_name"] in printer_queues:
+                printer_queues[job["printer_name"]].set_priority(job_id, priority)
 
-        if job["status"] == JOB_QUEUED:
-            job["status"] = JOB_CANCELLED
-            job["cancel_requested"] = True
-            update_job_status(job_id, JOB_CANCELLED)
-            set_cancel_requested(job_id)
-            return {"message": "Job cancelled (queued)"}
+    if not job:
+        # Held by a printer daemon, which applies it on its next sync
+        job = get_job(job_id)
 
-        if job["status"] == JOB_PRINTING:
-            job["cancel_requested"] = True
-            set_cancel_requested(job_id)
-            return {"message": "Cancel requested (printing)"}
+    if not job or job["status"] != JOB_QUEUED:
+        raise HTTPException(status_code=409, detail="Only queued jobs can be reprioritised")
 
-        return {"error": f"Cannot cancel job in state '{job['status']}'"}
+    set_job_priority(job_id, priority)
+    return get_queue(job["printer_name"])
 
-        
-@app.get("/admin/jobs")
-def list_all_jobs(admin=Depends(require_admin)):
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
+@app.post("/admin/job/{job_id}/move")
+def move_job(job_id: int, position: int = Form(...), admin=Depends(require_admin)):
+    with jobs_lock:
+        job = jobs.get(job_id)
 
-    cursor.execute("""
-        SELECT job_id, status, filename, papers, created_at
-        FROM print_jobs
-        ORDER BY job_id DESC
-    """)
+        if not job or job["status"] != JOB_QUEUED:
+            if not job and PRINTER_ROLE == "api":
+                raise HTTPException(
+                    status_code=409,
+                    detail="Jobs held by a printer daemon can only be reprioritised"
+                )
+            raise HTTPException(status_code=409, detail="Only queued jobs can be moved")
 
-    rows = cursor.fetchall()
-    conn.close()
+        queue = printer_queues.get(job["printer_name"])
+        priority = queue.move(job_id, position) if queue else None
+        if priority is None:
+            raise HTTPException(status_code=409, detail="Job is not waiting in a queue")
+        job["priority"] = priority
 
-    return [
-        {
-            "job_id": r[0],
-            "status": r[1],
-            "filename": r[2],
-            "papers":r[3],
-            "created_at": r[4]
-        }
-        for r in rows
-    ]   
+    set_job_priority(job_id, priority)
+    return get_queue(job["printer_name"])
+
+@app.get("/queue")
+def queue_status(user=Depends(get_current_user)):
+    # Other users' jobs are shown without their owner
+    result = [get_queue(name) for name in list(printer_queues)]
+
+    if user["role"] != "admin":
+        for printer in result:
+            for entry in printer["running"] + printer["queued"]:
+                entry["mine"] = entry.pop("user_id") == user["user_id"]
+
+    return {"printers": result}
+
+@app.get("/admin/storage")
+def storage_stats(admin=Depends(require_admin)):
+    return get_blob_stats()
+
+@app.post("/admin/storage/gc")
+def storage_gc(admin=Depends(require_admin)):
+    return {"removed": collect_garbage_blobs(), **get_blob_stats()}
+
+def job_counts_by_printer(status):
+    """
+    Queued or printing jobs per printer. API-only processes hold no
+    queues, so they count the shared database instead.
+    """
+    if PRINTER_ROLE == "api":
+        cursor = get_db().cursor()
+        cursor.execute("""
+            SELECT printer_name, COUNT(*)
+            FROM print_jobs
+            WHERE status = ?
+            GROUP BY printer_name
+        """, (status,))
+        return {(name,): count for name, count in cursor.fetchall()}
+
+    if status == JOB_QUEUED:
+        return {(name,): queue.depth() for name, queue in list(printer_queues.items())}
+    return {(name,): len(queue.running()) for name, queue in list(printer_queues.items())}
+
+metrics_registry.gauge(
+    "printer_queue_depth",
+    "Jobs waiting per printer",
+    ("printer",),
+    callback=lambda: job_counts_by_printer(JOB_QUEUED)
+)
+metrics_registry.gauge(
+    "printer_jobs_printing",
+    "Jobs being printed per printer",
+    ("printer",),
+    callback=lambda: job_counts_by_printer(JOB_PRINTING)
+)
+metrics_registry.gauge(
+    "printer_event_stream_subscribers",
+    "Open job event streams",
+    callback=job_event_hub.subscriber_count
+)
+metrics_registry.gauge(
+    "printer_cups_circuit_open",
+    "1 while calls to cupsd fail fast",
+    callback=lambda: int(cups_client.breaker.is_open)
+)
+
+@app.get("/metrics")
+def get_metrics(authorization: Optional[str] = Header(None)):
+    if METRICS_TOKEN and not secrets.compare_digest(authorization or "", f"Bearer {METRICS_TOKEN}"):
+        raise HTTPException(status_code=401, detail="Invalid metrics token")
+
+    return Response(metrics_registry.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/admin/jobs")
+def list_all_jobs(
+    after_job_id: Optional[int] = None,
+    limit: int = Query(JOBS_PAGE_SIZE, ge=1, le=JOBS_MAX_PAGE_SIZE),
+    status_filter: Optional[str] = Query(None, alias="status"),
+    created_from: Optional[str] = None,
+    created_to: Optional[str] = None,
+    admin=Depends(require_admin)
+):
+    page, next_after_job_id = list_jobs_page(
+        after_job_id=after_job_id,
+        limit=limit,
+        status=status_filter,
+        created_from=parse_created_filter(created_from),
+        created_to=parse_created_filter(created_to)
+    )
+
+    return {
+        "jobs": page,
+        "next_after_job_id": next_after_job_id
+    }
     
-def print_worker():
+def wait_for_cups(error):
+    delay = max(cups_client.breaker.retry_after(), CUPS_RESET_TIMEOUT)
+    print(f"{error}; retrying in {delay:.1f}s")
+    shutdown_requested.wait(delay)
+
+def requeue_job(job_id, job, print_queue, error):
+    # A CUPS outage isn't the job's fault: put it back instead of failing it
+    transition_job(job_id, job, JOB_QUEUED, expected=(JOB_PRINTING,))
+
+    wait_for_cups(error)
+    print_queue.requeue(job_id)
+
+def cups_job_by_title(cups_jobs, title):
+    # Skip earlier attempts that went nowhere: a stream that broke off is
+    # cancelled (or, if that failed too, left held without its document
+    # until cupsd aborts it)
+    for cups_job_id, attrs in sorted(cups_jobs.items(), reverse=True):
+        if attrs.get("job-name") != title:
+            continue
+        if attrs.get("job-state") in (IPP_JOB_HELD, IPP_JOB_CANCELED, IPP_JOB_ABORTED):
+            continue
+        return cups_job_id
+
+    return None
+
+def stream_document(conn, printer_name, data, title, options, document_format):
+    """
+    Create a CUPS job and send `data` (the document's memory map) as its
+    only document, a chunk at a time, on one connection (see
+    cups_client.run). A job left half-sent is cancelled.
+    """
+    cups_job_id = conn.createJob(printer_name, title, options)
+
+    try:
+        status = conn.startDocument(printer_name, cups_job_id, title, document_format, 1)
+
+        for offset in range(0, len(data), CUPS_STREAM_CHUNK_SIZE):
+            if status != cups.HTTP_CONTINUE:
+                break
+            piece = data[offset:offset + CUPS_STREAM_CHUNK_SIZE]
+            status = conn.writeRequestData(piece, len(piece))
+
+        if status != cups.HTTP_CONTINUE:
+            raise cups.HTTPError(status)
+
+        conn.finishDocument(printer_name)
+
+    except Exception:
+        try:
+            conn.cancelJob(cups_job_id)
+        except Exception:
+            pass
+        raise
+
+    return cups_job_id
+
+def find_cups_job(title):
+    # Jobs are submitted as PrintJob-<id> (PrintJob-<id>.<chunk> when
+    # chunked), so a submission whose reply was lost can be found by name
+    cups_jobs = cups_client.getJobs(which_jobs="all", requested_attributes=["job-name", "job-state"])
+
+    return cups_job_by_title(cups_jobs, title)
+
+def print_worker(printer_name):
+    cups_conn = cups_client
+    print_queue = printer_queues[printer_name]
+
     while True:
         job_id = print_queue.get()
 
+        if job_id is None:
+            # Shutting down
+            return
+
         with jobs_lock:
             job = jobs.get(job_id)
 
             if not job or job["status"] == JOB_CANCELLED:
-                print_queue.task_done()
+                print_queue.done(job_id)
                 continue
 
-            job["status"] = JOB_PRINTING
-            update_job_status(job_id, JOB_PRINTING)
+        # Don't let an offline printer hold jobs another printer could print
+        with printers_lock:
+            registered = printer_name in printers
 
         try:
-            print(f"Sending job {job_id} to CUPS")
+            online = registered and check_printer_online(cups_conn, printer_name)
+        except CupsUnavailable as e:
+            requeue_job(job_id, job, print_queue, e)
+            continue
+
+        if not online:
+            other = choose_printer(
+                job.get("color_mode", "bw"),
+                job.get("sides", "one-sided"),
+                job.get("copies", 1),
+                exclude=(printer_name,),
+                online_only=registered
+            )
+            if other:
+                print(f"Printer {printer_name} offline, moving job {job_id} to {other}")
+                print_queue.done(job_id)
+                assign_job_to_printer(job_id, other)
+            else:
+                shutdown_requested.wait(PRINTER_OFFLINE_RETRY)
+                print_queue.requeue(job_id)
 
-    # 1️⃣ Submit job to CUPS
-            cups_options = {
-                "copies": str(job["copies"]),
-                "sides": job["sides"]
-            }
+            continue
 
-            if job["color_mode"] == "bw":
-                cups_options["ColorModel"] = "Gray"
-            else:
-                cups_options["ColorModel"] = "RGB"
+        if not job.get("cups_job_id"):
+            owned, cancel = check_job_claim(job_id)
 
-            cups_job_id = cups_conn.printFile(
-                PRINTER_NAME,
-                job["file_path"],
-                f"PrintJob-{job_id}",
-                cups_options
-            )
+            if not owned:
+                # Another daemon took the job over
+                print(f"Job {job_id} is no longer held here, dropping it")
+                with jobs_lock:
+                    jobs.pop(job_id, None)
+                print_queue.done(job_id)
+                continue
 
+            if cancel:
+                with jobs_lock:
+                    job["cancel_requested"] = True
 
-            print(f"CUPS job id: {cups_job_id}")
+        with jobs_lock:
+            # Cancelled before it got to CUPS
+            cancelled = job["cancel_requested"] and not job.get("cups_job_id")
 
-    # 2️⃣ Poll CUPS job state
-            while True:
-                time.sleep(1)
+            job["printing_since"] = printing_since = time.time()
+            chunks = job.get("chunks")
+            chunk_index = job.get("next_chunk", 0)
+
+        if cancelled:
+            transition_job(job_id, job, JOB_CANCELLED)
+            print_queue.done(job_id)
+            continue
+
+        with jobs_lock:
+            status = job["status"]
+
+        if status != JOB_PRINTING and not transition_job(job_id, job, JOB_PRINTING, expected=(JOB_QUEUED,)):
+            # Cancelled while the printer was being checked, here or
+            # through another process
+            with jobs_lock:
+                job["status"] = JOB_CANCELLED
+                job["cancel_requested"] = True
+                retire_job(job_id)
+            print_queue.done(job_id)
+            continue
+
+        try:
+            print(f"Sending job {job_id} to CUPS ({printer_name})")
+
+    # 1️⃣ Submit job to CUPS
+            with jobs_lock:
+                cups_options = cups_print_options(job)
+                title = job_title(job_id, job)
+                pages = submitted_pages(job)
+                papers = next_chunk_papers(job)
+
+            # Set when the job was already in CUPS before a restart
+            cups_job_id = job.get("cups_job_id")
+            timed = cups_job_id is None
+
+            if cups_job_id is None and job.get("cups_submit_attempted"):
+                cups_job_id = find_cups_job(title)
+
+            if cups_job_id is None:
+                file_path = job["file_path"]
+                document_format = cups.CUPS_FORMAT_AUTO
+
+                if printer_name in RENDER_PRINTERS:
+                    rendered = render_cache.get(file_path, printer_name, render_options(cups_options))
+                    render_lookups.inc("hit" if rendered else "miss")
+
+                    if rendered:
+                        # Already device data; CUPS passes it straight through
+                        file_path = rendered
+                        document_format = cups.CUPS_FORMAT_RAW
+                        cups_options = {"copies": cups_options["copies"], "raw": "true"}
+
+                # Opened here, not inside the CUPS client: a missing or
+                # unreadable file fails the job instead of counting as a
+                # cupsd outage and tripping the breaker for every printer
+                with open(file_path, "rb") as f:
+                    job["cups_submit_attempted"] = True
+
+                    if CUPS_SUBMIT_MODE == "stream":
+                        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                            cups_job_id = cups_conn.run(
+                                stream_document,
+                                printer_name,
+                                data,
+                                title,
+                                cups_options,
+                                document_format,
+                                name="streamDocument"
+                            )
+                    else:
+                        cups_job_id = cups_conn.printFile(
+                            printer_name,
+                            file_path,
+                            title,
+                            cups_options
+                        )
+
+            if cups_job_id != job.get("cups_job_id"):
+                job["cups_job_id"] = cups_job_id
+                set_job_cups_id(job_id, cups_job_id)
+
+            if BLOB_RETENTION_SECONDS <= 0 and not (chunks and chunk_index + 1 < len(chunks)):
+                # cupsd has its own copy of the last piece now
+                release_blob(job_id, job)
 
-        # Fetch job info from CUPS
-                cups_jobs = cups_conn.getJobs(which_jobs="not-completed")
 
-        # 3️⃣ Check cancellation request (from DB)
+            print(f"CUPS job id: {cups_job_id}")
+            request_printer_refresh()
+
+            if printer_name in RENDER_PRINTERS and chunks and chunk_index + 1 < len(chunks):
+                # Have the next chunk ready by the time this one is done
                 with jobs_lock:
-                    db_job = get_job_from_db(job_id)
-                    if db_job and db_job["cancel_requested"]:
-                        print(f"Cancelling CUPS job {cups_job_id}")
-                        cups_conn.cancelJob(PRINTER_NAME, cups_job_id)
+                    options = render_options(cups_print_options(job, chunk_index + 1))
+                render_cache.prefetch(job["file_path"], printer_name, options)
 
-                        job["status"] = JOB_CANCELLED
-                        update_job_status(job_id, JOB_CANCELLED)
-                        break
+    # 2️⃣ Follow the CUPS job until it finishes or a cancel is requested
+            def cancel_requested():
+                with jobs_lock:
+                    return job["cancel_requested"]
+
+            # The job is in CUPS now, so an outage from here on just
+            # means waiting for cupsd to come back
+            cups_state = None
+            while True:
+                try:
+                    cups_state = cups_job_tracker.wait(cups_job_id, cancel_requested)
 
-        # 4️⃣ Check if CUPS job is done
-                if cups_job_id not in cups_jobs:
-                    with jobs_lock:
-                        job["status"] = JOB_COMPLETED
-                        update_job_status(job_id, JOB_COMPLETED)
-                        print(f"Job {job_id} completed")
+    # 3️⃣ Cancel requested by an admin
+                    if cups_state is None:
+                        print(f"Cancelling CUPS job {cups_job_id}")
+                        cups_conn.cancelJob(cups_job_id)
+                        cups_state = IPP_JOB_CANCELED
                     break
+                except CupsUnavailable as e:
+                    if shutdown_requested.is_set():
+                        break
+                    wait_for_cups(e)
+
+            if cups_state is None:
+                # Shutting down with cupsd away: the job stays printing
+                # and claimed, and the next start follows it from its
+                # CUPS job id
+                print(f"Job {job_id} left printing in CUPS job {cups_job_id}")
+                return
+
+    # 4️⃣ Record the final state, or go back in line for the next chunk
+            if cups_state == IPP_JOB_COMPLETED:
+                record_job_progress(job_id, job, pages)
+                if timed:
+                    record_printer_speed(printer_name, papers, time.time() - printing_since)
+
+            if cups_state == IPP_JOB_COMPLETED and chunks and chunk_index + 1 < len(chunks):
+                if not cancel_requested():
+                    publish_job_status(job_id, JOB_PRINTING)
+                    print_queue.done(job_id)
+
+                    # A new copy can go to whichever printer is least busy
+                    next_printer = printer_name
+                    if chunks[chunk_index + 1][0] != chunks[chunk_index][0]:
+                        next_printer = choose_printer(
+                            job["color_mode"], job["sides"], 1, online_only=True
+                        ) or printer_name
+
+                    if next_printer == printer_name:
+                        enqueue_job(printer_name, job_id)
+                    else:
+                        assign_job_to_printer(job_id, next_printer)
+                    continue
+
+                final_status = JOB_CANCELLED
+            elif cups_state == IPP_JOB_COMPLETED:
+                final_status = JOB_COMPLETED
+            elif cups_state == IPP_JOB_CANCELED:
+                final_status = JOB_CANCELLED
+            else:
+                final_status = JOB_FAILED
 
+            finish_job(job_id, job, final_status)
 
-        except Exception as e:
-            with jobs_lock:
-                job["status"] = JOB_FAILED
-                update_job_status(job_id, JOB_FAILED)
-                print(f"Job {job_id} failed:", e)
 
-        finally:
-            print_queue.task_done()
+        except CupsUnavailable as e:
+            requeue_job(job_id, job, print_queue, e)
+            continue
 
+        except Exception as e:
+            transition_job(job_id, job, JOB_FAILED)
+            print(f"Job {job_id} failed:", e)
 
-worker_thread = threading.Thread(target=print_worker, daemon=True)
-worker_thread.start()
+        finally:
+            request_printer_refresh()
+
+        print_queue.done(job_id)
+
+
+
+startup_lock = threading.Lock()
+started_subsystems = set()
+
+def start_background(target):
+    threading.Thread(target=target, daemon=True).start()
+
+def start_app(subsystems=None):
+    """
+    Bring up `subsystems` (PRINTER_SUBSYSTEMS by default). Ones already
+    running are left alone, so this is safe to call more than once, e.g.
+    by a script and then by the lifespan of the app it serves. It can't
+    be called again after stop_app(): a worker still draining would be
+    running twice.
+    """
+    wanted = PRINTER_SUBSYSTEMS if subsystems is None else set(subsystems)
+
+    if shutdown_requested.is_set():
+        raise RuntimeError("stop_app() has run; start a new process instead")
+
+    with startup_lock:
+        if "db" in wanted and "db" not in started_subsystems:
+            init_db()
+            create_default_admin()
+            start_background(blob_gc_worker)
+            start_background(session_eviction_worker)
+            started_subsystems.add("db")
+
+        if "cups" in wanted and "cups" not in started_subsystems:
+            try:
+                discover_printers()
+            except CupsUnavailable as e:
+                # Start anyway with the printers we knew about, offline;
+                # the status worker keeps retrying discovery
+                print(f"Printer discovery failed, retrying in the background: {e}")
+                load_printers()
+                build_printer_snapshot()
+                printer_discovery_pending.set()
+            start_background(printer_status_worker)
+            started_subsystems.add("cups")
+
+        if "workers" in wanted and "workers" not in started_subsystems:
+            if PRINTER_ROLE == "api":
+                start_background(job_status_feed_worker)
+            else:
+                claim_jobs(take_over=PRINTER_ROLE == "all")
+                start_printer_workers()
+                start_background(job_claim_worker)
+            started_subsystems.add("workers")
+
+def stop_app(timeout=None):
+    """
+    Stop background work. Printer workers take no new jobs; ones printing
+    get up to `timeout` (SHUTDOWN_DRAIN_TIMEOUT) seconds to finish, and
+    jobs not yet in CUPS are handed back in the database.
+    """
+    timeout = SHUTDOWN_DRAIN_TIMEOUT if timeout is None else timeout
+
+    shutdown_requested.set()
+    printer_refresh_requested.set()
+
+    for queue in list(printer_queues.values()):
+        queue.close()
+
+    deadline = time.monotonic() + timeout
+    for name, thread in list(printer_threads.items()):
+        thread.join(max(0.0, deadline - time.monotonic()))
+        if thread.is_alive():
+            print(f"Printer {name} still printing; its job is picked up again on the next start")
+
+    with startup_lock:
+        if "workers" in started_subsystems and PRINTER_ROLE != "api":
+            released = release_job_claims()
+            if released:
+                print(f"Released {released} unprinted job(s)")
+        started_subsystems.clear()
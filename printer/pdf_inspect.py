@@ -0,0 +1,316 @@
+"""
+Page count and document info for uploaded PDFs.
+
+inspect() first reads the page tree root's /Count straight out of the file
+through mmap: trailer /Root -> catalog /Pages -> /Count, locating objects
+through the cross-reference table. /Count is only trusted once the /Kids
+tree under it has been walked and holds that many pages, since it is one
+editable number. That covers the PDFs people normally print without
+parsing a single page's content. Documents it
+can't read that way (objects inside compressed object streams, damaged
+trailers) fall back to a full PyPDF2 parse in a small process pool with a
+timeout, so a pathological file costs a pool slot instead of a request
+thread.
+"""
+
+import mmap
+import multiprocessing
+import queue
+import re
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+from PyPDF2 import PdfReader
+
+
+_ROOT_RE = re.compile(rb"/Root\s+(\d+)\s+(\d+)\s+R")
+_INFO_RE = re.compile(rb"/Info\s+(\d+)\s+(\d+)\s+R")
+_PAGES_RE = re.compile(rb"/Pages\s+(\d+)\s+(\d+)\s+R")
+_COUNT_RE = re.compile(rb"/Count\s+(\d+)(?!\d)(?!\s+\d+\s+R)")
+_TYPE_PAGES_RE = re.compile(rb"/Type\s*/Pages\b")
+_TYPE_PAGE_RE = re.compile(rb"/Type\s*/Page\b")
+_KIDS_RE = re.compile(rb"/Kids\s*\[([^\]]*)\]")
+_REF_RE = re.compile(rb"(\d+)\s+(\d+)\s+R")
+_OBJ_HEADER_RE = re.compile(rb"(\d+)\s+(\d+)\s+obj\b")
+_STARTXREF_RE = re.compile(rb"startxref\s+(\d+)")
+_SUBSECTION_RE = re.compile(rb"\s*(\d+) +(\d+)[ \t]*\r?\n")
+_PREV_RE = re.compile(rb"/Prev\s+(\d+)")
+
+# Each cross-reference entry is exactly 20 bytes
+_XREF_ENTRY = 20
+_MAX_XREF_SECTIONS = 32
+_INFO_ENTRY_RE = re.compile(
+    rb"/(Title|Author|Subject|Creator|Producer)\s*\(((?:[^()\\]|\\.)*)\)"
+)
+
+# The trailer (or xref stream dictionary) lives at the end of the file
+_TAIL_BYTES = 64 * 1024
+
+
+class PdfError(ValueError):
+    pass
+
+
+class PdfTimeout(PdfError):
+    pass
+
+
+class PdfBusy(Exception):
+    pass
+
+
+def _xref_offset(data, num, startxref):
+    """
+    Byte offset of object `num` according to the classic cross-reference
+    tables, following /Prev through incremental updates. None if the file
+    uses cross-reference streams or doesn't list the object.
+    """
+    offset = startxref
+    seen = set()
+
+    while offset is not None and offset not in seen and len(seen) < _MAX_XREF_SECTIONS:
+        seen.add(offset)
+        if data[offset:offset + 4] != b"xref":
+            return None
+
+        pos = offset + 4
+        while True:
+            subsection = _SUBSECTION_RE.match(data, pos)
+            if not subsection:
+                break
+
+            first, count = int(subsection.group(1)), int(subsection.group(2))
+            pos = subsection.end()
+
+            if first <= num < first + count:
+                entry = data[pos + (num - first) * _XREF_ENTRY:][:_XREF_ENTRY]
+                if entry[17:18] != b"n" or not entry[:10].isdigit():
+                    return None
+                return int(entry[:10])
+
+            pos += count * _XREF_ENTRY
+
+        prev = _PREV_RE.search(data[pos:pos + 4096])
+        offset = int(prev.group(1)) if prev else None
+
+    return None
+
+
+def _find_object(data, num, gen, startxref=None, scan=True):
+    start = None
+
+    if startxref is not None:
+        offset = _xref_offset(data, num, startxref)
+        match = _OBJ_HEADER_RE.match(data, offset) if offset is not None else None
+        if match and (int(match.group(1)), int(match.group(2))) == (num, gen):
+            start = match.end()
+
+    if start is None and scan:
+        # No usable xref entry: scan, and since incremental updates append
+        # newer versions, the last one wins
+        header = re.compile(rb"(?<!\d)%d\s+%d\s+obj\b" % (num, gen))
+        for match in header.finditer(data):
+            start = match.end()
+
+    if start is None:
+        return None
+
+    end = data.find(b"endobj", start)
+    if end == -1:
+        return None
+
+    return data[start:end]
+
+
+def _last_match(regex, data):
+    match = None
+    for match in regex.finditer(data):
+        pass
+    return match
+
+
+def _count_pages(data, pages, startxref, limit):
+    """
+    Number of page leaves under the page tree node `pages`, walking /Kids
+    through the cross-reference table. None if the tree can't be walked
+    that way, loops, or holds more than `limit` pages.
+    """
+    leaves = 0
+    seen = set()
+    stack = [pages]
+
+    while stack:
+        node = stack.pop()
+        kids = _KIDS_RE.search(node)
+        if not kids:
+            return None
+
+        for ref in _REF_RE.finditer(kids.group(1)):
+            key = (int(ref.group(1)), int(ref.group(2)))
+            if key in seen:
+                return None
+            seen.add(key)
+
+            # Without an xref entry each lookup would scan the whole file
+            kid = _find_object(data, key[0], key[1], startxref, scan=False)
+            if kid is None:
+                return None
+
+            if _TYPE_PAGES_RE.search(kid):
+                stack.append(kid)
+            elif _TYPE_PAGE_RE.search(kid):
+                leaves += 1
+                if leaves > limit:
+                    return None
+            else:
+                return None
+
+    return leaves
+
+
+def fast_inspect(path):
+    """
+    Read the page count (and simple /Info strings) without parsing the
+    document. Returns None when the file isn't laid out for that.
+    """
+    with open(path, "rb") as f:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty file
+            return None
+
+    with data:
+        tail_start = max(0, len(data) - _TAIL_BYTES)
+        tail = data[tail_start:]
+
+        root_ref = _last_match(_ROOT_RE, tail) or _last_match(_ROOT_RE, data)
+        if not root_ref:
+            return None
+
+        startxref = _last_match(_STARTXREF_RE, tail)
+        startxref = int(startxref.group(1)) if startxref else None
+
+        catalog = _find_object(data, int(root_ref.group(1)), int(root_ref.group(2)), startxref)
+        if catalog is None:
+            return None
+
+        pages_ref = _PAGES_RE.search(catalog)
+        if not pages_ref:
+            return None
+
+        pages = _find_object(data, int(pages_ref.group(1)), int(pages_ref.group(2)), startxref)
+        if pages is None or not _TYPE_PAGES_RE.search(pages):
+            return None
+
+        count = _COUNT_RE.search(pages)
+        if not count or int(count.group(1)) < 1 or startxref is None:
+            return None
+
+        # The page count is what gets charged against quotas
+        if _count_pages(data, pages, startxref, int(count.group(1))) != int(count.group(1)):
+            return None
+
+        metadata = {}
+        info_ref = _last_match(_INFO_RE, tail)
+        if info_ref:
+            info = _find_object(data, int(info_ref.group(1)), int(info_ref.group(2)), startxref)
+            for key, value in _INFO_ENTRY_RE.findall(info or b""):
+                metadata[key.decode()] = value.decode("latin-1")
+
+        return {
+            "pages": int(count.group(1)),
+            "metadata": metadata
+        }
+
+
+def full_inspect(path):
+    with open(path, "rb") as f:
+        reader = PdfReader(f)
+        return {
+            "pages": len(reader.pages),
+            "metadata": {
+                k.lstrip("/"): str(v)
+                for k, v in (reader.metadata or {}).items()
+            }
+        }
+
+
+class FallbackPool:
+    """
+    Worker processes for full parses, one per slot. At most `workers`
+    parses run at once; a caller waits up to the timeout for a free slot
+    and then gets PdfBusy. A parse that overruns its timeout has its own
+    worker killed (and replaced on next use), leaving parses in the
+    other slots alone.
+    """
+
+    def __init__(self, workers, timeout):
+        self.workers = workers
+        self.timeout = timeout
+        self._executors = [None] * workers
+        # LIFO so the same warm workers keep getting used
+        self._free = queue.LifoQueue()
+        for slot in range(workers):
+            self._free.put(slot)
+
+    def _get_executor(self, slot):
+        if self._executors[slot] is None:
+            # spawn, not fork: the server process is multi-threaded
+            self._executors[slot] = ProcessPoolExecutor(
+                max_workers=1,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        return self._executors[slot]
+
+    def _reset(self, slot):
+        executor = self._executors[slot]
+        self._executors[slot] = None
+
+        # ProcessPoolExecutor can't cancel a running call; kill the worker
+        for process in list(executor._processes.values()):
+            process.terminate()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def inspect(self, path):
+        try:
+            slot = self._free.get(timeout=self.timeout)
+        except queue.Empty:
+            raise PdfBusy("Too many PDFs being processed")
+
+        try:
+            executor = self._get_executor(slot)
+            try:
+                future = executor.submit(full_inspect, path)
+                return future.result(timeout=self.timeout)
+            except TimeoutError:
+                self._reset(slot)
+                raise PdfTimeout("PDF took too long to process")
+            except BrokenProcessPool:
+                self._reset(slot)
+                raise PdfError("PDF parser crashed")
+            except PdfError:
+                raise
+            except Exception as e:
+                raise PdfError(str(e))
+        finally:
+            self._free.put(slot)
+
+
+def inspect(path, pool):
+    """
+    Page count and metadata for the PDF at path, via the fast path when
+    possible and `pool` (a FallbackPool) otherwise.
+    """
+    try:
+        info = fast_inspect(path)
+    except OSError as e:
+        raise PdfError(str(e))
+    except Exception:
+        # Whatever the fast path trips over, the full parse gets to judge
+        info = None
+
+    if info is not None:
+        return info
+
+    return pool.inspect(path)
@@ -0,0 +1,50 @@
+"""
+Printer daemon for multi-process deployments.
+
+Runs the printer workers without the API: it claims jobs the API
+processes leave queued in the shared database and prints them. Run it
+next to any number of API-only processes on the same database:
+
+    PRINTER_ROLE=api uvicorn main:app --workers 4
+    python printer_daemon.py
+
+A second daemon (with its own PRINTER_DAEMON_ID) can stand by; it takes
+over the first one's jobs once their leases run out. On SIGTERM or
+Ctrl-C the daemon lets jobs already sent to CUPS finish (up to
+SHUTDOWN_DRAIN_TIMEOUT) and releases the rest so the standby takes them
+at once.
+"""
+
+import os
+import signal
+import threading
+
+os.environ.setdefault("PRINTER_ROLE", "daemon")
+
+# main.py resolves static/ and templates/ relative to the working directory
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+import main  # noqa: E402
+
+
+def run():
+    if main.PRINTER_ROLE != "daemon":
+        raise SystemExit(f"PRINTER_ROLE must be daemon, not {main.PRINTER_ROLE!r}")
+
+    main.start_app()
+    print(f"Printer daemon {main.PRINTER_DAEMON_ID} running for {', '.join(main.printer_queues) or 'no printers'}")
+
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+
+    try:
+        stopping.wait()
+    except KeyboardInterrupt:
+        pass
+
+    print(f"Printer daemon {main.PRINTER_DAEMON_ID} stopping")
+    main.stop_app()
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,66 @@
+"""
+Token-bucket rate limiting keyed by arbitrary strings (usernames, client
+addresses).
+
+Each key gets `burst` tokens that refill at `rate` per second. Buckets
+that have refilled completely carry no information and are dropped, and
+at most `max_keys` buckets are kept, least recently used first out, so a
+flood of distinct keys can't grow memory without bound.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class RateLimiter:
+    def __init__(self, rate, burst, max_keys=100000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict()
+
+    def _level(self, key, now):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            return self.burst
+        tokens, updated = bucket
+        return min(self.burst, tokens + (now - updated) * self.rate)
+
+    def acquire(self, key):
+        """
+        Take one token for `key`. Returns 0 if it was available, otherwise
+        the number of seconds until one will be (nothing is taken).
+        """
+        if self.rate <= 0:
+            return 0
+
+        now = time.monotonic()
+
+        with self._lock:
+            tokens = self._level(key, now)
+            if tokens < 1:
+                return (1 - tokens) / self.rate
+
+            self._buckets[key] = (tokens - 1, now)
+            self._buckets.move_to_end(key)
+
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+
+            return 0
+
+    def reset(self, key):
+        with self._lock:
+            self._buckets.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+    def prune(self):
+        now = time.monotonic()
+        with self._lock:
+            for key in [k for k in self._buckets if self._level(k, now) >= self.burst]:
+                del self._buckets[key]
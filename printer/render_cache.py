@@ -0,0 +1,188 @@
+"""
+Print-ready render cache for host-based printers.
+
+A printer like the LaserJet 1020 has no PDF interpreter: CUPS converts
+each job through the queue's filter chain (PDF -> raster -> ZjStream) only
+once it reaches the front of the queue, and the printer sits idle while
+it does. RenderCache runs that same chain ahead of time with cupsfilter
+and the queue's PPD while earlier jobs print, and keeps the output on disk
+under a key of the document and the options that change its rendering.
+The worker then sends the cached file raw, and a document printed again
+with the same options is never converted twice.
+
+Each render is a cupsfilter process (and its filter children), started
+from a small thread pool so at most `workers` conversions run at once.
+A render that overruns `timeout` has its whole process group killed.
+Cached files are evicted least recently used first once they add up to
+more than `max_bytes`.
+"""
+
+import hashlib
+import json
+import os
+import signal
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+
+class RenderCache:
+    def __init__(self, directory, command="cupsfilter", ppd_dir="/etc/cups/ppd",
+                 workers=1, timeout=300.0, max_bytes=2 * 1024 ** 3, on_render=None):
+        self.directory = directory
+        self.command = command
+        self.ppd_dir = ppd_dir
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        # on_render(seconds, outcome), outcome being "ok" or "failed"
+        self.on_render = on_render
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._disabled = False
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers,
+            thread_name_prefix="render"
+        )
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(file_path, printer, options):
+        # Uploads live in the content-addressed blob store, so the path
+        # stands for the document's content
+        material = json.dumps([file_path, printer, sorted(options.items())])
+        return hashlib.sha256(material.encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], f"{key}.prn")
+
+    def prefetch(self, file_path, printer, options):
+        """Start rendering in the background unless it is cached or under way."""
+        if self._disabled:
+            return
+
+        key = self.key(file_path, printer, options)
+        if os.path.exists(self.path(key)):
+            return
+
+        with self._lock:
+            if key in self._pending:
+                return
+            self._pending[key] = self._executor.submit(
+                self._render, key, file_path, printer, options
+            )
+
+    def get(self, file_path, printer, options):
+        """
+        Path of the rendered document, or None if the caller should let
+        CUPS convert it. Waits for a render that is already running (its
+        work would otherwise be thrown away); one still waiting for a
+        worker is cancelled.
+        """
+        key = self.key(file_path, printer, options)
+        path = self.path(key)
+
+        with self._lock:
+            future = self._pending.get(key)
+            if future is not None and future.cancel():
+                del self._pending[key]
+                future = None
+
+        if future is not None:
+            try:
+                future.result(timeout=self.timeout)
+            except TimeoutError:
+                return None
+
+        try:
+            # Mark it recently used
+            os.utime(path)
+        except OSError:
+            return None
+        return path
+
+    def _render(self, key, file_path, printer, options):
+        path = self.path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        args = [
+            self.command,
+            "-p", os.path.join(self.ppd_dir, f"{printer}.ppd"),
+            "-m", "printer/foo",
+            "-e",
+        ]
+        for name, value in options.items():
+            args += ["-o", f"{name}={value}"]
+        args.append(file_path)
+
+        start = time.monotonic()
+        ok = False
+
+        try:
+            with open(tmp_path, "wb") as out:
+                process = subprocess.Popen(
+                    args,
+                    stdout=out,
+                    stderr=subprocess.DEVNULL,
+                    start_new_session=True
+                )
+                try:
+                    ok = process.wait(timeout=self.timeout) == 0
+                except subprocess.TimeoutExpired:
+                    # cupsfilter's filters run in its process group
+                    os.killpg(process.pid, signal.SIGKILL)
+                    process.wait()
+                    print(f"Render of {file_path} for {printer} timed out")
+
+            if ok and os.path.getsize(tmp_path):
+                os.replace(tmp_path, path)
+            else:
+                ok = False
+
+        except FileNotFoundError:
+            print(f"{self.command} not found, pre-rendering disabled")
+            self._disabled = True
+
+        finally:
+            if not ok:
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+
+            with self._lock:
+                self._pending.pop(key, None)
+
+            if self.on_render is not None:
+                self.on_render(time.monotonic() - start, "ok" if ok else "failed")
+
+        if ok:
+            self.trim()
+
+    def trim(self):
+        """Evict least recently used renders until the cache fits max_bytes."""
+        entries = []
+        total = 0
+
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if not name.endswith(".prn"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
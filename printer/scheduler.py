@@ -0,0 +1,149 @@
+"""
+Fair-share job queue for one printer.
+
+Jobs are ordered by admin-set priority first (higher first), then by
+weighted fair queueing between users: each job gets a virtual finish tag
+of start + cost, where start is the later of the queue's virtual time and
+the finish tag of that user's previous job. A user who queues fifty long
+jobs therefore only gets every other turn against someone with one short
+job, and a short job from an otherwise idle user jumps ahead of a long
+one queued just before it.
+
+Used by one worker thread per printer: get() hands out the next job and
+the worker reports back with done() or requeue(). close() stops the
+worker: get() returns None from then on.
+"""
+
+import itertools
+import threading
+
+
+def _order_key(entry):
+    return (-entry["priority"], entry["finish"], entry["seq"])
+
+
+class FairQueue:
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._queued = {}
+        self._running = {}
+        self._user_finish = {}
+        self._virtual_time = 0.0
+        self._seq = itertools.count()
+        self._closed = False
+
+    def put(self, job_id, user_id, cost, priority=0):
+        with self._cond:
+            start = max(self._virtual_time, self._user_finish.get(user_id, 0.0))
+            finish = start + max(cost, 1)
+            self._user_finish[user_id] = finish
+
+            self._queued[job_id] = {
+                "job_id": job_id,
+                "user_id": user_id,
+                "cost": cost,
+                "priority": priority,
+                "start": start,
+                "finish": finish,
+                "seq": next(self._seq),
+            }
+            self._cond.notify()
+
+    def get(self):
+        """
+        Block until a job is queued and return the next one's id, or None
+        once the queue is closed (queued jobs stay where they are).
+        """
+        with self._cond:
+            while not self._queued and not self._closed:
+                self._cond.wait()
+
+            if self._closed:
+                return None
+
+            entry = min(self._queued.values(), key=_order_key)
+            del self._queued[entry["job_id"]]
+            self._running[entry["job_id"]] = entry
+
+            self._virtual_time = max(self._virtual_time, entry["start"])
+            for user_id in [u for u, f in self._user_finish.items() if f <= self._virtual_time]:
+                del self._user_finish[user_id]
+
+            return entry["job_id"]
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def done(self, job_id):
+        with self._cond:
+            self._running.pop(job_id, None)
+
+    def requeue(self, job_id):
+        # Back in line with its original tags, so a retry isn't charged twice
+        with self._cond:
+            entry = self._running.pop(job_id, None)
+            if entry:
+                self._queued[job_id] = entry
+                self._cond.notify()
+
+    def remove(self, job_id):
+        with self._cond:
+            return self._queued.pop(job_id, None) is not None
+
+    def order(self):
+        """Queued jobs in the order they will be handed out."""
+        with self._cond:
+            return [dict(e) for e in sorted(self._queued.values(), key=_order_key)]
+
+    def depth(self):
+        with self._cond:
+            return len(self._queued)
+
+    def running(self):
+        with self._cond:
+            return [dict(e) for e in self._running.values()]
+
+    def set_priority(self, job_id, priority):
+        with self._cond:
+            entry = self._queued.get(job_id)
+            if not entry:
+                return False
+            entry["priority"] = priority
+            return True
+
+    def move(self, job_id, position):
+        """
+        Move a queued job to `position` (0 = next) and return the priority
+        it now has, or None if it isn't queued here. Taking over the
+        priority of its new neighbour is what keeps it in place.
+        """
+        with self._cond:
+            entry = self._queued.get(job_id)
+            if not entry:
+                return None
+
+            others = sorted(
+                (e for e in self._queued.values() if e is not entry),
+                key=_order_key
+            )
+            if not others:
+                return entry["priority"]
+
+            position = max(0, min(position, len(others)))
+            if position < len(others):
+                neighbour = others[position]
+                seq = neighbour["seq"] - 1
+                previous = others[position - 1] if position else None
+                if previous and _order_key(previous)[:2] == _order_key(neighbour)[:2]:
+                    seq = (previous["seq"] + neighbour["seq"]) / 2
+            else:
+                neighbour = others[-1]
+                seq = neighbour["seq"] + 1
+
+            entry["priority"] = neighbour["priority"]
+            entry["finish"] = neighbour["finish"]
+            entry["seq"] = seq
+
+            return entry["priority"]
@@ -23,6 +23,10 @@ if (role !== "admin") {
 
 let currentJobId = null;
 let pollInterval = null;
+let jobEvents = null;
+let historyEvents = null;
+let historyInterval = null;
+let historyReload = null;
 
 const jobHistoryTitle = document.getElementById("jobHistoryTitle");
 
@@ -32,6 +36,13 @@ jobHistoryTitle.textContent =
 const logoutBtn = document.getElementById("logoutBtn");
 
 logoutBtn.addEventListener("click", () => {
+    // End the session on the server; the page is left either way
+    fetch("/logout", {
+        method: "POST",
+        headers: { "Authorization": `Bearer ${token}` },
+        keepalive: true
+    }).catch(() => {});
+
     // Remove auth data
     localStorage.removeItem("token");
     localStorage.removeItem("role");
@@ -40,6 +51,12 @@ logoutBtn.addEventListener("click", () => {
     if (pollInterval) {
         clearInterval(pollInterval);
     }
+    if (jobEvents) {
+        jobEvents.close();
+    }
+    if (historyEvents) {
+        historyEvents.close();
+    }
 
     // Redirect to login
     window.location.href = "/login";
@@ -81,13 +98,18 @@ printBtn.addEventListener("click", async () => {
 
         currentJobId = data.job_id;
         statusText.textContent = "Job submitted. Job ID: " + currentJobId;
+
+        if (data.estimated_start) {
+            const start = new Date(data.estimated_start).toLocaleTimeString();
+            statusText.textContent += ` (expected to start around ${start})`;
+        }
         loadQuota();
 
         if (role === "admin") {
             cancelBtn.style.display = "inline";
         }
 
-        startPolling();
+        watchJob();
 
     } catch (err) {
         statusText.textContent = "Server error";
@@ -122,6 +144,91 @@ async function loadQuota() {
     }
 }
 
+// Returns true once the job has reached a final state
+function showJobStatus(status, data = {}) {
+    statusText.textContent = "Status: " + status;
+
+    if (status === "printing" && data.pages_total) {
+        statusText.textContent +=
+            ` (${data.pages_printed} of ${data.pages_total} pages printed)`;
+    }
+
+    if (status === "queued" && data.estimated_start) {
+        const start = new Date(data.estimated_start).toLocaleTimeString();
+        statusText.textContent +=
+            ` (position ${data.queue_position + 1}, expected to start around ${start})`;
+    }
+
+    if (
+        status === "completed" ||
+        status === "failed" ||
+        status === "cancelled"
+    ) {
+        cancelBtn.style.display = "none";
+        loadQuota();
+        return true;
+    }
+
+    return false;
+}
+
+// EventSource can't send the Authorization header, so each stream is
+// opened with a short-lived ticket rather than the session token
+async function openEventStream(path) {
+    const response = await fetch("/events/ticket", {
+        method: "POST",
+        headers: {
+            "Authorization": "Bearer " + token
+        }
+    });
+
+    if (!response.ok) {
+        throw new Error("Could not get a stream ticket");
+    }
+
+    const data = await response.json();
+    return new EventSource(`${path}?ticket=${encodeURIComponent(data.ticket)}`);
+}
+
+// Follow the current job over Server-Sent Events, polling if the stream
+// isn't available
+async function watchJob() {
+    if (pollInterval) {
+        clearInterval(pollInterval);
+    }
+    if (jobEvents) {
+        jobEvents.close();
+        jobEvents = null;
+    }
+
+    if (!window.EventSource) {
+        startPolling();
+        return;
+    }
+
+    try {
+        jobEvents = await openEventStream(`/job/${currentJobId}/events`);
+    } catch (err) {
+        startPolling();
+        return;
+    }
+
+    jobEvents.addEventListener("job", (event) => {
+        const data = JSON.parse(event.data);
+
+        if (showJobStatus(data.status, data)) {
+            jobEvents.close();
+            jobEvents = null;
+        }
+    });
+
+    jobEvents.onerror = () => {
+        jobEvents.close();
+        jobEvents = null;
+        startPolling();
+    };
+}
+
 function startPolling() {
     pollInterval = setInterval(async () => {
         try {
@@ -138,16 +245,8 @@ function startPolling() {
                 return;
             }
 
-            statusText.textContent = "Status: " + data.status;
-
-            if (
-                data.status === "completed" ||
-                data.status === "failed" ||
-                data.status === "cancelled"
-            ) {
+            if (showJobStatus(data.status, data)) {
                 clearInterval(pollInterval);
-                cancelBtn.style.display = "none";
-                loadQuota();
             }
 
         } catch (err) {
@@ -208,7 +307,9 @@ async function loadJobHistory() {
 
         jobTableBody.innerHTML = "";
 
-        data.forEach(job => {
+        // Only the newest page is shown; older jobs are reachable through
+        // the next_after_job_id cursor
+        data.jobs.forEach(job => {
             const row = document.createElement("tr");
 
             row.innerHTML = `
@@ -284,11 +385,64 @@ async function loadPrinterStatus() {
     }
 }
 
+// Reload job history when one of the listed jobs changes; poll every
+// 5 seconds while the event stream is down
+async function watchJobHistory() {
+    if (!window.EventSource) {
+        historyInterval = setInterval(loadJobHistory, 5000);
+        return;
+    }
+
+    try {
+        historyEvents = await openEventStream("/jobs/events");
+    } catch (err) {
+        historyEvents = null;
+    }
+
+    if (!historyEvents) {
+        if (!historyInterval) {
+            historyInterval = setInterval(loadJobHistory, 5000);
+        }
+        setTimeout(watchJobHistory, 5000);
+        return;
+    }
+
+    historyEvents.addEventListener("job", () => {
+        // Coalesce bursts of updates into one reload
+        if (!historyReload) {
+            historyReload = setTimeout(() => {
+                historyReload = null;
+                loadJobHistory();
+            }, 250);
+        }
+    });
+
+    historyEvents.onopen = () => {
+        if (historyInterval) {
+            clearInterval(historyInterval);
+            historyInterval = null;
+        }
+        loadJobHistory();
+    };
+
+    historyEvents.onerror = () => {
+        if (!historyInterval) {
+            historyInterval = setInterval(loadJobHistory, 5000);
+        }
+
+        // EventSource gives up once its ticket has expired; start over
+        // with a new one
+        if (historyEvents.readyState === EventSource.CLOSED) {
+            historyEvents = null;
+            setTimeout(watchJobHistory, 5000);
+        }
+    };
+}
+
 // Load job history initially
 loadJobHistory();
 loadPrinterStatus();
-// Refresh job history every 5 seconds
-setInterval(loadJobHistory, 5000);
+watchJobHistory();
 setInterval(loadPrinterStatus, 5000);
 loadQuota();
 loadPrinterCapabilities();